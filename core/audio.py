@@ -0,0 +1,79 @@
+"""
+Incremental whole-story audio.
+
+Each scene's audio is fingerprinted by the text, voice and language it was
+synthesized from, and the fingerprint is kept on its Media. Whole-story audio
+jobs carry a plan listing every scene in order: scenes whose current audio
+still matches are stitched from their existing segment, and only the rest
+are synthesized and charged for, so TTS time and cost scale with the edit.
+"""
+
+import hashlib
+import json
+import math
+
+from .models import Media, Scene
+from .utils import CREDIT_COSTS
+
+
+def scene_audio_fingerprint(content, voice_id, language):
+    """A stable sha256 hex digest of what a scene's audio is synthesized from."""
+    return hashlib.sha256(json.dumps([content, voice_id, language]).encode()).hexdigest()
+
+
+def scene_audio_cost(content):
+    return math.ceil(CREDIT_COSTS['audio'] * len(content))
+
+
+def plan_story_audio(story_id, voice_id, language):
+    """
+    Work out which scenes of a story need new audio.
+
+    Args:
+        story_id (int): Story to narrate
+        voice_id (str): Voice the audio is requested in
+        language (str): Language the audio is requested in
+
+    Returns:
+        list: One dict per active scene in story order with scene_id,
+        fingerprint and credit_cost; media_id and url name the current audio
+        to reuse, or are None when the scene has to be synthesized
+    """
+    current = {}
+    for scene_id, media_id, url, fingerprint in Media.objects.filter(
+        story_id=story_id, media_type='audio', is_active=True
+    ).order_by('id').values_list('scene_id', 'id', 'url', 'fingerprint'):
+        # The latest audio of a scene wins
+        current[scene_id] = (media_id, url, fingerprint)
+
+    plan = []
+    for scene_id, content in Scene.objects.filter(
+        story_id=story_id, is_active=True
+    ).order_by('order', 'id').values_list('id', 'content'):
+        fingerprint = scene_audio_fingerprint(content, voice_id, language)
+        media_id, url, current_fingerprint = current.get(scene_id, (None, None, None))
+        reusable = media_id is not None and current_fingerprint == fingerprint
+        plan.append({
+            'scene_id': scene_id,
+            'fingerprint': fingerprint,
+            'media_id': media_id if reusable else None,
+            'url': url if reusable else None,
+            'credit_cost': 0 if reusable else scene_audio_cost(content),
+        })
+    return plan
+
+
+def stale_scenes(plan):
+    """The scenes of a plan that have to be synthesized."""
+    return [scene for scene in plan if scene['media_id'] is None]
+
+
+def story_audio_segments(story_id):
+    """The current audio segment of each active scene in story order, for stitching previews."""
+    segments = {}
+    for scene_id, media_id, url in Media.objects.filter(
+        story_id=story_id, media_type='audio', is_active=True, scene__is_active=True
+    ).order_by('scene__order', 'scene_id', 'id').values_list('scene_id', 'id', 'url'):
+        # The latest audio of a scene wins; dicts keep story order
+        segments[scene_id] = {'scene_id': scene_id, 'media_id': media_id, 'url': url}
+    return list(segments.values())
@@ -0,0 +1,202 @@
+"""
+Response caching for story endpoints.
+
+Conditional GET support derives a weak ETag for a story from one aggregate
+query, so polling clients get a 304 without the story being serialized.
+
+Public responses are cached in Redis under keys that embed a version number. Saving or
+deleting a story, scene, media or revision bumps the version of its story
+(and of the public list when the story is public), so stale entries are never
+read again and simply expire.
+"""
+
+import hashlib
+import json
+import time
+
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import transaction
+from django.db.models import Count, Max, OuterRef, Subquery
+from django.utils.http import parse_etags
+from rest_framework import status
+from rest_framework.response import Response
+
+from .models import Credits, Media, Revision, Scene, Story
+from .utils import redis_client
+
+PUBLIC_CACHE_TTL = 300  # seconds a cached public response is kept
+FILL_LOCK_TTL = 10  # seconds one request may spend filling a missing entry
+FILL_WAIT = 2.0  # seconds other requests wait for that entry before computing it themselves
+FILL_POLL_INTERVAL = 0.05
+
+PUBLIC_LIST_VERSION_KEY = 'public:stories:version'
+
+
+def story_version_key(story_id):
+    return f"public:story:{story_id}:version"
+
+
+def query_fingerprint(request):
+    """Stable hash of a request's query parameters."""
+    params = sorted(request.query_params.lists())
+    return hashlib.md5(json.dumps(params).encode()).hexdigest()
+
+
+def public_list_cache_key(request):
+    """Cache key for a public story listing, or None when Redis is unavailable."""
+    version = _get_version(PUBLIC_LIST_VERSION_KEY)
+    if version is None:
+        return None
+    return f"public:stories:v{version}:{query_fingerprint(request)}"
+
+
+def public_story_cache_key(story_id, name, request):
+    """Cache key for one public story response, or None when Redis is unavailable."""
+    version = _get_version(story_version_key(story_id))
+    if version is None:
+        return None
+    return f"public:story:{story_id}:{name}:v{version}:{query_fingerprint(request)}"
+
+
+def get_or_compute(key, compute):
+    """
+    Return the cached body stored at ``key``, computing and caching it on a miss.
+
+    Concurrent misses for the same key are coalesced: one request takes a
+    short fill lock and computes the body while the others poll for it,
+    so a burst of traffic on a cold entry costs a single database read.
+    Falls back to ``compute()`` whenever Redis is unavailable.
+
+    Args:
+        key (str): The cache key from one of the *_cache_key helpers; None disables caching
+        compute (callable): Builds the JSON serializable response body
+
+    Returns:
+        The response body
+    """
+    if key is None:
+        return compute()
+    # compute() is only ever called outside these try blocks, so its own
+    # exceptions (e.g. Http404) propagate instead of triggering a second run
+    try:
+        client = redis_client()
+        cached = client.get(key)
+        if cached is not None:
+            return json.loads(cached)
+
+        lock_key = f"{key}:lock"
+        filling = client.set(lock_key, 1, nx=True, ex=FILL_LOCK_TTL)
+        if not filling:
+            deadline = time.monotonic() + FILL_WAIT
+            while time.monotonic() < deadline:
+                time.sleep(FILL_POLL_INTERVAL)
+                cached = client.get(key)
+                if cached is not None:
+                    return json.loads(cached)
+    except Exception as e:
+        print(f"Error reading public cache: {str(e)}")
+        filling = False
+
+    if not filling:
+        # Redis is down, or the filling request is slow or died; serve this one directly
+        return compute()
+
+    try:
+        body = compute()
+        try:
+            client.setex(key, PUBLIC_CACHE_TTL, json.dumps(body, cls=DjangoJSONEncoder))
+        except Exception as e:
+            print(f"Error writing public cache: {str(e)}")
+        return body
+    finally:
+        try:
+            client.delete(lock_key)
+        except Exception as e:
+            print(f"Error releasing public cache lock: {str(e)}")
+
+
+def invalidate_public_story(story_id, include_list=True):
+    """
+    Invalidate cached public responses for a story once the current
+    transaction commits.
+
+    Args:
+        story_id (int): The story whose responses changed
+        include_list (bool): Also invalidate the public story listing
+    """
+    def bump():
+        try:
+            pipeline = redis_client().pipeline()
+            pipeline.incr(story_version_key(story_id))
+            if include_list:
+                pipeline.incr(PUBLIC_LIST_VERSION_KEY)
+            pipeline.execute()
+        except Exception as e:
+            print(f"Error invalidating public cache: {str(e)}")
+
+    transaction.on_commit(bump)
+
+
+def _get_version(key):
+    """Return the current version stored at ``key``, or None when Redis is unavailable."""
+    try:
+        return int(redis_client().get(key) or 0)
+    except Exception as e:
+        print(f"Error reading public cache version: {str(e)}")
+        return None
+
+
+def _aggregate(queryset, aggregate):
+    """Correlated subquery computing one aggregate over ``queryset`` per story."""
+    return Subquery(
+        queryset.order_by().values('story_id').annotate(value=aggregate).values('value'),
+    )
+
+
+def story_version(story_id):
+    """
+    Summarise everything a story's representations are built from in one query.
+
+    Returns a dict with the story's visibility and author alongside the latest
+    change timestamps and counts of its active scenes, active media, current
+    revisions and the author's active credits, or None if the story does not
+    exist.
+    """
+    scenes = Scene.objects.filter(story_id=OuterRef('pk'), is_active=True)
+    media = Media.objects.filter(story_id=OuterRef('pk'), is_active=True)
+    revisions = Revision.objects.filter(story_id=OuterRef('pk'), is_current=True, url__isnull=False)
+    credits = Credits.objects.filter(user_id=OuterRef('author_id'), is_active=True)
+    return Story.objects.filter(pk=story_id).values(
+        'is_public', 'author_id', 'updated_at', 'is_active'
+    ).annotate(
+        scenes_updated_at=_aggregate(scenes, Max('updated_at')),
+        scene_count=_aggregate(scenes, Count('id')),
+        media_max_id=_aggregate(media, Max('id')),
+        media_count=_aggregate(media, Count('id')),
+        revision_max_id=_aggregate(revisions, Max('id')),
+        revision_count=_aggregate(revisions, Count('id')),
+        credits_updated_at=Subquery(credits.order_by('-updated_at').values('updated_at')[:1]),
+    ).first()
+
+
+def story_etag(version, name, request):
+    """Weak ETag for one representation (``name`` plus query string) of a story version."""
+    digest = hashlib.md5(
+        json.dumps([name, version, query_fingerprint(request)], cls=DjangoJSONEncoder).encode()
+    ).hexdigest()
+    return f'W/"{digest}"'
+
+
+def etag_matches(request, etag):
+    """Weak comparison of ``etag`` against the request's If-None-Match header."""
+    if_none_match = parse_etags(request.META.get('HTTP_IF_NONE_MATCH', ''))
+    if '*' in if_none_match:
+        return True
+    opaque = etag.removeprefix('W/')
+    return any(candidate.removeprefix('W/') == opaque for candidate in if_none_match)
+
+
+def not_modified(etag):
+    response = Response(status=status.HTTP_304_NOT_MODIFIED)
+    response['ETag'] = etag
+    return response
@@ -0,0 +1,243 @@
+"""
+Batched job completion ingestion.
+
+Workers report finished jobs in batches. Each batch is applied in one
+transaction with a fixed number of statements however many events it
+carries: jobs are locked and updated with bulk_update, generated media and
+preview revisions are inserted with bulk_create, bulk parents are rolled up,
+and the affected stories' counters and caches are refreshed once. Failed
+jobs with retries left go back to pending for dispatch_retries. Job events
+are published after the transaction commits.
+
+finish_parent_jobs() rolls up bulk parents; it also runs when a child is
+cancelled (cancel_job) or dead lettered by the outbox relay.
+"""
+
+from django.db import transaction
+from django.db.models import Count, Q
+from django.utils import timezone
+
+from .cache import invalidate_public_story
+from .events import publish_job_events
+from .models import Job, Media, OutboxMessage, Revision, Story
+from .previews import invalidate_preview_status
+
+FINISHED_STATUSES = ('completed', 'failed', 'cancelled')
+
+PREVIEW_FORMATS = {
+    'generate_pdf_preview': 'pdf',
+    'generate_audio_preview': 'audio',
+    'generate_video_preview': 'mp4',
+}
+
+
+def apply_completion_events(events):
+    """
+    Apply a batch of validated completion events.
+
+    Args:
+        events (list): Dicts with job_id, status and optionally response_data,
+            error_message, media (url, description, request_id, fingerprint,
+            or a list of those with scene_id for story-level jobs) and revision (url, format, sub_format, metadata, or the id of the
+            pending revision the worker rendered)
+
+    Returns:
+        dict: Job ids that were ``applied`` (including failures scheduled for a
+        retry), ``skipped`` because they had already finished, and ``unknown``
+    """
+    now = timezone.now()
+    with transaction.atomic():
+        jobs = Job.objects.select_for_update().in_bulk([event['job_id'] for event in events])
+
+        applied, skipped, unknown = [], [], []
+        media, revisions, rendered, current_revisions = [], [], {}, {}
+        for event in events:
+            job = jobs.get(event['job_id'])
+            if job is None:
+                unknown.append(event['job_id'])
+                continue
+            # Redelivered events must not apply twice
+            if job.status in FINISHED_STATUSES:
+                skipped.append(job.id)
+                continue
+
+            job.status = event['status']
+            job.completed_at = now
+            job.updated_at = now
+            if event.get('response_data') is not None:
+                job.response_data = event['response_data']
+            if job.status == 'failed':
+                job.error_message = event.get('error_message') or 'Job failed'
+                # Left pending for dispatch_retries while the job has retries left
+                job.schedule_retry(save=False)
+            applied.append(job)
+
+            if job.status != 'completed':
+                continue
+            if event.get('media'):
+                media.extend(job_media(job, event['media']))
+            if event.get('revision') and job.story_id:
+                revision = event['revision']
+                metadata = revision.get('metadata') or {}
+                # The content the job was queued for, so unchanged stories aren't rendered again
+                if job.request_data.get('fingerprint'):
+                    metadata['fingerprint'] = job.request_data['fingerprint']
+                if revision.get('id'):
+                    rendered[revision['id']] = (job.story_id, revision, metadata)
+                    continue
+                new_revision = Revision(
+                    story_id=job.story_id,
+                    format=revision.get('format') or PREVIEW_FORMATS.get(job.job_type, 'pdf'),
+                    sub_format=revision.get('sub_format'),
+                    url=revision['url'],
+                    metadata=metadata,
+                    is_current=True,
+                    status='complete',
+                    completed_at=now
+                )
+                # Only the batch's last revision of a story and format stays current
+                previous = current_revisions.get((new_revision.story_id, new_revision.format))
+                if previous is not None:
+                    previous.is_current = False
+                current_revisions[(new_revision.story_id, new_revision.format)] = new_revision
+                revisions.append(new_revision)
+
+        Job.objects.bulk_update(applied, [
+            'status', 'completed_at', 'updated_at', 'response_data', 'error_message', 'retry_count', 'next_retry_at'
+        ])
+        Media.objects.bulk_create(media)
+        if revisions:
+            # The new revisions replace the current ones of the same story and format
+            replaced = Q()
+            for revision in revisions:
+                replaced |= Q(story_id=revision.story_id, format=revision.format)
+            Revision.objects.filter(replaced, is_current=True).update(is_current=False)
+            Revision.objects.bulk_create(revisions)
+        if rendered:
+            # Pending revisions the worker created before uploading the file
+            completed_revisions = []
+            for revision in Revision.objects.filter(pk__in=rendered):
+                story_id, data, metadata = rendered[revision.id]
+                if revision.story_id != story_id:
+                    continue
+                revision.url = data['url']
+                revision.metadata = {**(revision.metadata or {}), **metadata}
+                revision.status = 'complete'
+                revision.completed_at = now
+                completed_revisions.append(revision)
+            Revision.objects.bulk_update(completed_revisions, ['url', 'metadata', 'status', 'completed_at'])
+            revisions.extend(completed_revisions)
+
+        finished_parents = finish_parent_jobs({job.parent_id for job in applied if job.parent_id}, now)
+
+        story_ids = {job.story_id for job in applied if job.story_id}
+        if media:
+            Story.objects.filter(pk__in={item.story_id for item in media}).refresh_counters()
+        for story_id in story_ids:
+            invalidate_public_story(story_id)
+        for story_id in {revision.story_id for revision in revisions}:
+            invalidate_preview_status(story_id)
+        publish_job_events(applied + finished_parents)
+
+    return {
+        'applied': [job.id for job in applied],
+        'skipped': skipped,
+        'unknown': unknown,
+    }
+
+
+def job_media(job, items):
+    """
+    Build the Media rows a completed job reported.
+
+    A scene job reports one item for its own scene. A story-level job (a
+    generate_entire_audio run) reports a list of per-scene items; only the
+    scenes its plan synthesized are accepted, and each is stamped with the
+    fingerprint the plan computed for it so the next run reuses it.
+
+    Returns:
+        list: Unsaved Media
+    """
+    media_type = job.request_data.get('media_type', 'image')
+    if not isinstance(items, list):
+        if not job.scene_id:
+            return []
+        # Lets whole-story audio reuse this segment while the scene is unchanged
+        fingerprint = items.get('fingerprint') or (
+            job.request_data.get('fingerprint') if media_type == 'audio' else None
+        )
+        return [new_media(job, job.scene_id, media_type, items, fingerprint)]
+
+    planned = {
+        scene['scene_id']: scene for scene in job.request_data.get('scenes', []) if scene.get('media_id') is None
+    }
+    return [
+        new_media(job, item['scene_id'], media_type, item, planned[item['scene_id']].get('fingerprint'))
+        for item in items if item['scene_id'] in planned
+    ]
+
+
+def new_media(job, scene_id, media_type, item, fingerprint):
+    return Media(
+        story_id=job.story_id,
+        scene_id=scene_id,
+        media_type=media_type,
+        url=item['url'],
+        description=item.get('description', ''),
+        request_id=item.get('request_id'),
+        fingerprint=fingerprint
+    )
+
+
+def cancel_job(job):
+    """
+    Cancel a pending or processing job.
+
+    Cancelling a bulk parent cancels its unfinished children, and cancelling
+    a child finishes its parent once no other child is left. Messages of the
+    cancelled jobs that were not sent yet are dead lettered so no worker
+    picks them up.
+    """
+    now = timezone.now()
+    with transaction.atomic():
+        job.cancel()
+        children = list(job.children.select_for_update().exclude(status__in=FINISHED_STATUSES))
+        for child in children:
+            child.status = 'cancelled'
+            child.completed_at = now
+            child.updated_at = now
+        Job.objects.bulk_update(children, ['status', 'completed_at', 'updated_at'])
+        OutboxMessage.objects.filter(
+            job__in=[job] + children, sent_at__isnull=True, dead_lettered_at__isnull=True
+        ).update(dead_lettered_at=now, last_error='Job cancelled')
+        finished_parents = finish_parent_jobs({job.parent_id} if job.parent_id else set(), now)
+        publish_job_events(children + finished_parents)
+
+
+def finish_parent_jobs(parent_ids, now):
+    """Complete bulk parent jobs whose children have all finished; returns the parents updated."""
+    if not parent_ids:
+        return []
+    parents = list(
+        Job.objects.filter(pk__in=parent_ids).exclude(status__in=FINISHED_STATUSES).annotate(
+            unfinished=Count('children', filter=~Q(children__status__in=FINISHED_STATUSES)),
+            completed=Count('children', filter=Q(children__status='completed')),
+            failed=Count('children', filter=Q(children__status='failed')),
+            cancelled=Count('children', filter=Q(children__status='cancelled')),
+        )
+    )
+    finished = []
+    for parent in parents:
+        if parent.unfinished:
+            continue
+        # A bulk run is complete if any scene succeeded; failed children carry their own errors
+        if parent.completed:
+            parent.status = 'completed'
+        else:
+            parent.status = 'failed' if parent.failed else 'cancelled'
+        parent.completed_at = now
+        parent.updated_at = now
+        parent.response_data = {'completed': parent.completed, 'failed': parent.failed, 'cancelled': parent.cancelled}
+        finished.append(parent)
+    Job.objects.bulk_update(finished, ['status', 'completed_at', 'updated_at', 'response_data'])
+    return finished
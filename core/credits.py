@@ -0,0 +1,110 @@
+"""
+Credit balance reads for the WhisprTales API.
+
+A user's active balance is kept in Redis so profile and author reads don't
+touch the credits table. Cached balances are stored under a per-user version
+number: code that changes a balance bumps the version with
+invalidate_credit_balance() and the next read repopulates the cache from the
+database. A read that loaded the row before a change committed stores it
+under the old version, where it is never read again, so overlapping writers
+and readers can't leave a stale balance cached.
+"""
+
+import json
+
+from django.db import transaction
+from django.db.models import OuterRef, Subquery
+from rest_framework import serializers
+
+from .models import Credits
+from .utils import redis_client
+
+CREDIT_BALANCE_TTL = 24 * 60 * 60
+EMPTY_BALANCE = {'credits_remaining': 0, 'updated_at': None}
+
+
+def credit_balance_version_key(user_id):
+    return f"credits:balance:{user_id}:version"
+
+
+def credit_balance_key(user_id, version):
+    return f"credits:balance:{user_id}:v{version}"
+
+
+def credit_balance_data(credits):
+    """Represent a Credits row the way CreditSerializer does."""
+    return {
+        'credits_remaining': credits.credits_remaining,
+        'updated_at': serializers.DateTimeField().to_representation(credits.updated_at),
+    }
+
+
+def get_credit_balance(user_id):
+    """
+    Return a user's active credit balance, reading through Redis.
+
+    Args:
+        user_id (int): The user whose balance to read
+
+    Returns:
+        dict: credits_remaining and updated_at, zero and None when the user
+        has no active credits
+    """
+    key = None
+    try:
+        client = redis_client()
+        # Read the version before the row, so a change committing meanwhile
+        # makes this read cache under a version nobody reads any more
+        key = credit_balance_key(user_id, int(client.get(credit_balance_version_key(user_id)) or 0))
+        cached = client.get(key)
+        if cached is not None:
+            return json.loads(cached)
+    except Exception as e:
+        print(f"Error reading credit balance: {str(e)}")
+
+    credits = Credits.objects.filter(user_id=user_id, is_active=True).first()
+    if not credits:
+        return dict(EMPTY_BALANCE)
+    data = credit_balance_data(credits)
+    if key is not None:
+        try:
+            redis_client().setex(key, CREDIT_BALANCE_TTL, json.dumps(data))
+        except Exception as e:
+            print(f"Error caching credit balance: {str(e)}")
+    return data
+
+
+def annotate_credit_balance(users):
+    """
+    Annotate a user queryset with each user's active balance in the same
+    SQL statement, as ``active_credits_remaining`` and ``active_credits_updated_at``.
+    """
+    active_credits = Credits.objects.filter(user=OuterRef('pk'), is_active=True).order_by('-updated_at')
+    return users.annotate(
+        active_credits_remaining=Subquery(active_credits.values('credits_remaining')[:1]),
+        active_credits_updated_at=Subquery(active_credits.values('updated_at')[:1]),
+    )
+
+
+def annotated_credit_balance(user):
+    """Read the balance annotated by annotate_credit_balance()."""
+    if user.active_credits_updated_at is None:
+        return dict(EMPTY_BALANCE)
+    return {
+        'credits_remaining': user.active_credits_remaining,
+        'updated_at': serializers.DateTimeField().to_representation(user.active_credits_updated_at),
+    }
+
+
+def invalidate_credit_balance(user_id):
+    """
+    Drop a user's cached balance once the current transaction commits, so a
+    rolled back change never invalidates and the next read sees the change.
+    """
+    def bump():
+        try:
+            redis_client().incr(credit_balance_version_key(user_id))
+        except Exception as e:
+            print(f"Error invalidating credit balance: {str(e)}")
+
+    transaction.on_commit(bump)
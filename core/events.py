@@ -0,0 +1,125 @@
+"""
+Job progress events.
+
+Job status transitions are published to Redis pub/sub channels for the job's
+user and story. The job_events view streams them to the browser as
+Server-Sent Events, so an open tab holds one idle connection instead of
+polling the job and preview status endpoints.
+
+Served under ASGI only (see the Procfile); under WSGI every open stream
+would hold a worker thread, so the view refuses to stream there.
+"""
+
+import json
+
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import transaction
+from django.http import JsonResponse, StreamingHttpResponse
+from rest_framework_simplejwt.exceptions import TokenError
+from rest_framework_simplejwt.tokens import AccessToken
+
+from .models import Story
+from .utils import async_redis_client, redis_client, served_under_asgi
+
+JOB_EVENT_HEARTBEAT = 15  # seconds between keep-alive comments on an idle stream
+
+
+def user_channel(user_id):
+    return f"jobs:user:{user_id}"
+
+
+def story_channel(story_id):
+    return f"jobs:story:{story_id}"
+
+
+def job_event(job):
+    """The event payload for a job's current state."""
+    return {
+        'id': job.id,
+        'job_type': job.job_type,
+        'status': job.status,
+        'queue_lane': job.queue_lane,
+        'story': job.story_id,
+        'scene': job.scene_id,
+        'parent': job.parent_id,
+        'error_message': job.error_message,
+        'updated_at': job.updated_at,
+    }
+
+
+def publish_job_event(job):
+    """Publish a job's state to its user and story channels once the current transaction commits."""
+    publish_job_events([job])
+
+
+def publish_job_events(jobs):
+    """Publish the state of several jobs in one pipeline once the current transaction commits."""
+    messages = []
+    for job in jobs:
+        data = json.dumps(job_event(job), cls=DjangoJSONEncoder)
+        messages.append((user_channel(job.user_id), data))
+        if job.story_id:
+            messages.append((story_channel(job.story_id), data))
+
+    def publish():
+        try:
+            pipeline = redis_client().pipeline(transaction=False)
+            for channel, data in messages:
+                pipeline.publish(channel, data)
+            pipeline.execute()
+        except Exception as e:
+            print(f"Error publishing job event: {str(e)}")
+
+    if messages:
+        transaction.on_commit(publish)
+
+
+async def job_events(request):
+    """
+    Stream job status transitions as Server-Sent Events.
+
+    GET /events/jobs/?token=<access token>             - every job of the user
+    GET /events/jobs/?token=<access token>&story=<id>  - jobs of one of the user's stories
+
+    EventSource cannot send an Authorization header, so the JWT access token
+    is passed as a query parameter. Answers 501 when not served under ASGI.
+    """
+    if not served_under_asgi(request):
+        return JsonResponse({'error': 'Job events are only streamed when served under ASGI'}, status=501)
+
+    try:
+        user_id = AccessToken(request.GET.get('token', ''))['user_id']
+    except (TokenError, KeyError):
+        return JsonResponse({'error': 'Invalid or expired token'}, status=401)
+
+    story_id = request.GET.get('story')
+    if story_id:
+        if not story_id.isdigit() or not await Story.objects.filter(pk=story_id, author_id=user_id).aexists():
+            return JsonResponse({'error': 'Story not found'}, status=404)
+        channel = story_channel(story_id)
+    else:
+        channel = user_channel(user_id)
+
+    response = StreamingHttpResponse(stream_channel(channel), content_type='text/event-stream')
+    response['Cache-Control'] = 'no-cache'
+    # Stop nginx from buffering the stream
+    response['X-Accel-Buffering'] = 'no'
+    return response
+
+
+async def stream_channel(channel):
+    """Relay messages published on ``channel`` as SSE frames until the client disconnects."""
+    client = async_redis_client()
+    pubsub = client.pubsub()
+    try:
+        await pubsub.subscribe(channel)
+        yield 'retry: 5000\n\n'
+        while True:
+            message = await pubsub.get_message(ignore_subscribe_messages=True, timeout=JOB_EVENT_HEARTBEAT)
+            if message is None:
+                yield ': keep-alive\n\n'
+                continue
+            yield f"event: job\ndata: {message['data'].decode()}\n\n"
+    finally:
+        await pubsub.aclose()
+        await client.aclose()
@@ -0,0 +1,82 @@
+"""
+Idempotent job submission.
+
+Media generation and preview requests are remembered in Redis, keyed by the
+client's Idempotency-Key header or, without one, by a canonical hash of the
+request. A repeated submission within the window is answered with the Job
+the first one created instead of enqueueing (and charging for) the same work
+again.
+
+An explicit Idempotency-Key is remembered for IDEMPOTENCY_TTL. A request
+hash only coalesces double submits for DUPLICATE_SUBMISSION_TTL, since an
+identical body sent later is a deliberate "regenerate".
+"""
+
+import hashlib
+import json
+
+from .utils import redis_client
+
+IDEMPOTENCY_TTL = 10 * 60  # seconds an Idempotency-Key is remembered once its job exists
+DUPLICATE_SUBMISSION_TTL = 5  # seconds an identical submission without a key is coalesced
+IDEMPOTENCY_CLAIM_TTL = 60  # seconds a submission may stay in flight before others may retry it
+
+IDEMPOTENT_URL_NAMES = (
+    'scene-generate-image',
+    'scene-generate-audio',
+    'story-preview-pdf',
+    'story-preview-audio',
+    'story-preview-video',
+    'story-preview-voice',
+)
+
+
+def request_fingerprint(request):
+    """Canonical hash of a submission: its path and its body with keys sorted."""
+    try:
+        data = json.loads(request.body or b'{}')
+    except ValueError:
+        data = sorted(request.POST.lists())
+    canonical = json.dumps({'path': request.path_info, 'data': data}, sort_keys=True, separators=(',', ':'))
+    return hashlib.sha256(canonical.encode()).hexdigest()
+
+
+def submission_key(user_id, request, fingerprint):
+    idempotency_key = request.headers.get('Idempotency-Key')
+    if idempotency_key:
+        return f"idempotency:{user_id}:key:{hashlib.sha256(idempotency_key.encode()).hexdigest()}"
+    return f"idempotency:{user_id}:fp:{fingerprint}"
+
+
+def submission_ttl(request):
+    """How long the job of a finished submission is replayed for."""
+    return IDEMPOTENCY_TTL if request.headers.get('Idempotency-Key') else DUPLICATE_SUBMISSION_TTL
+
+
+def claim_submission(key, fingerprint):
+    """
+    Claim a submission before any work is done for it.
+
+    Returns:
+        dict: None when this request now owns the submission, otherwise the
+        stored record with the original ``fingerprint`` and its ``job_id``
+        (None while the original request is still in flight)
+    """
+    client = redis_client()
+    record = {'fingerprint': fingerprint, 'job_id': None}
+    if client.set(key, json.dumps(record), nx=True, ex=IDEMPOTENCY_CLAIM_TTL):
+        return None
+    existing = client.get(key)
+    # The claim expired between the two calls; treat this request as the owner
+    return json.loads(existing) if existing is not None else None
+
+
+def record_submission(key, fingerprint, job_id, ttl=IDEMPOTENCY_TTL):
+    """Remember the job a claimed submission created for ``ttl`` seconds."""
+    record = {'fingerprint': fingerprint, 'job_id': job_id}
+    redis_client().setex(key, ttl, json.dumps(record))
+
+
+def release_submission(key):
+    """Forget a claimed submission that did not create a job, so it can be retried."""
+    redis_client().delete(key)
@@ -0,0 +1,58 @@
+import time
+
+import boto3
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from core.utils import AWS_CLIENT_CONFIG, aws_client
+
+
+class Command(BaseCommand):
+    """
+    Compare building a boto3 client per call with the shared client registry.
+
+    Usage:
+        python manage.py benchmark_aws_clients                     # client setup only, no network
+        python manage.py benchmark_aws_clients --call              # also make one SQS request per iteration
+    """
+    help = 'Time per-call boto3 clients against the pooled clients from aws_client()'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--iterations', type=int, default=50)
+        parser.add_argument('--service', default='sqs', choices=('sqs', 's3'))
+        parser.add_argument('--call', action='store_true', help='Make one cheap API request with each client')
+
+    def handle(self, *args, **options):
+        iterations = options['iterations']
+        service = options['service']
+        call = options['call']
+
+        def per_call_client():
+            return boto3.client(
+                service,
+                aws_access_key_id=settings.AWS_ACCESS_KEY_ID,
+                aws_secret_access_key=settings.AWS_SECRET_ACCESS_KEY,
+                region_name=settings.AWS_S3_REGION_NAME,
+                config=AWS_CLIENT_CONFIG
+            )
+
+        for label, factory in (('per-call client', per_call_client), ('pooled client', lambda: aws_client(service))):
+            timings = []
+            for _ in range(iterations):
+                started = time.perf_counter()
+                client = factory()
+                if call:
+                    self.request(client, service)
+                timings.append(time.perf_counter() - started)
+            timings.sort()
+            self.stdout.write(
+                f'{label}: mean {sum(timings) / len(timings) * 1000:.2f} ms, '
+                f'median {timings[len(timings) // 2] * 1000:.2f} ms, '
+                f'max {timings[-1] * 1000:.2f} ms over {iterations} iterations'
+            )
+
+    def request(self, client, service):
+        if service == 'sqs':
+            client.get_queue_attributes(QueueUrl=settings.WHISPR_TALES_QUEUE_URL, AttributeNames=['ApproximateNumberOfMessages'])
+        else:
+            client.list_objects_v2(Bucket=settings.IMAGE_AWS_STORAGE_BUCKET_NAME, MaxKeys=1)
@@ -0,0 +1,38 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from core.outbox import enqueue_due_retries, relay_batch
+
+
+class Command(BaseCommand):
+    """
+    Re-dispatch jobs whose scheduled retry (Job.next_retry_at) is due.
+
+    Safe to run on several replicas: due jobs are claimed with SKIP LOCKED and
+    queued through the outbox, which this command also relays.
+
+    Usage:
+        python manage.py dispatch_retries              # run until stopped
+        python manage.py dispatch_retries --once       # dispatch what is due and exit
+    """
+    help = 'Dispatch jobs whose next_retry_at has passed'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=100, help='Jobs claimed per transaction')
+        parser.add_argument('--interval', type=float, default=10.0, help='Seconds to sleep when nothing is due')
+        parser.add_argument('--once', action='store_true', help='Exit once no retries are due')
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        total = 0
+        while True:
+            queued = enqueue_due_retries(batch_size)
+            if queued:
+                total += queued
+                relay_batch(batch_size)
+                continue
+            if options['once']:
+                break
+            time.sleep(options['interval'])
+        self.stdout.write(self.style.SUCCESS(f'Dispatched {total} retries'))
@@ -0,0 +1,47 @@
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.db.models import F
+from django.utils import timezone
+
+from core.models import Job
+
+
+class Command(BaseCommand):
+    """
+    Report how long jobs waited in each queue lane before a worker started them.
+
+    Usage:
+        python manage.py job_lane_stats                # jobs started in the last 24 hours
+        python manage.py job_lane_stats --hours 1
+    """
+    help = 'Show queue wait percentiles (created_at to started_at) per job queue lane'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--hours', type=float, default=24, help='Only include jobs started in this window')
+        parser.add_argument('--limit', type=int, default=10000, help='Most recent jobs sampled per lane')
+
+    def handle(self, *args, **options):
+        since = timezone.now() - timedelta(hours=options['hours'])
+        for lane, label in Job.QUEUE_LANE_CHOICES:
+            waits = sorted(
+                (wait.total_seconds() for wait in Job.objects.filter(
+                    queue_lane=lane, started_at__gte=since
+                ).order_by('-started_at').annotate(
+                    wait=F('started_at') - F('created_at')
+                ).values_list('wait', flat=True)[:options['limit']])
+            )
+            if not waits:
+                self.stdout.write(f'{label}: no jobs started')
+                continue
+            self.stdout.write(
+                f'{label}: {len(waits)} jobs, '
+                f'p50 {self.percentile(waits, 50):.1f}s, '
+                f'p95 {self.percentile(waits, 95):.1f}s, '
+                f'max {waits[-1]:.1f}s'
+            )
+
+    def percentile(self, values, percent):
+        """Nearest-rank percentile of sorted ``values``."""
+        rank = max(1, -(-len(values) * percent // 100))
+        return values[int(rank) - 1]
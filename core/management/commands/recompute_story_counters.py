@@ -0,0 +1,40 @@
+from django.core.management.base import BaseCommand
+
+from core.models import Story
+
+
+class Command(BaseCommand):
+    """
+    Recompute the denormalized scene/media readiness counters on Story.
+
+    Usage:
+        python manage.py recompute_story_counters            # every story
+        python manage.py recompute_story_counters 12 34      # specific stories
+    """
+    help = 'Recompute active scene and media readiness counters for stories'
+
+    def add_arguments(self, parser):
+        parser.add_argument('story_ids', nargs='*', type=int, help='Stories to repair (default: all)')
+        parser.add_argument('--batch-size', type=int, default=1000, help='Stories updated per statement')
+
+    def handle(self, *args, **options):
+        story_ids = options['story_ids']
+        batch_size = options['batch_size']
+
+        if story_ids:
+            updated = Story.objects.filter(pk__in=story_ids).refresh_counters()
+            self.stdout.write(self.style.SUCCESS(f'Recomputed counters for {updated} stories'))
+            return
+
+        # Walk the table in primary key ranges so each UPDATE stays short
+        updated = 0
+        last_id = 0
+        while True:
+            batch = list(
+                Story.objects.filter(pk__gt=last_id).order_by('pk').values_list('pk', flat=True)[:batch_size]
+            )
+            if not batch:
+                break
+            updated += Story.objects.filter(pk__in=batch).refresh_counters()
+            last_id = batch[-1]
+        self.stdout.write(self.style.SUCCESS(f'Recomputed counters for {updated} stories'))
@@ -0,0 +1,72 @@
+import time
+from datetime import timedelta
+
+from botocore.exceptions import ClientError
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from core.models import Revision
+from core.previews import invalidate_preview_status, preview_object_key
+from core.utils import aws_client
+
+
+class Command(BaseCommand):
+    """
+    Confirm pending preview revisions against S3.
+
+    Workers normally report finished previews through the job completion
+    endpoint; this catches revisions whose report never arrived. Pending
+    revisions whose file exists are marked complete, and those still missing
+    after --fail-after seconds are marked failed.
+
+    Usage:
+        python manage.py reconcile_previews                 # one pass
+        python manage.py reconcile_previews --interval 30   # keep reconciling
+    """
+    help = 'Mark pending preview revisions complete or failed based on S3'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--grace', type=int, default=60, help='Seconds before a pending revision is checked')
+        parser.add_argument('--fail-after', type=int, default=60 * 60, help='Seconds before a missing preview is failed')
+        parser.add_argument('--batch-size', type=int, default=200)
+        parser.add_argument('--interval', type=float, default=0, help='Repeat every this many seconds (0 runs once)')
+
+    def handle(self, *args, **options):
+        while True:
+            completed, failed = self.reconcile(options)
+            self.stdout.write(f'Marked {completed} previews complete and {failed} failed')
+            if not options['interval']:
+                break
+            time.sleep(options['interval'])
+
+    def reconcile(self, options):
+        now = timezone.now()
+        s3_client = aws_client('s3')
+        revisions = list(Revision.objects.filter(
+            status='pending',
+            is_active=True,
+            deleted_at=None,
+            created_at__lte=now - timedelta(seconds=options['grace'])
+        ).order_by('created_at', 'id')[:options['batch_size']])
+
+        changed = []
+        for revision in revisions:
+            try:
+                s3_client.head_object(Bucket=settings.PDF_AWS_STORAGE_BUCKET_NAME, Key=preview_object_key(revision))
+                revision.status = 'complete'
+                revision.completed_at = now
+            except ClientError as e:
+                if e.response.get('Error', {}).get('Code') not in ('404', 'NoSuchKey', 'NotFound'):
+                    self.stderr.write(f'Error checking revision {revision.id}: {str(e)}')
+                    continue
+                if revision.created_at > now - timedelta(seconds=options['fail_after']):
+                    continue
+                revision.status = 'failed'
+            changed.append(revision)
+
+        Revision.objects.bulk_update(changed, ['status', 'completed_at'])
+        for story_id, name in {(revision.story_id, revision.format) for revision in changed}:
+            invalidate_preview_status(story_id, name)
+        completed = sum(1 for revision in changed if revision.status == 'complete')
+        return completed, len(changed) - completed
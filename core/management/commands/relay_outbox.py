@@ -0,0 +1,35 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from core.outbox import relay_batch
+
+
+class Command(BaseCommand):
+    """
+    Send pending outbox messages to the job queue.
+
+    Usage:
+        python manage.py relay_outbox              # run until stopped
+        python manage.py relay_outbox --once       # drain what is pending and exit
+    """
+    help = 'Relay pending job messages from the outbox to the job queue'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=100, help='Messages claimed per transaction')
+        parser.add_argument('--interval', type=float, default=1.0, help='Seconds to sleep when the outbox is empty')
+        parser.add_argument('--once', action='store_true', help='Exit once no messages are pending')
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        total_sent = 0
+        while True:
+            sent, failed = relay_batch(batch_size)
+            total_sent += sent
+            if failed:
+                self.stderr.write(f'{failed} messages failed to send and will be retried')
+            if sent + failed == 0 or (failed and not sent):
+                if options['once']:
+                    break
+                time.sleep(options['interval'])
+        self.stdout.write(self.style.SUCCESS(f'Relayed {total_sent} messages'))
@@ -1,13 +1,23 @@
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction, sync_to_async
 from django.db import transaction
 from rest_framework.response import Response
 from rest_framework import status
-from .models import Credits, CreditTransaction, Scene
+from .models import Credits, CreditTransaction, Job, Scene, Story
 from rest_framework_simplejwt.tokens import AccessToken
 from django.contrib.auth import get_user_model
 from django.conf import settings
 from jwt import decode as jwt_decode
 from jwt.exceptions import InvalidTokenError
 from .utils import *
+from .credits import invalidate_credit_balance
+from .audio import plan_story_audio
+from .idempotency import (
+    IDEMPOTENT_URL_NAMES, claim_submission, record_submission, release_submission,
+    request_fingerprint, submission_key, submission_ttl
+)
+from .serializers import JobSerializer
+from django.urls import Resolver404, resolve
+import json
 import math
 import redis
 import os
@@ -21,22 +31,191 @@ redis_client = redis.Redis(
     password=os.getenv('REDISPASSWORD')
 )
 
+MEDIA_GENERATION_ENDPOINTS = ['generate-image', 'generate-audio', 'generate-bulk-image', 'generate-bulk-audio']
+
+def render_json(data, status_code, **headers):
+    """Render a DRF Response from middleware, outside of any view."""
+    response = Response(data, status=status_code, headers=headers or None)
+    response.accepted_renderer = JSONRenderer()
+    response.accepted_media_type = "application/json"
+    response.renderer_context = {}
+    response.render()
+    return response
+
+class IdempotentSubmissionMiddleware:
+    """
+    Coalesce repeated media generation and preview submissions.
+
+    Runs before CreditDeductionMiddleware so a repeated submission is answered
+    with the Job the original request created, without a second debit, lock
+    or queue message. See core.idempotency.
+
+    Async capable, so parked ASGI requests (long-polls, the events stream)
+    pass through without holding a thread; only submissions run the Redis and
+    ORM work, in a thread.
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(self.get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        submission = self.submission(request)
+        if submission is None:
+            return self.get_response(request)
+
+        key, fingerprint = submission
+        try:
+            existing = claim_submission(key, fingerprint)
+        except Exception as e:
+            print(f"Error claiming idempotent submission: {str(e)}")
+            return self.get_response(request)
+        if existing is not None:
+            response = self.replay(existing, fingerprint)
+            if response is not None:
+                return response
+
+        response = self.get_response(request)
+        self.record(request, key, fingerprint, response)
+        return response
+
+    async def __acall__(self, request):
+        submission = self.submission(request)
+        if submission is None:
+            return await self.get_response(request)
+
+        key, fingerprint = submission
+        try:
+            existing = await sync_to_async(claim_submission)(key, fingerprint)
+        except Exception as e:
+            print(f"Error claiming idempotent submission: {str(e)}")
+            return await self.get_response(request)
+        if existing is not None:
+            response = await sync_to_async(self.replay)(existing, fingerprint)
+            if response is not None:
+                return response
+
+        response = await self.get_response(request)
+        await sync_to_async(self.record)(request, key, fingerprint, response)
+        return response
+
+    def submission(self, request):
+        """
+        Identify an idempotent submission.
+
+        Returns:
+            tuple: (key, fingerprint) of the submission, or None for any other request
+        """
+        if request.method != 'POST':
+            return None
+        try:
+            url_name = resolve(request.path_info).url_name
+        except Resolver404:
+            url_name = None
+        auth_header = request.META.get('HTTP_AUTHORIZATION', '')
+        if url_name not in IDEMPOTENT_URL_NAMES or not auth_header.startswith('Bearer '):
+            return None
+
+        try:
+            user_id = jwt_decode(auth_header.split(' ')[1], settings.SECRET_KEY, algorithms=['HS256']).get('user_id')
+        except InvalidTokenError:
+            # Let authentication reject the request as usual
+            return None
+
+        fingerprint = request_fingerprint(request)
+        return submission_key(user_id, request, fingerprint), fingerprint
+
+    def replay(self, existing, fingerprint):
+        """
+        Answer a submission that repeats a claimed one.
+
+        Returns:
+            Response: The rendered answer, or None to process the request anyway
+        """
+        if existing['fingerprint'] != fingerprint:
+            return render_json(
+                {'error': 'Idempotency-Key was already used for a different request'},
+                status.HTTP_422_UNPROCESSABLE_ENTITY
+            )
+        if existing['job_id'] is None:
+            return render_json(
+                {'error': 'An identical request is already being processed. Please try again shortly.', 'error_code': 'E002'},
+                status.HTTP_409_CONFLICT
+            )
+        job = Job.objects.filter(pk=existing['job_id']).first()
+        if job is not None:
+            return render_json(JobSerializer(job).data, status.HTTP_200_OK, **{'Idempotent-Replayed': 'true'})
+        return None
+
+    def record(self, request, key, fingerprint, response):
+        """Record the Job a submission created, or release the claim when it created none."""
+        data = getattr(response, 'data', None)
+        try:
+            if status.is_success(response.status_code) and isinstance(data, dict) and data.get('id'):
+                record_submission(key, fingerprint, data['id'], submission_ttl(request))
+            else:
+                release_submission(key)
+        except Exception as e:
+            print(f"Error recording idempotent submission: {str(e)}")
+
+def request_voice_id(request):
+    """The voice_id of a JSON or form encoded request body, read the way the views' request.data does."""
+    if request.content_type == 'application/json':
+        try:
+            return json.loads(request.body or b'{}').get('voice_id')
+        except (ValueError, AttributeError):
+            return None
+    return request.POST.get('voice_id')
+
+def is_media_generation(request):
+    """Whether a request is a media generation submission that costs credits."""
+    return request.method == 'POST' and any(endpoint in request.path_info for endpoint in MEDIA_GENERATION_ENDPOINTS)
+
 class CreditDeductionMiddleware:
     """
     Middleware to handle credit deduction for story saving and media generation.
     Deducts 1 credit when a story is saved.
     Deducts credits for image/audio generation based on CREDIT_COSTS.
+    Other requests pass straight through, without a thread under ASGI.
     """
-    
-    
+    sync_capable = True
+    async_capable = True
+
     def __init__(self, get_response):
         self.get_response = get_response
+        if iscoroutinefunction(self.get_response):
+            markcoroutinefunction(self)
 
     def __call__(self, request):
-        # Check if this is a story save endpoint
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        if is_media_generation(request):
+            response = self.deduct_credits(request)
+            if response is not None:
+                return response
+        return self.get_response(request)
 
+    async def __acall__(self, request):
+        if is_media_generation(request):
+            response = await sync_to_async(self.deduct_credits)(request)
+            if response is not None:
+                return response
+        return await self.get_response(request)
+
+    def deduct_credits(self, request):
+        """
+        Deduct the credits of a media generation request and lock its scene.
+
+        Returns:
+            Response: The rendered error that rejects the request, or None to process it
+        """
         # Handle media generation endpoints (image/audio)
-        if request.method == 'POST' and any(endpoint in request.path_info for endpoint in ['generate-image', 'generate-audio', 'generate-bulk-image', 'generate-bulk-audio']):
+        if is_media_generation(request):
             try:
                 # Get the JWT token from the Authorization header
                 auth_header = request.META.get('HTTP_AUTHORIZATION', '')
@@ -65,7 +244,7 @@ class CreditDeductionMiddleware:
                         media_type = 'audio'
                     
                     if not media_type:
-                        return self.get_response(request)
+                        return None
 
                     # Calculate credit cost
                     credit_cost = 0
@@ -80,12 +259,18 @@ class CreditDeductionMiddleware:
                                 break
                         
                         if story_id:
-                            # Get all scenes for the story
-                            scenes = Scene.objects.filter(story_id=story_id, is_active=True)
                             if media_type == 'image':
-                                credit_cost = sum([math.ceil(CREDIT_COSTS['image']) for _ in scenes])
+                                # One image per active scene, read from the story's counter
+                                scene_count = Story.objects.filter(pk=story_id).values_list('active_scene_count', flat=True).first() or 0
+                                credit_cost = math.ceil(CREDIT_COSTS['image']) * scene_count
                             elif media_type == 'audio':
-                                credit_cost = sum([math.ceil(CREDIT_COSTS['audio'] * len(scene.content)) for scene in scenes])
+                                # Only scenes whose text, voice or language changed are synthesized
+                                voice_id = request_voice_id(request)
+                                language = get_user_model().objects.filter(pk=user_id).values_list('language', flat=True).first()
+                                plan = plan_story_audio(story_id, voice_id, language)
+                                credit_cost = sum(scene['credit_cost'] for scene in plan)
+                                # The view queues exactly the plan that was charged for
+                                request.audio_plan = {'voice_id': voice_id, 'language': language, 'scenes': plan}
                     else:
                         # For single scene generation
                         # Extract scene_id from path
@@ -125,11 +310,13 @@ class CreditDeductionMiddleware:
                             # Deduct credits
                             user_credits.credits_remaining -= credit_cost
                             user_credits.save()
+                            invalidate_credit_balance(user_id)
 
                             # Create credit transaction record
                             if 'bulk' in request.path_info:
-                                # For bulk generation, create one transaction for the total cost
-                                CreditTransaction.objects.create(
+                                # For bulk generation, create one transaction for the total cost;
+                                # the view links the jobs it creates to it
+                                request.credit_transaction = CreditTransaction.objects.create(
                                     user_id=user_id,
                                     credits_used=credit_cost,
                                     transaction_type='debit'
@@ -165,7 +352,7 @@ class CreditDeductionMiddleware:
         # For media generation endpoints, only handle Redis locking (no credit deduction)
         if request.method == 'POST':
             path = request.path_info
-            if any(endpoint in path for endpoint in ['generate-image', 'generate-audio', 'generate-bulk-image', 'generate-bulk-audio']):
+            if any(endpoint in path for endpoint in MEDIA_GENERATION_ENDPOINTS):
                 # Get the media type and scene ID for locking
                 media_type = 'image' if 'image' in path else 'audio'
                 scene_id = request.path.split('/')[-3]
@@ -188,4 +375,4 @@ class CreditDeductionMiddleware:
                 # Set lock with 5 minute expiry
                 redis_client.setex(lock_key, 300, 'locked')
 
-        return self.get_response(request)
\ No newline at end of file
+        return None
\ No newline at end of file
@@ -0,0 +1,21 @@
+# Generated by Django 5.0.2 on 2026-10-16 23:33
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0026_remove_story_is_private_alter_story_is_public'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='story',
+            index=models.Index(condition=models.Q(('is_active', True)), fields=['author', '-created_at', '-id'], name='story_author_created_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='story',
+            index=models.Index(condition=models.Q(('is_active', True)), fields=['is_public', '-created_at', '-id'], name='story_public_created_idx'),
+        ),
+    ]
@@ -0,0 +1,60 @@
+# Generated by Django 5.0.2 on 2026-10-16 23:35
+
+import django.contrib.postgres.indexes
+import django.contrib.postgres.search
+import django.db.models.functions.text
+from django.contrib.postgres.operations import TrigramExtension
+from django.contrib.postgres.search import SearchVector
+from django.db import migrations
+
+
+def populate_search_vector(apps, schema_editor):
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    Story = apps.get_model('core', 'Story')
+    Story.objects.update(
+        search_vector=SearchVector('title', weight='A', config='simple') +
+        SearchVector('content', weight='B', config='simple')
+    )
+
+
+class AddTrigramIndex(migrations.AddIndex):
+    """AddIndex that, like TrigramExtension, is a no-op off PostgreSQL."""
+
+    def database_forwards(self, app_label, schema_editor, from_state, to_state):
+        if schema_editor.connection.vendor == 'postgresql':
+            super().database_forwards(app_label, schema_editor, from_state, to_state)
+
+    def database_backwards(self, app_label, schema_editor, from_state, to_state):
+        if schema_editor.connection.vendor == 'postgresql':
+            super().database_backwards(app_label, schema_editor, from_state, to_state)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('auth', '0012_alter_user_first_name_max_length'),
+        ('core', '0027_story_story_author_created_idx_and_more'),
+    ]
+
+    operations = [
+        TrigramExtension(),
+        migrations.AddField(
+            model_name='story',
+            name='search_vector',
+            field=django.contrib.postgres.search.SearchVectorField(editable=False, null=True),
+        ),
+        migrations.RunPython(populate_search_vector, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='story',
+            index=django.contrib.postgres.indexes.GinIndex(fields=['search_vector'], name='story_search_vector_idx'),
+        ),
+        AddTrigramIndex(
+            model_name='story',
+            index=django.contrib.postgres.indexes.GinIndex(django.contrib.postgres.indexes.OpClass(django.db.models.functions.text.Upper('title'), name='gin_trgm_ops'), name='story_title_trgm_idx'),
+        ),
+        AddTrigramIndex(
+            model_name='user',
+            index=django.contrib.postgres.indexes.GinIndex(django.contrib.postgres.indexes.OpClass(django.db.models.functions.text.Upper('username'), name='gin_trgm_ops'), name='user_username_trgm_idx'),
+        ),
+    ]
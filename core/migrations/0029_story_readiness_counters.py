@@ -0,0 +1,62 @@
+# Generated by Django 5.0.2 on 2026-10-16 23:40
+
+from django.db import migrations, models
+from django.db.models import Count, Exists, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+
+
+def populate_counters(apps, schema_editor):
+    Story = apps.get_model('core', 'Story')
+    Scene = apps.get_model('core', 'Scene')
+    Media = apps.get_model('core', 'Media')
+    active_scenes = Scene.objects.filter(story=OuterRef('pk'), is_active=True)
+
+    def count(scenes):
+        return Coalesce(
+            Subquery(scenes.order_by().values('story').annotate(total=Count('id')).values('total')),
+            0
+        )
+
+    def ready(media_type):
+        return active_scenes.filter(
+            Exists(Media.objects.filter(scene=OuterRef('pk'), media_type=media_type, is_active=True))
+        )
+
+    Story.objects.update(
+        active_scene_count=count(active_scenes),
+        image_ready_scene_count=count(ready('image')),
+        audio_ready_scene_count=count(ready('audio')),
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0028_story_search_vector'),
+    ]
+
+    operations = [
+        # The trigram indexes 0028 created stay in the database, but leave the
+        # model state: off PostgreSQL, adding a field rebuilds the table and
+        # would replay these PostgreSQL only expression indexes.
+        migrations.SeparateDatabaseAndState(state_operations=[
+            migrations.RemoveIndex(model_name='story', name='story_title_trgm_idx'),
+            migrations.RemoveIndex(model_name='user', name='user_username_trgm_idx'),
+        ]),
+        migrations.AddField(
+            model_name='story',
+            name='active_scene_count',
+            field=models.PositiveIntegerField(default=0, editable=False, verbose_name='active scene count'),
+        ),
+        migrations.AddField(
+            model_name='story',
+            name='audio_ready_scene_count',
+            field=models.PositiveIntegerField(default=0, editable=False, help_text='Active scenes that have an active audio', verbose_name='audio ready scene count'),
+        ),
+        migrations.AddField(
+            model_name='story',
+            name='image_ready_scene_count',
+            field=models.PositiveIntegerField(default=0, editable=False, help_text='Active scenes that have an active image', verbose_name='image ready scene count'),
+        ),
+        migrations.RunPython(populate_counters, migrations.RunPython.noop),
+    ]
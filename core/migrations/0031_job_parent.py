@@ -0,0 +1,24 @@
+# Generated by Django 5.0.2 on 2026-10-16 23:48
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0030_outboxmessage'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='job',
+            name='parent',
+            field=models.ForeignKey(blank=True, help_text='Bulk job this per-scene job belongs to', null=True, on_delete=django.db.models.deletion.CASCADE, related_name='children', to='core.job'),
+        ),
+        migrations.AlterField(
+            model_name='job',
+            name='job_type',
+            field=models.CharField(choices=[('generate_media', 'Generate Media'), ('generate_pdf_preview', 'Generate PDF Preview'), ('generate_audio_preview', 'Generate Audio Preview'), ('generate_video_preview', 'Generate Video Preview'), ('generate_entire_audio', 'Generate Entire Audio'), ('generate_bulk_media', 'Generate Bulk Media')], max_length=50),
+        ),
+    ]
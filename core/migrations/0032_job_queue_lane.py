@@ -0,0 +1,39 @@
+# Generated by Django 5.0.2 on 2026-10-16 23:49
+
+from django.db import migrations, models
+from django.db.models import Q
+
+
+def populate_queue_lanes(apps, schema_editor):
+    Job = apps.get_model('core', 'Job')
+    batch = Q(parent__isnull=False) | Q(job_type__in=['generate_entire_audio', 'generate_bulk_media'])
+    Job.objects.filter(batch).update(queue_lane='batch')
+    Job.objects.filter(~batch, job_type__in=[
+        'generate_pdf_preview', 'generate_audio_preview', 'generate_video_preview'
+    ]).update(queue_lane='preview')
+    Job.objects.filter(queue_lane='').update(queue_lane='interactive')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0031_job_parent'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='job',
+            name='queue_lane',
+            field=models.CharField(blank=True, choices=[('interactive', 'Interactive'), ('preview', 'Preview'), ('batch', 'Batch')], help_text='Queue lane the job is dispatched on', max_length=20),
+        ),
+        migrations.AddField(
+            model_name='outboxmessage',
+            name='queue_lane',
+            field=models.CharField(choices=[('interactive', 'Interactive'), ('preview', 'Preview'), ('batch', 'Batch')], default='interactive', max_length=20),
+        ),
+        migrations.AddIndex(
+            model_name='job',
+            index=models.Index(fields=['queue_lane', 'created_at'], name='core_job_queue_l_0bb40b_idx'),
+        ),
+        migrations.RunPython(populate_queue_lanes, migrations.RunPython.noop),
+    ]
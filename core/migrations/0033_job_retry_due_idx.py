@@ -0,0 +1,17 @@
+# Generated by Django 5.0.2 on 2026-10-16 23:51
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0032_job_queue_lane'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='job',
+            index=models.Index(condition=models.Q(('next_retry_at__isnull', False)), fields=['status', 'next_retry_at'], name='job_retry_due_idx'),
+        ),
+    ]
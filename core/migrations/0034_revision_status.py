@@ -0,0 +1,37 @@
+# Generated by Django 5.0.2 on 2026-10-16 23:55
+
+from datetime import timedelta
+
+from django.db import migrations, models
+from django.db.models import F
+from django.utils import timezone
+
+
+def populate_status(apps, schema_editor):
+    Revision = apps.get_model('core', 'Revision')
+    # Older revisions have long been rendered; recent ones stay pending for
+    # reconcile_previews to confirm against S3
+    Revision.objects.filter(
+        url__isnull=False, created_at__lt=timezone.now() - timedelta(hours=1)
+    ).update(status='complete', completed_at=F('created_at'))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0033_job_retry_due_idx'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='revision',
+            name='completed_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='revision',
+            name='status',
+            field=models.CharField(choices=[('pending', 'Pending'), ('complete', 'Complete'), ('failed', 'Failed')], default='pending', help_text='Whether the preview file has been rendered', max_length=20),
+        ),
+        migrations.RunPython(populate_status, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,29 @@
+# Generated by Django 5.0.2 on 2026-10-16 23:59
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0034_revision_status'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='revision',
+            index=models.Index(condition=models.Q(('deleted_at__isnull', True), ('is_active', True)), fields=['story', 'format', '-created_at'], name='revision_active_format_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='revision',
+            index=models.Index(condition=models.Q(('is_current', True), ('url__isnull', False)), fields=['story', '-created_at'], name='revision_current_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='revision',
+            index=models.Index(condition=models.Q(('deleted_at__isnull', True)), fields=['story', '-created_at', '-id'], name='revision_live_created_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='revision',
+            index=models.Index(fields=['story', 'format', '-created_at'], name='revision_history_idx'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.0.2 on 2026-10-17 00:03
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0035_revision_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='media',
+            name='fingerprint',
+            field=models.CharField(blank=True, help_text='Fingerprint of the scene text, voice and language audio was synthesized from', max_length=64, null=True, verbose_name='fingerprint'),
+        ),
+    ]
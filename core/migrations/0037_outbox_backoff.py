@@ -0,0 +1,40 @@
+# Generated by Django 5.0.2 on 2026-10-17 00:17
+
+import django.utils.timezone
+from django.db import migrations, models
+from django.db.models import F
+
+
+def dead_letter_exhausted(apps, schema_editor):
+    # Before this migration messages out of attempts simply stayed pending
+    OutboxMessage = apps.get_model('core', 'OutboxMessage')
+    OutboxMessage.objects.filter(sent_at__isnull=True, attempts__gte=5).update(dead_lettered_at=F('created_at'))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0036_media_fingerprint'),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name='outboxmessage',
+            name='outbox_pending_idx',
+        ),
+        migrations.AddField(
+            model_name='outboxmessage',
+            name='dead_lettered_at',
+            field=models.DateTimeField(blank=True, help_text='When the relay gave up on sending', null=True),
+        ),
+        migrations.AddField(
+            model_name='outboxmessage',
+            name='next_attempt_at',
+            field=models.DateTimeField(default=django.utils.timezone.now, help_text='When the relay may next try to send'),
+        ),
+        migrations.RunPython(dead_letter_exhausted, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='outboxmessage',
+            index=models.Index(condition=models.Q(('dead_lettered_at__isnull', True), ('sent_at__isnull', True)), fields=['next_attempt_at', 'id'], name='outbox_pending_idx'),
+        ),
+    ]
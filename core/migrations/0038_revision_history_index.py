@@ -0,0 +1,21 @@
+# Generated by Django 5.0.2 on 2026-10-17 00:52
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0037_outbox_backoff'),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name='revision',
+            name='revision_history_idx',
+        ),
+        migrations.AddIndex(
+            model_name='revision',
+            index=models.Index(fields=['story', '-created_at'], name='revision_history_idx'),
+        ),
+    ]
@@ -1,4 +1,8 @@
-from django.db import models
+from django.db import models, connection, transaction
+from django.contrib.postgres.indexes import GinIndex
+from django.contrib.postgres.search import SearchQuery, SearchRank, SearchVector, SearchVectorField
+from django.db.models import Count, Exists, F, OuterRef, Prefetch, Subquery
+from django.db.models.functions import Coalesce
 from django.contrib.auth.models import AbstractUser
 from django.utils.translation import gettext_lazy as _
 from django.conf import settings
@@ -52,6 +56,132 @@ class User(AbstractUser):
     #         self.referral_code = str(uuid.uuid4())[:8].upper()
     #     super().save(*args, **kwargs)
 
+# Stories are written in many languages, so search uses the language
+# agnostic 'simple' configuration rather than an English stemmer.
+STORY_SEARCH_CONFIG = 'simple'
+STORY_SEARCH_VECTOR = (
+    SearchVector('title', weight='A', config=STORY_SEARCH_CONFIG) +
+    SearchVector('content', weight='B', config=STORY_SEARCH_CONFIG)
+)
+
+class StoryQuerySet(models.QuerySet):
+    """QuerySet helpers for reading stories"""
+
+    def with_related(self, include=None, fields=None):
+        """
+        Load everything StorySerializer reads in a fixed number of queries:
+        the author (joined), the author's active credits, active scenes and
+        the active media of those scenes.
+
+        ``include`` limits the relations loaded to a subset of
+        ('author', 'scenes', 'media'). When ``fields`` is given without
+        'content', the story body is deferred.
+        """
+        if include is None:
+            include = ('author', 'scenes', 'media')
+        queryset = self.defer('search_vector')
+        if fields is not None and 'content' not in fields:
+            queryset = queryset.defer('content')
+        if 'author' in include:
+            queryset = queryset.select_related('author').prefetch_related(
+                Prefetch(
+                    'author__credits',
+                    queryset=Credits.objects.filter(is_active=True),
+                    to_attr='active_credits'
+                )
+            )
+        if 'scenes' in include:
+            scenes = Scene.objects.filter(is_active=True)
+            if 'media' in include:
+                scenes = scenes.prefetch_related(
+                    Prefetch(
+                        'media',
+                        queryset=Media.objects.filter(is_active=True),
+                        to_attr='active_media'
+                    )
+                )
+            queryset = queryset.prefetch_related(
+                Prefetch('scenes', queryset=scenes, to_attr='active_scenes')
+            )
+        return queryset
+
+    def search(self, term):
+        """
+        Filter to stories matching ``term`` and order them by relevance.
+
+        On PostgreSQL the maintained ``search_vector`` (title weighted above
+        content) is matched with a web-search style query and ranked; title
+        and author name substrings are matched through trigram indexes.
+        Other databases fall back to plain substring matching.
+        """
+        if connection.vendor != 'postgresql':
+            return self.filter(
+                models.Q(title__icontains=term) |
+                models.Q(content__icontains=term) |
+                models.Q(author__username__icontains=term)
+            ).order_by('-created_at', '-id')
+
+        query = SearchQuery(term, search_type='websearch', config=STORY_SEARCH_CONFIG)
+        return self.filter(
+            models.Q(search_vector=query) |
+            models.Q(title__icontains=term) |
+            models.Q(author__in=User.objects.filter(username__icontains=term).values('id'))
+        ).annotate(
+            rank=SearchRank(F('search_vector'), query)
+        ).order_by('-rank', '-created_at', '-id')
+
+    def summary(self):
+        """
+        Load only the columns StorySummarySerializer renders, with the first
+        active scene image annotated as ``cover_image``.
+        """
+        cover_image = Media.objects.filter(
+            story=OuterRef('pk'),
+            media_type='image',
+            is_active=True,
+            scene__is_active=True
+        ).order_by('scene__order', '-created_at').values('url')[:1]
+        return self.only(
+            'id', 'title', 'word_count', 'created_at', 'updated_at', 'is_public', 'language',
+            'active_scene_count', 'image_ready_scene_count', 'audio_ready_scene_count'
+        ).annotate(cover_image=Subquery(cover_image))
+
+    def refresh_counters(self):
+        """
+        Recompute the denormalized scene and media readiness counters of the
+        stories in this queryset with a single UPDATE.
+
+        Counters are recomputed from the rows rather than incremented, so
+        missed updates can't make them drift. The stories are row locked
+        first: under READ COMMITTED a second writer's UPDATE then starts
+        after the first writer commits, and its snapshot counts both
+        writers' rows. FOR NO KEY UPDATE doesn't conflict with the key share
+        locks that scene and media inserts take on the story.
+        """
+        with transaction.atomic(savepoint=False):
+            list(self.select_for_update(no_key=True).order_by('pk').values_list('pk', flat=True))
+            return self._update_counters()
+
+    def _update_counters(self):
+        active_scenes = Scene.objects.filter(story=OuterRef('pk'), is_active=True)
+
+        def count(scenes):
+            return Coalesce(
+                Subquery(scenes.order_by().values('story').annotate(total=Count('id')).values('total')),
+                0
+            )
+
+        def ready(media_type):
+            return active_scenes.filter(
+                Exists(Media.objects.filter(scene=OuterRef('pk'), media_type=media_type, is_active=True))
+            )
+
+        return self.update(
+            active_scene_count=count(active_scenes),
+            image_ready_scene_count=count(ready('image')),
+            audio_ready_scene_count=count(ready('audio')),
+        )
+
 class Story(models.Model):
     """Story model to store user's stories"""
     title = models.CharField(_('title'), max_length=200)
@@ -76,10 +206,47 @@ class Story(models.Model):
         null=True,
         default='en-US',
         help_text='Language of the story')
+    search_vector = SearchVectorField(null=True, editable=False)
+
+    # Denormalized readiness counters, kept current by StoryQuerySet.refresh_counters()
+    active_scene_count = models.PositiveIntegerField(_('active scene count'), default=0, editable=False)
+    image_ready_scene_count = models.PositiveIntegerField(
+        _('image ready scene count'),
+        default=0,
+        editable=False,
+        help_text=_('Active scenes that have an active image')
+    )
+    audio_ready_scene_count = models.PositiveIntegerField(
+        _('audio ready scene count'),
+        default=0,
+        editable=False,
+        help_text=_('Active scenes that have an active audio')
+    )
+
+    objects = StoryQuerySet.as_manager()
+
     class Meta:
         verbose_name = _('story')
         verbose_name_plural = _('stories')
         ordering = ['-created_at']
+        indexes = [
+            # Keyset pagination of a user's stories and of the shared feeds
+            models.Index(
+                fields=['author', '-created_at', '-id'],
+                name='story_author_created_idx',
+                condition=models.Q(is_active=True)
+            ),
+            models.Index(
+                fields=['is_public', '-created_at', '-id'],
+                name='story_public_created_idx',
+                condition=models.Q(is_active=True)
+            ),
+            # Ranked full-text search. Trigram indexes on UPPER(title) and
+            # UPPER(user.username) for substring search are created in
+            # migration 0028 and left out of the model state (0029) as they
+            # are PostgreSQL only.
+            GinIndex(fields=['search_vector'], name='story_search_vector_idx'),
+        ]
 
     def __str__(self):
         return self.title
@@ -88,6 +255,23 @@ class Story(models.Model):
         # Calculate word count before saving
         self.word_count = len(self.content.split())
         super().save(*args, **kwargs)
+        update_fields = kwargs.get('update_fields')
+        if update_fields is None or {'title', 'content'} & set(update_fields):
+            self.update_search_vector()
+
+    def is_media_ready(self, media_type):
+        """Whether every active scene has active media of ``media_type``."""
+        ready = {
+            'image': self.image_ready_scene_count,
+            'audio': self.audio_ready_scene_count,
+        }.get(media_type, 0)
+        return ready == self.active_scene_count
+
+    def update_search_vector(self):
+        """Recompute the full-text search document, weighting the title above the content."""
+        if connection.vendor != 'postgresql':
+            return
+        Story.objects.filter(pk=self.pk).update(search_vector=STORY_SEARCH_VECTOR)
 
 class Scene(models.Model):
     """Scene model for story segments"""
@@ -157,6 +341,13 @@ class Media(models.Model):
         null=True,
         blank=True
     )
+    fingerprint = models.CharField(
+        _('fingerprint'),
+        max_length=64,
+        null=True,
+        blank=True,
+        help_text=_('Fingerprint of the scene text, voice and language audio was synthesized from')
+    )
     created_at = models.DateTimeField(_('created at'), auto_now_add=True)
     is_active = models.BooleanField(_('is active'), default=True)
     class Meta:
@@ -173,6 +364,11 @@ class Revision(models.Model):
         ('mp4', 'MP4'),
         ('audio', 'Audio'),
     ]
+    STATUS_CHOICES = [
+        ('pending', 'Pending'),
+        ('complete', 'Complete'),
+        ('failed', 'Failed'),
+    ]
     
     story = models.ForeignKey(Story, on_delete=models.CASCADE, related_name='revisions')
     format = models.CharField(max_length=10, choices=FORMAT_CHOICES)
@@ -183,9 +379,33 @@ class Revision(models.Model):
     is_current = models.BooleanField(default=True)
     is_active = models.BooleanField(default=True)
     metadata = models.JSONField(default=dict, null=True, blank=True)
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default='pending', help_text="Whether the preview file has been rendered")
+    completed_at = models.DateTimeField(null=True, blank=True)
 
     class Meta:
         ordering = ['-created_at']
+        indexes = [
+            # Latest live revision of a format: preview status and preview generation
+            models.Index(
+                fields=['story', 'format', '-created_at'],
+                name='revision_active_format_idx',
+                condition=models.Q(is_active=True, deleted_at__isnull=True)
+            ),
+            # Current revisions and the story version summary
+            models.Index(
+                fields=['story', '-created_at'],
+                name='revision_current_idx',
+                condition=models.Q(is_current=True, url__isnull=False)
+            ),
+            # Generated content pages and public story revisions
+            models.Index(
+                fields=['story', '-created_at', '-id'],
+                name='revision_live_created_idx',
+                condition=models.Q(deleted_at__isnull=True)
+            ),
+            # Revision history; the format filter, when given, is checked on the index rows
+            models.Index(fields=['story', '-created_at'], name='revision_history_idx'),
+        ]
 
     def __str__(self):
         return f"{self.story.title} - {self.format} ({self.created_at})"
@@ -297,18 +517,40 @@ class Job(models.Model):
         ('generate_pdf_preview', 'Generate PDF Preview'),
         ('generate_audio_preview', 'Generate Audio Preview'),
         ('generate_video_preview', 'Generate Video Preview'),
-        ('generate_entire_audio', 'Generate Entire Audio')
+        ('generate_entire_audio', 'Generate Entire Audio'),
+        ('generate_bulk_media', 'Generate Bulk Media')
+    ]
+
+    # Queue lanes, consumed with the weights in settings.JOB_QUEUE_LANES
+    LANE_INTERACTIVE = 'interactive'
+    LANE_PREVIEW = 'preview'
+    LANE_BATCH = 'batch'
+    QUEUE_LANE_CHOICES = [
+        (LANE_INTERACTIVE, 'Interactive'),
+        (LANE_PREVIEW, 'Preview'),
+        (LANE_BATCH, 'Batch')
     ]
+    PREVIEW_JOB_TYPES = ('generate_pdf_preview', 'generate_audio_preview', 'generate_video_preview')
+    BATCH_JOB_TYPES = ('generate_entire_audio', 'generate_bulk_media')
 
     # Job identification
     message_id = models.CharField(max_length=100, unique=True, null=True, blank=True, help_text="AWS SQS Message ID")
     job_type = models.CharField(max_length=50, choices=JOB_TYPE_CHOICES)
     status = models.CharField(max_length=20, choices=JOB_STATUS_CHOICES, default='pending')
+    queue_lane = models.CharField(max_length=20, choices=QUEUE_LANE_CHOICES, blank=True, help_text="Queue lane the job is dispatched on")
     
     # Related objects
     user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='jobs')
     story = models.ForeignKey(Story, on_delete=models.CASCADE, related_name='jobs', null=True, blank=True)
     scene = models.ForeignKey(Scene, on_delete=models.CASCADE, related_name='jobs', null=True, blank=True)
+    parent = models.ForeignKey(
+        'self',
+        on_delete=models.CASCADE,
+        null=True,
+        blank=True,
+        related_name='children',
+        help_text="Bulk job this per-scene job belongs to"
+    )
     
     # Job details
     request_data = models.JSONField(help_text="Original request data sent to SQS")
@@ -347,11 +589,41 @@ class Job(models.Model):
             models.Index(fields=['job_type']),
             models.Index(fields=['created_at']),
             models.Index(fields=['user', 'status']),
+            models.Index(fields=['queue_lane', 'created_at']),
+            # Jobs waiting on a scheduled retry, polled by dispatch_retries
+            models.Index(
+                fields=['status', 'next_retry_at'],
+                name='job_retry_due_idx',
+                condition=models.Q(next_retry_at__isnull=False)
+            ),
         ]
 
     def __str__(self):
         return f"{self.job_type} - {self.id} ({self.status})"
 
+    def save(self, *args, **kwargs):
+        if not self.queue_lane:
+            self.queue_lane = self.lane_for(self.job_type, is_child=self.parent_id is not None)
+        super().save(*args, **kwargs)
+
+    @classmethod
+    def lane_for(cls, job_type, is_child=False, scene_count=None):
+        """
+        Route a job to a queue lane by type and size.
+
+        Single-scene regenerations are interactive. Bulk runs, their per-scene
+        children and whole-story audio are batch work. Previews get their own
+        lane unless the story is longer than JOB_LANE_MAX_PREVIEW_SCENES, in
+        which case they are batch work too.
+        """
+        if is_child or job_type in cls.BATCH_JOB_TYPES:
+            return cls.LANE_BATCH
+        if job_type in cls.PREVIEW_JOB_TYPES:
+            if scene_count is not None and scene_count > settings.JOB_LANE_MAX_PREVIEW_SCENES:
+                return cls.LANE_BATCH
+            return cls.LANE_PREVIEW
+        return cls.LANE_INTERACTIVE
+
     def mark_as_processing(self):
         """Mark job as processing and set start time."""
         self.status = 'processing'
@@ -373,15 +645,27 @@ class Job(models.Model):
         self.error_message = error_message
         self.save()
 
-    def schedule_retry(self):
-        """Schedule a retry for failed jobs."""
+    def schedule_retry(self, immediate=False, save=True):
+        """
+        Schedule a retry for failed jobs.
+
+        The dispatch_retries command sends the job once next_retry_at is due;
+        ``immediate`` leaves next_retry_at empty for callers that re-send the
+        job themselves. With ``save=False`` only the fields are set, for
+        callers that write jobs with bulk_update.
+        """
         if self.retry_count < self.max_retries:
             self.retry_count += 1
-            # Exponential backoff: 5min, 15min, 45min
-            delay_minutes = 5 * (3 ** (self.retry_count - 1))
-            self.next_retry_at = timezone.now() + timedelta(minutes=delay_minutes)
+            if immediate:
+                self.next_retry_at = None
+            else:
+                # Exponential backoff: 5min, 15min, 45min
+                delay_minutes = 5 * (3 ** (self.retry_count - 1))
+                self.next_retry_at = timezone.now() + timedelta(minutes=delay_minutes)
             self.status = 'pending'
-            self.save()
+            self.completed_at = None
+            if save:
+                self.save()
             return True
         return False
 
@@ -389,4 +673,36 @@ class Job(models.Model):
         """Cancel the job."""
         self.status = 'cancelled'
         self.completed_at = timezone.now()
-        self.save()
\ No newline at end of file
+        self.save()
+class OutboxMessage(models.Model):
+    """
+    A queue message written in the same transaction as the Job it dispatches.
+
+    The relay_outbox command sends pending messages and stamps the job's
+    message_id, so requests never wait on the queue and a rolled back job
+    never leaves a message behind. Failed sends are retried with exponential
+    backoff (next_attempt_at) and dead lettered once they run out of attempts.
+    """
+    job = models.ForeignKey(Job, on_delete=models.CASCADE, related_name='outbox_messages', null=True, blank=True)
+    queue_lane = models.CharField(max_length=20, choices=Job.QUEUE_LANE_CHOICES, default=Job.LANE_INTERACTIVE)
+    body = models.JSONField(help_text="Message body sent to the queue")
+    attempts = models.PositiveIntegerField(default=0)
+    last_error = models.TextField(null=True, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    next_attempt_at = models.DateTimeField(default=timezone.now, help_text="When the relay may next try to send")
+    sent_at = models.DateTimeField(null=True, blank=True)
+    dead_lettered_at = models.DateTimeField(null=True, blank=True, help_text="When the relay gave up on sending")
+
+    class Meta:
+        ordering = ['id']
+        indexes = [
+            # The relay only ever scans messages still waiting to be sent
+            models.Index(
+                fields=['next_attempt_at', 'id'],
+                name='outbox_pending_idx',
+                condition=models.Q(sent_at__isnull=True, dead_lettered_at__isnull=True)
+            ),
+        ]
+
+    def __str__(self):
+        return f"Outbox message {self.id} for job {self.job_id}"
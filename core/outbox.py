@@ -0,0 +1,162 @@
+"""
+Transactional outbox for Job dispatch.
+
+Views record the queue message for a Job in the same transaction that
+creates it; the relay_outbox command later sends pending messages in
+batches. A request therefore only pays for database writes, and a rolled
+back Job never produces a message. Failed sends back off exponentially and
+are dead lettered after OUTBOX_MAX_ATTEMPTS, which takes them out of the
+pending index.
+"""
+
+from datetime import timedelta
+
+from django.db import transaction
+from django.utils import timezone
+
+from .completions import finish_parent_jobs
+from .events import publish_job_events
+from .models import Job, OutboxMessage
+from .queues import get_queue
+
+OUTBOX_MAX_ATTEMPTS = 5
+OUTBOX_RETRY_DELAY = 5  # seconds before the first retry, doubled on each further attempt
+OUTBOX_MAX_RETRY_DELAY = 15 * 60
+
+
+def retry_delay(attempts):
+    """Backoff before the next send of a message that has failed ``attempts`` times."""
+    return timedelta(seconds=min(OUTBOX_RETRY_DELAY * 2 ** (attempts - 1), OUTBOX_MAX_RETRY_DELAY))
+
+
+def enqueue_job(job, request_data, media_id=None):
+    """
+    Record the queue message for a job; must run inside the job's transaction.
+
+    Args:
+        job (Job): The job the message dispatches
+        request_data (dict): The data to send in the message
+        media_id (int): The media the job replaces, if any
+
+    Returns:
+        OutboxMessage: The pending message
+    """
+    request_data['job_id'] = str(job.id)
+    request_data['media_id'] = media_id
+    job.request_data = request_data
+    job.save(update_fields=['request_data', 'updated_at'])
+    return OutboxMessage.objects.create(job=job, queue_lane=job.queue_lane, body=request_data)
+
+
+def enqueue_jobs(jobs):
+    """
+    Record the queue messages of several new jobs with one UPDATE and one
+    INSERT; must run inside the jobs' transaction.
+
+    Returns:
+        list: The pending OutboxMessages
+    """
+    now = timezone.now()
+    for job in jobs:
+        job.request_data['job_id'] = str(job.id)
+        job.updated_at = now
+    Job.objects.bulk_update(jobs, ['request_data', 'updated_at'])
+    return OutboxMessage.objects.bulk_create([
+        OutboxMessage(job=job, queue_lane=job.queue_lane or Job.LANE_INTERACTIVE, body=job.request_data)
+        for job in jobs
+    ])
+
+
+def enqueue_due_retries(batch_size=100):
+    """
+    Queue one batch of jobs whose scheduled retry is due.
+
+    Due jobs are claimed with SELECT ... FOR UPDATE SKIP LOCKED, their
+    next_retry_at is cleared and their messages are written to the outbox in
+    the same transaction, so concurrent schedulers never dispatch a job twice.
+
+    Returns:
+        int: The number of jobs queued
+    """
+    now = timezone.now()
+    with transaction.atomic():
+        jobs = list(
+            Job.objects.select_for_update(skip_locked=True)
+            .filter(status='pending', next_retry_at__lte=now)
+            .order_by('next_retry_at')[:batch_size]
+        )
+        if not jobs:
+            return 0
+        for job in jobs:
+            job.request_data['job_id'] = str(job.id)
+            job.next_retry_at = None
+            job.updated_at = now
+        Job.objects.bulk_update(jobs, ['request_data', 'next_retry_at', 'updated_at'])
+        OutboxMessage.objects.bulk_create([
+            OutboxMessage(job=job, queue_lane=job.queue_lane or Job.LANE_INTERACTIVE, body=job.request_data)
+            for job in jobs
+        ])
+    return len(jobs)
+
+
+def relay_batch(batch_size=100):
+    """
+    Send one batch of pending outbox messages.
+
+    Rows are claimed with SELECT ... FOR UPDATE SKIP LOCKED so several relays
+    can run side by side without sending a message twice. Sent messages stamp
+    their job's message_id; failed ones are retried after an exponential
+    backoff until OUTBOX_MAX_ATTEMPTS, after which the message is dead
+    lettered and the job is marked as failed (finishing its bulk parent once
+    no other child is left).
+
+    Returns:
+        tuple: (sent, failed) message counts
+    """
+    with transaction.atomic():
+        messages = list(
+            OutboxMessage.objects.select_for_update(skip_locked=True)
+            .filter(sent_at__isnull=True, dead_lettered_at__isnull=True, next_attempt_at__lte=timezone.now())
+            .order_by('next_attempt_at', 'id')[:batch_size]
+        )
+        if not messages:
+            return 0, 0
+
+        # One batch send per lane, mapped back to positions in ``messages``
+        sent, failed = [], []
+        lanes = {}
+        for index, message in enumerate(messages):
+            lanes.setdefault(message.queue_lane, []).append(index)
+        for lane, indexes in lanes.items():
+            lane_sent, lane_failed = get_queue(lane).send_batch([messages[index].body for index in indexes])
+            sent.extend((indexes[position], message_id) for position, message_id in lane_sent)
+            failed.extend((indexes[position], error) for position, error in lane_failed)
+
+        now = timezone.now()
+        jobs, parent_ids = [], set()
+        for index, message_id in sent:
+            message = messages[index]
+            message.sent_at = now
+            message.attempts += 1
+            if message.job_id:
+                jobs.append(Job(id=message.job_id, message_id=message_id, updated_at=now))
+        for index, error in failed:
+            message = messages[index]
+            message.attempts += 1
+            message.last_error = error
+            if message.attempts < OUTBOX_MAX_ATTEMPTS:
+                message.next_attempt_at = now + retry_delay(message.attempts)
+                continue
+            message.dead_lettered_at = now
+            if message.job_id:
+                job = Job.objects.get(pk=message.job_id)
+                job.mark_as_failed(f"Failed to send to the job queue: {error}")
+                if job.parent_id:
+                    parent_ids.add(job.parent_id)
+
+        OutboxMessage.objects.bulk_update(
+            messages, ['sent_at', 'attempts', 'last_error', 'next_attempt_at', 'dead_lettered_at']
+        )
+        Job.objects.bulk_update(jobs, ['message_id', 'updated_at'])
+        publish_job_events(finish_parent_jobs(parent_ids, now))
+    return len(sent), len(failed)
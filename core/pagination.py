@@ -0,0 +1,102 @@
+"""
+Pagination helpers for the WhisprTales API.
+
+Keyset (seek) pagination walks a queryset by filtering past the last row of
+the previous page on a unique ordering such as ('-created_at', '-id'), so a
+page costs the same index range scan however deep the client scrolls.
+"""
+
+import base64
+import binascii
+import json
+
+from django.conf import settings
+from django.core.exceptions import ValidationError
+from django.db.models import Q
+from rest_framework.exceptions import NotFound
+
+
+class KeysetPagination:
+    """
+    Paginate a queryset on a unique ordering using an opaque cursor.
+
+    The cursor encodes the ordering values of the last row on the page;
+    the next page is fetched with a row comparison against those values.
+    """
+    cursor_query_param = 'cursor'
+    page_size_query_param = 'page_size'
+    max_page_size = 100
+
+    def __init__(self, ordering=('-created_at', '-id'), page_size=None):
+        self.ordering = ordering
+        self.page_size = page_size or settings.REST_FRAMEWORK['PAGE_SIZE']
+        self.next_cursor = None
+
+    def get_page_size(self, request):
+        """Read the requested page size, bounded by max_page_size."""
+        try:
+            page_size = int(request.query_params.get(self.page_size_query_param, self.page_size))
+        except (TypeError, ValueError):
+            return self.page_size
+        return max(1, min(page_size, self.max_page_size))
+
+    def paginate_queryset(self, queryset, request):
+        """Return the rows of the requested page and remember the next cursor."""
+        self.page_size = self.get_page_size(request)
+        queryset = queryset.order_by(*self.ordering)
+
+        cursor = request.query_params.get(self.cursor_query_param)
+        if cursor:
+            queryset = queryset.filter(self.seek_filter(queryset.model, self.decode_cursor(cursor)))
+
+        # Fetch one extra row to learn whether another page exists
+        rows = list(queryset[:self.page_size + 1])
+        has_next = len(rows) > self.page_size
+        rows = rows[:self.page_size]
+        self.next_cursor = self.encode_cursor(rows[-1]) if has_next else None
+        return rows
+
+    def get_paginated_data(self, data):
+        """Wrap serialized page data with the pagination details."""
+        return {
+            'results': data,
+            'next_cursor': self.next_cursor,
+            'page_size': self.page_size
+        }
+
+    def field_names(self):
+        return [name.lstrip('-') for name in self.ordering]
+
+    def seek_filter(self, model, values):
+        """
+        Build the row comparison selecting rows after ``values``, e.g. for
+        ('-created_at', '-id'): created_at < c OR (created_at = c AND id < i).
+        """
+        seek = Q()
+        equal = Q()
+        for name, value in zip(self.ordering, values):
+            field_name = name.lstrip('-')
+            lookup = 'lt' if name.startswith('-') else 'gt'
+            try:
+                value = model._meta.get_field(field_name).to_python(value)
+            except (ValidationError, TypeError, ValueError):
+                raise NotFound('Invalid cursor')
+            seek |= equal & Q(**{f'{field_name}__{lookup}': value})
+            equal &= Q(**{field_name: value})
+        return seek
+
+    def encode_cursor(self, row):
+        values = []
+        for field_name in self.field_names():
+            value = getattr(row, field_name)
+            values.append(value.isoformat() if hasattr(value, 'isoformat') else value)
+        return base64.urlsafe_b64encode(json.dumps(values).encode()).decode()
+
+    def decode_cursor(self, cursor):
+        try:
+            values = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        except (binascii.Error, ValueError, UnicodeDecodeError):
+            raise NotFound('Invalid cursor')
+        if not isinstance(values, list) or len(values) != len(self.ordering):
+            raise NotFound('Invalid cursor')
+        return values
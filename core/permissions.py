@@ -0,0 +1,26 @@
+"""
+Permissions for internal endpoints called by workers rather than users.
+"""
+
+import hmac
+
+from django.conf import settings
+from rest_framework import permissions
+
+
+class IsWorker(permissions.BasePermission):
+    """
+    Allow requests carrying the shared worker token:
+
+        Authorization: Worker <WORKER_API_TOKEN>
+
+    Denies everything when WORKER_API_TOKEN is not configured.
+    """
+    keyword = 'Worker'
+
+    def has_permission(self, request, view):
+        expected = settings.WORKER_API_TOKEN
+        scheme, _, token = request.META.get('HTTP_AUTHORIZATION', '').partition(' ')
+        if not expected or scheme != self.keyword or not token:
+            return False
+        return hmac.compare_digest(token.encode(), expected.encode())
@@ -0,0 +1,192 @@
+"""
+Preview status for the preview-status endpoint.
+
+A preview's state lives on its Revision (status and completed_at), set by
+the job completion endpoint or by the reconcile_previews command. The status
+response for a story and format is cached in Redis and dropped whenever one
+of the story's revisions changes, so polling clients are answered without
+touching the database or S3. Each change is also published on a Redis
+channel so long-polling clients wake up as soon as their preview is ready.
+
+Revisions carry a fingerprint of the story content they were rendered from,
+so an unchanged story is not rendered again.
+"""
+
+import asyncio
+import hashlib
+import json
+
+from asgiref.sync import sync_to_async
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import transaction
+
+from .models import Media, Revision, Scene, Story
+from .utils import async_redis_client, redis_client
+
+PREVIEW_STATUS_TTL = 60 * 60
+MAX_PREVIEW_WAIT = 30  # seconds a long-poll may be parked
+
+# The preview-status URL says 'video' where revisions store 'mp4'
+PREVIEW_FORMAT_ALIASES = {'video': 'mp4'}
+PREVIEW_FILE_EXTENSIONS = {'pdf': 'pdf', 'audio': 'mp3', 'mp4': 'mp4'}
+
+
+def revision_format(name):
+    return PREVIEW_FORMAT_ALIASES.get(name, name)
+
+
+def preview_status_key(story_id, name):
+    return f"preview:status:{story_id}:{revision_format(name)}"
+
+
+def preview_status_channel(story_id, name):
+    return f"preview:changed:{story_id}:{revision_format(name)}"
+
+
+def story_content_fingerprint(story):
+    """
+    Fingerprint the content a preview is rendered from: the story's title,
+    text and language, its active scenes in order and the ids of their
+    active media.
+
+    Args:
+        story (Story): The story being previewed
+
+    Returns:
+        str: sha256 hex digest, stable while no story text, scene text or media changes
+    """
+    media = {}
+    for scene_id, media_id in Media.objects.filter(
+        story_id=story.id, scene__is_active=True, is_active=True
+    ).values_list('scene_id', 'id'):
+        media.setdefault(scene_id, []).append(media_id)
+    scenes = [
+        [scene_id, title, content, sorted(media.get(scene_id, []))]
+        for scene_id, title, content in Scene.objects.filter(
+            story_id=story.id, is_active=True
+        ).order_by('order', 'id').values_list('id', 'title', 'content')
+    ]
+    rendered = [story.title, story.content, story.language, scenes]
+    return hashlib.sha256(json.dumps(rendered, separators=(',', ':')).encode()).hexdigest()
+
+
+def find_rendered_preview(story_id, name, fingerprint):
+    """The story's live, completed revision in a format rendered from ``fingerprint``, if any."""
+    return Revision.objects.filter(
+        story_id=story_id,
+        format=revision_format(name),
+        is_active=True,
+        deleted_at=None,
+        status='complete',
+        metadata__fingerprint=fingerprint
+    ).order_by('-created_at').first()
+
+
+def preview_object_key(revision):
+    """The S3 key a worker uploads a revision's preview file to."""
+    extension = PREVIEW_FILE_EXTENSIONS.get(revision.format, revision.format)
+    return f"story_{revision.story_id}/preview_{revision.id}.{extension}"
+
+
+def preview_status_body(revision):
+    if revision is None or revision.status != 'complete':
+        return {'status': 'failed' if revision is not None and revision.status == 'failed' else 'pending'}
+    return {
+        'status': 'complete',
+        'url': revision.url,
+        'format': revision.format,
+        'created_at': revision.created_at,
+        'completed_at': revision.completed_at,
+    }
+
+
+def get_preview_status(story_id, name):
+    """
+    Return the preview status of a story's latest revision in a format.
+
+    Returns:
+        tuple: (author_id, body); author_id is None when the story doesn't exist
+    """
+    key = preview_status_key(story_id, name)
+    try:
+        cached = redis_client().get(key)
+        if cached is not None:
+            cached = json.loads(cached)
+            return cached['author_id'], cached['body']
+    except Exception as e:
+        print(f"Error reading preview status: {str(e)}")
+
+    revision = Revision.objects.filter(
+        story_id=story_id,
+        format=revision_format(name),
+        is_active=True,
+        deleted_at=None
+    ).select_related('story').order_by('-created_at').first()
+    if revision is not None:
+        author_id = revision.story.author_id
+    else:
+        author_id = Story.objects.filter(pk=story_id).values_list('author_id', flat=True).first()
+    body = json.loads(json.dumps(preview_status_body(revision), cls=DjangoJSONEncoder))
+
+    if author_id is not None:
+        try:
+            redis_client().setex(key, PREVIEW_STATUS_TTL, json.dumps({'author_id': author_id, 'body': body}))
+        except Exception as e:
+            print(f"Error caching preview status: {str(e)}")
+    return author_id, body
+
+
+def invalidate_preview_status(story_id, name=None):
+    """Drop cached preview statuses of a story (one format, or all) once the current transaction commits."""
+    names = [name] if name else PREVIEW_FILE_EXTENSIONS
+
+    def delete():
+        try:
+            pipeline = redis_client().pipeline(transaction=False)
+            pipeline.delete(*[preview_status_key(story_id, fmt) for fmt in names])
+            # Wake long-polling clients once the stale status is gone
+            for fmt in names:
+                pipeline.publish(preview_status_channel(story_id, fmt), 'changed')
+            pipeline.execute()
+        except Exception as e:
+            print(f"Error invalidating preview status: {str(e)}")
+
+    transaction.on_commit(delete)
+
+
+async def wait_for_preview_status(story_id, name, user_id, wait):
+    """
+    Return the preview status, waiting up to ``wait`` seconds for a pending
+    preview to finish.
+
+    Subscribes to the preview's change channel before reading the status so
+    no completion can slip in between; the request then stays parked on the
+    subscription instead of polling. Falls back to the current status when
+    Redis is unavailable.
+
+    Returns:
+        tuple: (author_id, body) as from get_preview_status()
+    """
+    client = async_redis_client()
+    pubsub = client.pubsub()
+    try:
+        try:
+            await pubsub.subscribe(preview_status_channel(story_id, name))
+        except Exception as e:
+            print(f"Error subscribing to preview status: {str(e)}")
+            return await sync_to_async(get_preview_status)(story_id, name)
+
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + min(wait, MAX_PREVIEW_WAIT)
+        author_id, body = await sync_to_async(get_preview_status)(story_id, name)
+        while author_id == user_id and body['status'] == 'pending':
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                break
+            message = await pubsub.get_message(ignore_subscribe_messages=True, timeout=remaining)
+            if message is not None:
+                author_id, body = await sync_to_async(get_preview_status)(story_id, name)
+        return author_id, body
+    finally:
+        await pubsub.aclose()
+        await client.aclose()
@@ -0,0 +1,270 @@
+"""
+Job queue backends.
+
+Job dispatch goes through get_queue(), which returns the backend named by the
+JOB_QUEUE_BACKEND setting:
+
+    'sqs'     Amazon SQS at WHISPR_TALES_QUEUE_URL (production)
+    'redis'   A Redis Stream at JOB_QUEUE_STREAM, read through consumer groups
+    'memory'  An in-process queue for local runs, load tests and unit tests
+
+A dotted path to a QueueBackend subclass is accepted as well. Every backend
+sends single messages and batches, and delivers messages to consumer groups
+until they are acknowledged.
+
+Jobs are split into priority lanes (Job.queue_lane). Each lane in
+JOB_QUEUE_LANES may name its own SQS queue or stream, and LaneConsumer reads
+the lanes by weighted round robin so batch work can't starve interactive
+requests.
+"""
+
+import itertools
+import json
+import threading
+from abc import ABC, abstractmethod
+from collections import namedtuple
+
+from django.conf import settings
+from django.utils.module_loading import import_string
+
+from .utils import SQS_MAX_BATCH_SIZE, aws_client, redis_client, send_messages_to_sqs
+
+# ``receipt`` is what ack() needs: the SQS receipt handle or the stream entry id
+QueueMessage = namedtuple('QueueMessage', ['id', 'body', 'receipt'])
+
+
+class QueueBackend(ABC):
+    """Interface shared by the job queue backends; send() is built on send_batch()."""
+
+    def send(self, body):
+        """Send one JSON serializable message and return its message id."""
+        sent, failed = self.send_batch([body])
+        if failed:
+            raise Exception(f"Failed to send message: {failed[0][1]}")
+        return sent[0][1]
+
+    @abstractmethod
+    def send_batch(self, bodies):
+        """
+        Send several messages.
+
+        Returns:
+            tuple: (sent, failed) lists; sent holds (index, message_id) and
+            failed holds (index, error) pairs, indexing into ``bodies``
+        """
+
+    @abstractmethod
+    def receive(self, group, consumer, max_messages=10, wait_seconds=0):
+        """Return up to ``max_messages`` QueueMessages delivered to ``consumer`` of ``group``."""
+
+    @abstractmethod
+    def ack(self, group, messages):
+        """Acknowledge processed messages so they are not delivered again."""
+
+
+class SQSQueue(QueueBackend):
+    """
+    Amazon SQS. The queue itself acts as the only consumer group; unacknowledged
+    messages reappear after the queue's visibility timeout.
+    """
+
+    def __init__(self, lane=None, queue_url=None):
+        self.queue_url = queue_url or lane_setting(lane, 'queue_url') or settings.WHISPR_TALES_QUEUE_URL
+
+    def send(self, body):
+        response = aws_client('sqs').send_message(QueueUrl=self.queue_url, MessageBody=json.dumps(body))
+        return response['MessageId']
+
+    def send_batch(self, bodies):
+        return send_messages_to_sqs(bodies, queue_url=self.queue_url)
+
+    def receive(self, group, consumer, max_messages=10, wait_seconds=0):
+        response = aws_client('sqs').receive_message(
+            QueueUrl=self.queue_url,
+            MaxNumberOfMessages=min(max_messages, SQS_MAX_BATCH_SIZE),
+            WaitTimeSeconds=wait_seconds
+        )
+        return [
+            QueueMessage(message['MessageId'], json.loads(message['Body']), message['ReceiptHandle'])
+            for message in response.get('Messages', [])
+        ]
+
+    def ack(self, group, messages):
+        for start in range(0, len(messages), SQS_MAX_BATCH_SIZE):
+            aws_client('sqs').delete_message_batch(
+                QueueUrl=self.queue_url,
+                Entries=[
+                    {'Id': str(index), 'ReceiptHandle': message.receipt}
+                    for index, message in enumerate(messages[start:start + SQS_MAX_BATCH_SIZE])
+                ]
+            )
+
+
+class RedisStreamQueue(QueueBackend):
+    """
+    A Redis Stream. Sends are pipelined XADDs, consumers read with XREADGROUP,
+    and entries left unacknowledged for ``visibility_timeout`` seconds are
+    claimed by the next consumer that asks, like an SQS visibility timeout.
+    """
+
+    def __init__(self, lane=None, stream=None, maxlen=None, visibility_timeout=300):
+        self.stream = stream or lane_setting(lane, 'stream') or settings.JOB_QUEUE_STREAM
+        self.maxlen = maxlen or settings.JOB_QUEUE_MAXLEN
+        self.visibility_timeout = visibility_timeout
+
+    def send_batch(self, bodies):
+        pipeline = redis_client().pipeline(transaction=False)
+        for body in bodies:
+            pipeline.xadd(self.stream, {'body': json.dumps(body)}, maxlen=self.maxlen, approximate=True)
+        sent, failed = [], []
+        for index, result in enumerate(pipeline.execute(raise_on_error=False)):
+            if isinstance(result, Exception):
+                failed.append((index, str(result)))
+            else:
+                sent.append((index, result.decode()))
+        return sent, failed
+
+    def receive(self, group, consumer, max_messages=10, wait_seconds=0):
+        client = redis_client()
+        self.ensure_group(client, group)
+        _, claimed, *_ = client.xautoclaim(
+            self.stream, group, consumer, self.visibility_timeout * 1000, count=max_messages
+        )
+        entries = [(entry_id, fields) for entry_id, fields in claimed if fields]
+        trimmed = [entry_id for entry_id, fields in claimed if not fields]
+        if trimmed:
+            # Trimmed by MAXLEN before anyone acknowledged them; Redis 6.2 keeps them pending
+            client.xack(self.stream, group, *trimmed)
+        if not entries:
+            response = client.xreadgroup(
+                group, consumer, {self.stream: '>'}, count=max_messages,
+                block=wait_seconds * 1000 if wait_seconds else None
+            )
+            entries = response[0][1] if response else []
+        return [
+            QueueMessage(entry_id.decode(), json.loads(fields[b'body']), entry_id)
+            for entry_id, fields in entries
+        ]
+
+    def ack(self, group, messages):
+        if messages:
+            redis_client().xack(self.stream, group, *[message.receipt for message in messages])
+
+    def ensure_group(self, client, group):
+        try:
+            client.xgroup_create(self.stream, group, id='0', mkstream=True)
+        except Exception as e:
+            if 'BUSYGROUP' not in str(e):
+                raise
+
+
+class MemoryQueue(QueueBackend):
+    """
+    An in-process queue with consumer group semantics: each group sees every
+    message once, and a message stays pending until its group acknowledges it.
+    """
+
+    def __init__(self, lane=None):
+        self.lane = lane or 'default'
+        self.lock = threading.Lock()
+        self.ids = itertools.count(1)
+        self.messages = []
+        self.groups = {}
+
+    def send_batch(self, bodies):
+        with self.lock:
+            sent = []
+            for index, body in enumerate(bodies):
+                message_id = f"memory-{self.lane}-{next(self.ids)}"
+                # Round trip through JSON so consumers get what a real queue would deliver
+                self.messages.append(QueueMessage(message_id, json.loads(json.dumps(body)), message_id))
+                sent.append((index, message_id))
+            return sent, []
+
+    def receive(self, group, consumer, max_messages=10, wait_seconds=0):
+        with self.lock:
+            state = self.groups.setdefault(group, {'offset': 0, 'pending': {}})
+            messages = self.messages[state['offset']:state['offset'] + max_messages]
+            state['offset'] += len(messages)
+            for message in messages:
+                state['pending'][message.receipt] = message
+            return messages
+
+    def ack(self, group, messages):
+        with self.lock:
+            pending = self.groups.get(group, {}).get('pending', {})
+            for message in messages:
+                pending.pop(message.receipt, None)
+
+
+QUEUE_BACKENDS = {
+    'sqs': SQSQueue,
+    'redis': RedisStreamQueue,
+    'memory': MemoryQueue,
+}
+
+_queues = {}
+_queues_lock = threading.Lock()
+
+
+def lane_setting(lane, name):
+    """Read one option of a lane from JOB_QUEUE_LANES, or None when it isn't set."""
+    return settings.JOB_QUEUE_LANES.get(lane, {}).get(name) if lane else None
+
+
+def get_queue(lane=None):
+    """Return this process's instance of the configured job queue backend for a lane."""
+    name = settings.JOB_QUEUE_BACKEND
+    queue = _queues.get((name, lane))
+    if queue is None:
+        with _queues_lock:
+            queue = _queues.get((name, lane))
+            if queue is None:
+                backend = QUEUE_BACKENDS.get(name) or import_string(name)
+                queue = _queues[(name, lane)] = backend(lane=lane)
+    return queue
+
+
+class LaneConsumer:
+    """
+    Receive jobs from every lane in JOB_QUEUE_LANES by smooth weighted round robin.
+
+    With weights interactive=6, preview=3, batch=1 a busy worker takes six
+    interactive batches for every batch batch. Empty lanes are skipped, so
+    idle capacity always goes to whatever work is waiting.
+    """
+
+    def __init__(self, group, consumer, lanes=None):
+        self.group = group
+        self.consumer = consumer
+        lanes = lanes or settings.JOB_QUEUE_LANES
+        self.weights = {lane: lanes[lane].get('weight', 1) for lane in lanes}
+        self.current = {lane: 0 for lane in self.weights}
+
+    def lane_order(self):
+        """Advance the round robin and return the lanes, the one whose turn it is first."""
+        total = sum(self.weights.values())
+        for lane, weight in self.weights.items():
+            self.current[lane] += weight
+        chosen = max(self.current, key=self.current.get)
+        self.current[chosen] -= total
+        return [chosen] + sorted(
+            (lane for lane in self.weights if lane != chosen), key=self.weights.get, reverse=True
+        )
+
+    def receive(self, max_messages=10, wait_seconds=0):
+        """
+        Returns:
+            tuple: (lane, messages) from the first lane in turn with work, or (None, [])
+        """
+        lanes = self.lane_order()
+        for index, lane in enumerate(lanes):
+            # Only long-poll on the last lane, once the others are known to be empty
+            wait = wait_seconds if index == len(lanes) - 1 else 0
+            messages = get_queue(lane).receive(self.group, self.consumer, max_messages, wait)
+            if messages:
+                return lane, messages
+        return None, []
+
+    def ack(self, lane, messages):
+        get_queue(lane).ack(self.group, messages)
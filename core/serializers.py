@@ -1,9 +1,33 @@
 from rest_framework import serializers
 from django.contrib.auth import get_user_model
+from django.db.models import Prefetch
 from .models import Story, Scene, Media, Revision, Credits, CreditTransaction, Order, Payment, Job
+from .credits import get_credit_balance, invalidate_credit_balance, annotated_credit_balance
 
 User = get_user_model()
 
+class DynamicFieldsMixin:
+    """
+    Lets callers trim a serializer's output.
+
+    ``fields`` keeps only the named fields. ``include`` names which of the
+    serializer's ``expandable_fields`` (nested relations) to render; when it
+    is omitted every relation is rendered as before.
+    """
+    expandable_fields = ()
+
+    def __init__(self, *args, **kwargs):
+        fields = kwargs.pop('fields', None)
+        include = kwargs.pop('include', None)
+        super().__init__(*args, **kwargs)
+        self.include = include
+
+        allowed = set(self.fields) if fields is None else set(fields)
+        if include is not None:
+            allowed = (allowed - set(self.expandable_fields)) | (set(include) & set(self.expandable_fields))
+        for field_name in set(self.fields) - allowed:
+            self.fields.pop(field_name)
+
 class CreditSerializer(serializers.ModelSerializer):
     class Meta:
         model = Credits
@@ -18,8 +42,14 @@ class UserSerializer(serializers.ModelSerializer):
         read_only_fields = ('id',)
 
     def get_credits(self, obj):
-        credit = Credits.objects.filter(user=obj, is_active=True).first()
-        return CreditSerializer(credit).data if credit else {'credits_remaining': 0, 'updated_at': None}
+        # Use the credits prefetched by Story.objects.with_related() or annotated
+        # by annotate_credit_balance() when present, otherwise the balance cached in Redis
+        if hasattr(obj, 'active_credits'):
+            credit = obj.active_credits[0] if obj.active_credits else None
+            return CreditSerializer(credit).data if credit else {'credits_remaining': 0, 'updated_at': None}
+        if hasattr(obj, 'active_credits_updated_at'):
+            return annotated_credit_balance(obj)
+        return get_credit_balance(obj.id)
 
 class UserRegistrationSerializer(serializers.ModelSerializer):
     """
@@ -39,11 +69,12 @@ class UserRegistrationSerializer(serializers.ModelSerializer):
             referral_code=validated_data.get('referral_code')  # Add referral code during user creation
         )
         # Create initial credits for the user
-        Credits.objects.create(
+        credits = Credits.objects.create(
             user=user,
             credits_remaining=300,  # Default credits
             is_active=True
         )
+        invalidate_credit_balance(credits.user_id)
         return user
 
 class MediaSerializer(serializers.ModelSerializer):
@@ -52,8 +83,9 @@ class MediaSerializer(serializers.ModelSerializer):
         fields = ('id', 'media_type', 'url', 'description', 'created_at', 'is_active')
         read_only_fields = ('id', 'created_at')
 
-class SceneSerializer(serializers.ModelSerializer):
+class SceneSerializer(DynamicFieldsMixin, serializers.ModelSerializer):
     media = serializers.SerializerMethodField()
+    expandable_fields = ('media',)
 
     class Meta:
         model = Scene
@@ -64,20 +96,68 @@ class SceneSerializer(serializers.ModelSerializer):
         read_only_fields = ('id', 'created_at', 'updated_at')
 
     def get_media(self, obj):
-        active_media = obj.media.filter(is_active=True)
+        active_media = getattr(obj, 'active_media', None)
+        if active_media is None:
+            active_media = obj.media.filter(is_active=True)
         return MediaSerializer(active_media, many=True).data
 
-class StorySerializer(serializers.ModelSerializer):
+class StorySerializer(DynamicFieldsMixin, serializers.ModelSerializer):
+    """
+    Serializer for a story with its author and active scenes.
+
+    Expects instances loaded through Story.objects.with_related(); falls back
+    to per-object queries otherwise. ``include`` accepts 'author', 'scenes'
+    and 'media' (the media nested in each scene).
+    """
     author = UserSerializer(read_only=True)
-    scenes = SceneSerializer(many=True, read_only=True)
+    scenes = serializers.SerializerMethodField()
+    expandable_fields = ('author', 'scenes')
 
     class Meta:
         model = Story
         fields = (
             'id', 'title', 'content', 'author', 'created_at',
-            'updated_at', 'is_public', 'word_count', 'scenes', 'is_default', 'language'
+            'updated_at', 'is_public', 'word_count', 'scenes', 'is_default', 'language',
+            'active_scene_count', 'image_ready_scene_count', 'audio_ready_scene_count'
+        )
+        read_only_fields = (
+            'id', 'author', 'created_at', 'updated_at', 'word_count', 'is_default', 'language',
+            'active_scene_count', 'image_ready_scene_count', 'audio_ready_scene_count'
         )
-        read_only_fields = ('id', 'author', 'created_at', 'updated_at', 'word_count', 'is_default', 'language')
+
+    def get_scenes(self, obj):
+        active_scenes = getattr(obj, 'active_scenes', None)
+        if active_scenes is None:
+            active_scenes = obj.scenes.filter(is_active=True).prefetch_related(
+                Prefetch('media', queryset=Media.objects.filter(is_active=True), to_attr='active_media')
+            )
+        scene_include = None if self.include is None else [name for name in self.include if name == 'media']
+        return SceneSerializer(active_scenes, many=True, include=scene_include).data
+
+    @classmethod
+    def relations_for(cls, fields=None, include=None):
+        """Return the relations Story.objects.with_related() must load for the given options."""
+        if include is not None:
+            return [name for name in ('author', 'scenes', 'media') if name in include]
+        if fields is None:
+            return ['author', 'scenes', 'media']
+        relations = [name for name in ('author', 'scenes') if name in fields]
+        if 'scenes' in relations:
+            relations.append('media')
+        return relations
+
+class StorySummarySerializer(serializers.ModelSerializer):
+    """Compact story representation for story cards and listings."""
+    cover_image = serializers.CharField(read_only=True, allow_null=True)
+
+    class Meta:
+        model = Story
+        fields = (
+            'id', 'title', 'word_count', 'created_at', 'updated_at',
+            'is_public', 'language', 'cover_image',
+            'active_scene_count', 'image_ready_scene_count', 'audio_ready_scene_count'
+        )
+        read_only_fields = fields
 
 class StoryCreateSerializer(serializers.ModelSerializer):
     class Meta:
@@ -127,13 +207,13 @@ class JobSerializer(serializers.ModelSerializer):
     class Meta:
         model = Job
         fields = [
-            'id', 'message_id', 'job_type', 'status',
-            'user', 'story', 'scene', 'request_data', 'response_data',
+            'id', 'message_id', 'job_type', 'status', 'queue_lane',
+            'user', 'story', 'scene', 'parent', 'request_data', 'response_data',
             'error_message', 'created_at', 'started_at', 'completed_at',
             'updated_at', 'retry_count', 'max_retries', 'next_retry_at'
         ]
         read_only_fields = [
-            'id', 'message_id', 'created_at', 'started_at',
+            'id', 'message_id', 'queue_lane', 'parent', 'created_at', 'started_at',
             'completed_at', 'updated_at', 'retry_count', 'next_retry_at'
         ]
 
@@ -143,4 +223,43 @@ class JobCreateSerializer(serializers.ModelSerializer):
         model = Job
         fields = [
             'job_type', 'user', 'story', 'scene', 'request_data'
-        ]
\ No newline at end of file
+        ]
+class MediaCompletionSerializer(serializers.Serializer):
+    scene_id = serializers.IntegerField(required=False, help_text="Scene of the media, for story-level jobs")
+    url = serializers.URLField(max_length=1000)
+    description = serializers.CharField(required=False, allow_blank=True)
+    request_id = serializers.CharField(required=False, allow_null=True, max_length=200)
+    fingerprint = serializers.CharField(required=False, allow_null=True, max_length=64)
+
+class MediaCompletionField(serializers.Field):
+    """
+    The media a job produced: one item for a scene job, or a list of items
+    each naming its scene_id for a story-level job such as generate_entire_audio.
+    """
+    def to_internal_value(self, data):
+        many = isinstance(data, list)
+        serializer = MediaCompletionSerializer(data=data, many=many)
+        if not serializer.is_valid():
+            raise serializers.ValidationError(serializer.errors)
+        if many and any('scene_id' not in item for item in serializer.validated_data):
+            raise serializers.ValidationError('Every item of a media list needs a scene_id')
+        return serializer.validated_data
+
+    def to_representation(self, value):
+        return value
+
+class RevisionCompletionSerializer(serializers.Serializer):
+    id = serializers.IntegerField(required=False, help_text="Pending revision the worker rendered")
+    url = serializers.URLField()
+    format = serializers.ChoiceField(choices=Revision.FORMAT_CHOICES, required=False)
+    sub_format = serializers.CharField(required=False, allow_null=True, max_length=50)
+    metadata = serializers.JSONField(required=False)
+
+class JobCompletionEventSerializer(serializers.Serializer):
+    """One finished job reported by a worker."""
+    job_id = serializers.IntegerField()
+    status = serializers.ChoiceField(choices=['completed', 'failed'])
+    response_data = serializers.JSONField(required=False, allow_null=True)
+    error_message = serializers.CharField(required=False, allow_null=True, allow_blank=True)
+    media = MediaCompletionField(required=False)
+    revision = RevisionCompletionSerializer(required=False)
@@ -0,0 +1,63 @@
+"""
+Signal handlers for the core app.
+
+Keeps the public response cache and the story readiness counters coherent
+with story, scene, media and revision writes made through the ORM, and
+publishes job status transitions. Bulk .update() calls bypass these handlers
+and refresh or invalidate explicitly.
+"""
+
+from django.db.models.signals import post_delete, post_init, post_save
+from django.dispatch import receiver
+
+from .cache import invalidate_public_story
+from .events import publish_job_event
+from .previews import invalidate_preview_status
+from .models import Job, Media, Revision, Scene, Story
+
+
+def story_is_public(instance):
+    """Whether the story a scene or media row belongs to is public."""
+    try:
+        return instance.story.is_public
+    except Story.DoesNotExist:
+        # The story is being deleted along with its scenes and media
+        return True
+
+
+@receiver([post_save, post_delete], sender=Story)
+def invalidate_story(sender, instance, **kwargs):
+    invalidate_public_story(instance.id)
+
+
+@receiver([post_save, post_delete], sender=Scene)
+@receiver([post_save, post_delete], sender=Media)
+def invalidate_story_content(sender, instance, **kwargs):
+    # Scenes and media are embedded in the public listing only for public stories
+    invalidate_public_story(instance.story_id, include_list=story_is_public(instance))
+
+
+@receiver([post_save, post_delete], sender=Revision)
+def invalidate_story_revisions(sender, instance, **kwargs):
+    invalidate_public_story(instance.story_id, include_list=False)
+    invalidate_preview_status(instance.story_id, instance.format)
+
+
+@receiver([post_save, post_delete], sender=Scene)
+@receiver([post_save, post_delete], sender=Media)
+def refresh_story_counters(sender, instance, **kwargs):
+    # Runs inside the writer's transaction, so the counters commit with the change
+    Story.objects.filter(pk=instance.story_id).refresh_counters()
+
+
+@receiver(post_init, sender=Job)
+def remember_job_status(sender, instance, **kwargs):
+    # Read through __dict__ so a deferred status field isn't loaded here
+    instance._loaded_status = instance.__dict__.get('status')
+
+
+@receiver(post_save, sender=Job)
+def publish_job_status(sender, instance, created, **kwargs):
+    if created or instance.status != instance._loaded_status:
+        publish_job_event(instance)
+    instance._loaded_status = instance.status
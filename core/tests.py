@@ -1,3 +1,1421 @@
-from django.test import TestCase
+import asyncio
+import base64
+import itertools
+import json
+import math
+from collections import defaultdict
+from datetime import timedelta
+from io import StringIO
+from unittest import mock, skipUnless
 
-# Create your tests here.
+from asgiref.sync import SyncToAsync, sync_to_async
+from botocore.stub import Stubber
+import redis
+from django.core.management import call_command
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import connection, transaction
+from django.db.models import F
+from django.http import Http404
+from django.test import RequestFactory, TestCase, override_settings
+from django.urls import resolve, reverse
+from django.utils import timezone
+from rest_framework_simplejwt.tokens import AccessToken
+from rest_framework.test import APIClient, APIRequestFactory, force_authenticate
+
+from .models import User, Story, Scene, Media, Credits, CreditTransaction, Job, OutboxMessage, Revision
+from .views import StoryDetailAPIView
+from .outbox import OUTBOX_MAX_ATTEMPTS, enqueue_due_retries, enqueue_job, enqueue_jobs, relay_batch
+from .queues import LaneConsumer, MemoryQueue, QueueBackend, RedisStreamQueue, get_queue
+from .idempotency import request_fingerprint, submission_key
+from .audio import plan_story_audio, scene_audio_fingerprint
+from .utils import CREDIT_COSTS
+from . import cache, credits, events, idempotency, previews, queues, utils
+
+
+class FakeRedis:
+    """In-memory stand-in for the Redis commands the app uses; expiry is ignored."""
+
+    def __init__(self):
+        self.data = {}
+        self.ttls = {}
+        self.subscribers = defaultdict(list)
+
+    @staticmethod
+    def encode(value):
+        return value if isinstance(value, bytes) else str(value).encode()
+
+    def get(self, key):
+        return self.data.get(key)
+
+    def set(self, key, value, nx=False, ex=None):
+        if nx and key in self.data:
+            return None
+        self.data[key] = self.encode(value)
+        return True
+
+    def setex(self, key, ttl, value):
+        self.ttls[key] = ttl
+        return self.set(key, value)
+
+    def exists(self, *keys):
+        return sum(key in self.data for key in keys)
+
+    def delete(self, *keys):
+        return sum(self.data.pop(key, None) is not None for key in keys)
+
+    def incr(self, key):
+        value = int(self.data.get(key, 0)) + 1
+        self.data[key] = self.encode(value)
+        return value
+
+    def publish(self, channel, message):
+        message = {'type': 'message', 'channel': channel.encode(), 'data': self.encode(message)}
+        for loop, queue in self.subscribers[channel]:
+            loop.call_soon_threadsafe(queue.put_nowait, message)
+        return len(self.subscribers[channel])
+
+    def pipeline(self, transaction=True):
+        return FakePipeline(self)
+
+
+class FakePipeline:
+
+    def __init__(self, client):
+        self.client = client
+        self.commands = []
+
+    def __getattr__(self, name):
+        def queue(*args, **kwargs):
+            self.commands.append((getattr(self.client, name), args, kwargs))
+            return self
+        return queue
+
+    def execute(self, raise_on_error=True):
+        results = []
+        for command, args, kwargs in self.commands:
+            try:
+                results.append(command(*args, **kwargs))
+            except redis.RedisError as e:
+                if raise_on_error:
+                    raise
+                results.append(e)
+        return results
+
+
+class FakeStreamRedis:
+    """
+    In-memory Redis Streams with consumer groups, as RedisStreamQueue uses
+    them. ``now`` is the clock, in milliseconds, entries idle against.
+    """
+
+    def __init__(self):
+        self.now = 0
+        self.ids = itertools.count(1)
+        self.streams = defaultdict(list)
+        self.groups = {}
+
+    def pipeline(self, transaction=True):
+        return FakePipeline(self)
+
+    def xadd(self, stream, fields, maxlen=None, approximate=True):
+        if stream == 'broken':
+            raise redis.ResponseError('WRONGTYPE Operation against a key holding the wrong kind of value')
+        entry_id = f'{next(self.ids)}-0'.encode()
+        self.streams[stream].append((entry_id, {key.encode(): value.encode() for key, value in fields.items()}))
+        if maxlen:
+            del self.streams[stream][:-maxlen]
+        return entry_id
+
+    def xgroup_create(self, stream, group, id='0', mkstream=False):
+        if (stream, group) in self.groups:
+            raise redis.ResponseError('BUSYGROUP Consumer Group name already exists')
+        self.groups[(stream, group)] = {'delivered': 0, 'pending': {}}
+
+    def xreadgroup(self, group, consumer, streams, count=None, block=None):
+        [(stream, offset)] = streams.items()
+        state = self.groups[(stream, group)]
+        entries = [
+            entry for entry in self.streams[stream] if int(entry[0].split(b'-')[0]) > state['delivered']
+        ][:count]
+        for entry_id, _ in entries:
+            state['delivered'] = int(entry_id.split(b'-')[0])
+            state['pending'][entry_id] = (consumer, self.now)
+        return [[stream.encode(), entries]] if entries else []
+
+    def xautoclaim(self, stream, group, consumer, min_idle_time, count=100):
+        # Like Redis 6.2, entries trimmed from the stream come back without fields
+        fields = dict(self.streams[stream])
+        pending = self.groups[(stream, group)]['pending']
+        claimed = [
+            entry_id for entry_id, (_, delivered_at) in pending.items() if self.now - delivered_at >= min_idle_time
+        ][:count]
+        for entry_id in claimed:
+            pending[entry_id] = (consumer, self.now)
+        return [b'0-0', [(entry_id, fields.get(entry_id)) for entry_id in claimed], []]
+
+    def xack(self, stream, group, *entry_ids):
+        pending = self.groups[(stream, group)]['pending']
+        return sum(pending.pop(entry_id, None) is not None for entry_id in entry_ids)
+
+
+class FakeAsyncRedis:
+    """The asyncio client of a FakeRedis; only pub/sub is used asynchronously."""
+
+    def __init__(self, client):
+        self.client = client
+
+    def pubsub(self):
+        return FakePubSub(self.client)
+
+    async def aclose(self):
+        pass
+
+
+class FakePubSub:
+
+    def __init__(self, client):
+        self.client = client
+        self.queue = asyncio.Queue()
+        self.channels = []
+
+    async def subscribe(self, *channels):
+        for channel in channels:
+            self.client.subscribers[channel].append((asyncio.get_running_loop(), self.queue))
+            self.channels.append(channel)
+
+    async def get_message(self, ignore_subscribe_messages=False, timeout=0.0):
+        try:
+            return await asyncio.wait_for(self.queue.get(), timeout)
+        except asyncio.TimeoutError:
+            return None
+
+    async def aclose(self):
+        for channel in self.channels:
+            self.client.subscribers[channel] = [
+                subscriber for subscriber in self.client.subscribers[channel] if subscriber[1] is not self.queue
+            ]
+
+
+def use_fake_redis(test):
+    """Point every Redis client of the app at one FakeRedis for the duration of a test."""
+    client = FakeRedis()
+    for module in (cache, credits, events, idempotency, previews, utils):
+        patcher = mock.patch.object(module, 'redis_client', return_value=client)
+        patcher.start()
+        test.addCleanup(patcher.stop)
+        if hasattr(module, 'async_redis_client'):
+            patcher = mock.patch.object(module, 'async_redis_client', side_effect=lambda: FakeAsyncRedis(client))
+            patcher.start()
+            test.addCleanup(patcher.stop)
+    return client
+
+
+def use_broken_redis(test):
+    """Make every Redis call of the app fail as if the server were down."""
+    for module in (cache, credits, events, idempotency, previews, utils):
+        patcher = mock.patch.object(module, 'redis_client', side_effect=redis.ConnectionError('Redis is down'))
+        patcher.start()
+        test.addCleanup(patcher.stop)
+
+
+class StoryReadQueryBudgetTests(TestCase):
+    """Story read endpoints must cost a fixed number of queries per page."""
+
+    def setUp(self):
+        self.client = APIClient()
+        self.user = User.objects.create_user(username='reader', email='reader@example.com', password='secret')
+        Credits.objects.create(user=self.user, credits_remaining=300)
+        self.client.force_authenticate(self.user)
+
+    def create_stories(self, story_count, scene_count):
+        stories = []
+        for i in range(story_count):
+            story = Story.objects.create(
+                title=f'Story {i}', content='once upon a time', author=self.user, is_public=True
+            )
+            for order in range(scene_count):
+                scene = Scene.objects.create(story=story, title=f'Scene {order}', content='text', order=order)
+                Media.objects.create(story=story, scene=scene, media_type='image', url='https://example.com/a.png')
+                Media.objects.create(story=story, scene=scene, media_type='audio', url='https://example.com/a.mp3')
+            stories.append(story)
+        return stories
+
+    def test_story_list_query_budget(self):
+        self.create_stories(2, 2)
+        # stories + author join, credits, scenes, media
+        with self.assertNumQueries(4):
+            small = self.client.get(reverse('story-list-create'))
+        self.create_stories(5, 6)
+        with self.assertNumQueries(4):
+            large = self.client.get(reverse('story-list-create'))
+        self.assertEqual(small.status_code, 200)
+        self.assertEqual(len(large.data['results']), 7)
+
+    def test_story_detail_query_budget(self):
+        story = self.create_stories(1, 8)[0]
+        # version (ETag) query + the four story read queries
+        with self.assertNumQueries(5):
+            response = self.client.get(reverse('story-detail', args=[story.id]))
+        self.assertEqual(len(response.data['scenes']), 8)
+        self.assertEqual(len(response.data['scenes'][0]['media']), 2)
+        self.assertEqual(response.data['author']['credits']['credits_remaining'], 300)
+
+    def test_public_story_list_query_budget(self):
+        self.create_stories(6, 5)
+        self.client.force_authenticate(None)
+        # count + the four story read queries
+        with self.assertNumQueries(5):
+            response = self.client.get(reverse('public-story-list'))
+        self.assertEqual(response.data['total_count'], 6)
+
+    def test_public_story_detail_query_budget(self):
+        story = self.create_stories(1, 10)[0]
+        self.client.force_authenticate(None)
+        with self.assertNumQueries(4):
+            response = self.client.get(reverse('public-story-detail', args=[story.id]))
+        self.assertEqual(len(response.data['scenes']), 10)
+
+    def test_inactive_scenes_and_media_are_excluded(self):
+        story = self.create_stories(1, 2)[0]
+        scene = story.scenes.first()
+        scene.media.filter(media_type='audio').update(is_active=False)
+        Scene.objects.create(story=story, title='Removed', content='gone', order=5, is_active=False)
+        response = self.client.get(reverse('story-detail', args=[story.id]))
+        self.assertEqual(len(response.data['scenes']), 2)
+        self.assertEqual(len(response.data['scenes'][0]['media']), 1)
+
+    def test_summary_view_skips_content_and_relations(self):
+        story = self.create_stories(3, 4)[0]
+        # stories with the cover image subquery, nothing else
+        with self.assertNumQueries(1):
+            response = self.client.get(reverse('story-list-create'), {'view': 'summary'})
+        card = next(item for item in response.data['results'] if item['id'] == story.id)
+        self.assertNotIn('content', card)
+        self.assertNotIn('scenes', card)
+        self.assertEqual(card['cover_image'], 'https://example.com/a.png')
+
+    def test_sparse_fields_and_include(self):
+        story = self.create_stories(1, 3)[0]
+        with self.assertNumQueries(3):
+            response = self.client.get(
+                reverse('story-detail', args=[story.id]),
+                {'fields': 'id,title', 'include': 'scenes'}
+            )
+        self.assertEqual(set(response.data), {'id', 'title', 'scenes'})
+        self.assertNotIn('media', response.data['scenes'][0])
+
+        response = self.client.get(reverse('story-detail', args=[story.id]), {'fields': 'id,title'})
+        self.assertEqual(set(response.data), {'id', 'title'})
+
+    def test_story_list_keyset_pagination(self):
+        stories = self.create_stories(5, 0)
+        # Identical timestamps must still page deterministically on id
+        Story.objects.update(created_at=stories[0].created_at)
+        seen = []
+        params = {'page_size': 2}
+        while True:
+            response = self.client.get(reverse('story-list-create'), params)
+            seen.extend(item['id'] for item in response.data['results'])
+            if not response.data['next_cursor']:
+                break
+            params['cursor'] = response.data['next_cursor']
+        self.assertEqual(seen, sorted((story.id for story in stories), reverse=True))
+
+    def test_story_list_rejects_invalid_cursor(self):
+        response = self.client.get(reverse('story-list-create'), {'cursor': 'not-a-cursor'})
+        self.assertEqual(response.status_code, 404)
+        # Valid JSON of the wrong types for the ordering fields
+        for values in ([[123], 'x'], [{'at': 1}, 1]):
+            cursor = base64.urlsafe_b64encode(json.dumps(values).encode()).decode()
+            response = self.client.get(reverse('story-list-create'), {'cursor': cursor})
+            self.assertEqual(response.status_code, 404)
+
+    def test_public_story_list_cursor_mode(self):
+        stories = self.create_stories(3, 1)
+        self.client.force_authenticate(None)
+        response = self.client.get(reverse('public-story-list'), {'pagination': 'cursor', 'page_size': 2})
+        self.assertEqual([item['id'] for item in response.data['results']], [stories[2].id, stories[1].id])
+        self.assertEqual(response.data['total_count'], 3)
+        response = self.client.get(reverse('public-story-list'), {'cursor': response.data['next_cursor'], 'page_size': 2})
+        self.assertEqual([item['id'] for item in response.data['results']], [stories[0].id])
+        self.assertIsNone(response.data['next_cursor'])
+
+
+    def test_story_detail_conditional_get(self):
+        story = self.create_stories(1, 3)[0]
+        url = reverse('story-detail', args=[story.id])
+        etag = self.client.get(url)['ETag']
+        self.assertTrue(etag.startswith('W/'))
+
+        with self.assertNumQueries(1):
+            response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+
+        # Deactivating media through a bulk update changes the version
+        Media.objects.filter(story=story, media_type='audio').update(is_active=False)
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+
+    def test_scene_list_and_current_revisions_conditional_get(self):
+        story = self.create_stories(1, 2)[0]
+        for name in ('scene-list-create', 'revision-current'):
+            url = reverse(name, args=[story.id])
+            etag = self.client.get(url)['ETag']
+            self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=etag).status_code, 304)
+        Scene.objects.create(story=story, title='New', content='more', order=9)
+        self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=etag).status_code, 200)
+
+
+class UserListTests(TestCase):
+
+    def test_user_list_is_paginated_in_one_query(self):
+        users = []
+        for i in range(5):
+            user = User.objects.create_user(username=f'user{i}', email=f'user{i}@example.com', password='secret')
+            Credits.objects.create(user=user, credits_remaining=100 + i)
+            users.append(user)
+        client = APIClient()
+        client.force_authenticate(users[0])
+        with self.assertNumQueries(1):
+            response = client.get(reverse('user-list-create'), {'page_size': 3})
+        self.assertEqual([item['id'] for item in response.data['results']], [user.id for user in users[:3]])
+        self.assertEqual(response.data['results'][1]['credits']['credits_remaining'], 101)
+        response = client.get(reverse('user-list-create'), {'cursor': response.data['next_cursor'], 'page_size': 3})
+        self.assertEqual([item['id'] for item in response.data['results']], [user.id for user in users[3:]])
+        self.assertIsNone(response.data['next_cursor'])
+
+
+@skipUnless(connection.vendor == 'postgresql', 'full-text search requires PostgreSQL')
+class PublicStorySearchTests(TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create_user(username='writer', email='writer@example.com', password='secret')
+
+    def test_title_matches_rank_above_content_matches(self):
+        in_content = Story.objects.create(title='A quiet night', content='the dragon slept', author=self.user, is_public=True)
+        in_title = Story.objects.create(title='The dragon', content='it slept', author=self.user, is_public=True)
+        Story.objects.create(title='Unrelated', content='nothing here', author=self.user, is_public=True)
+        response = APIClient().get(reverse('public-story-list'), {'search': 'dragon'})
+        self.assertEqual([item['id'] for item in response.data['results']], [in_title.id, in_content.id])
+
+    def test_search_vector_follows_edits(self):
+        story = Story.objects.create(title='Draft', content='empty', author=self.user, is_public=True)
+        story.content = 'a tale about lighthouses'
+        story.save()
+        self.assertEqual(list(Story.objects.search('lighthouses')), [story])
+
+
+class PublicCacheTests(TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create_user(username='writer', email='writer@example.com', password='secret')
+        self.story = Story.objects.create(title='Cached', content='text', author=self.user, is_public=True)
+        self.url = reverse('public-story-detail', args=[self.story.id])
+
+    def test_public_story_is_cached_until_it_changes(self):
+        use_fake_redis(self)
+        self.assertEqual(APIClient().get(self.url).data['title'], 'Cached')
+        with self.assertNumQueries(0):
+            self.assertEqual(APIClient().get(self.url).data['title'], 'Cached')
+
+        self.story.title = 'Renamed'
+        with self.captureOnCommitCallbacks(execute=True):
+            self.story.save()
+        self.assertEqual(APIClient().get(self.url).data['title'], 'Renamed')
+
+    def test_concurrent_miss_waits_for_the_filling_request(self):
+        client = use_fake_redis(self)
+        client.set('public:key:lock', 1)
+        compute = mock.Mock(return_value={'filled': 'here'})
+
+        def fill(seconds):
+            client.set('public:key', json.dumps({'filled': 'elsewhere'}))
+
+        with mock.patch.object(cache.time, 'sleep', side_effect=fill):
+            self.assertEqual(cache.get_or_compute('public:key', compute), {'filled': 'elsewhere'})
+        compute.assert_not_called()
+
+    def test_unfilled_entry_is_computed_once(self):
+        client = use_fake_redis(self)
+        client.set('public:key:lock', 1)
+        compute = mock.Mock(side_effect=Http404)
+        with mock.patch.object(cache, 'FILL_WAIT', 0), self.assertRaises(Http404):
+            cache.get_or_compute('public:key', compute)
+        self.assertEqual(compute.call_count, 1)
+
+    def test_redis_down_falls_back_to_the_database(self):
+        use_broken_redis(self)
+        self.assertEqual(APIClient().get(self.url).data['title'], 'Cached')
+        compute = mock.Mock(side_effect=Http404)
+        with self.assertRaises(Http404):
+            cache.get_or_compute('public:key', compute)
+        self.assertEqual(compute.call_count, 1)
+        Story.objects.filter(pk=self.story.id).update(is_public=False)
+        self.assertEqual(APIClient().get(self.url).status_code, 404)
+
+
+class CreditBalanceTests(TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create_user(username='writer', email='writer@example.com', password='secret')
+        self.credits = Credits.objects.create(user=self.user, credits_remaining=300)
+
+    def change_balance(self, credits_remaining):
+        Credits.objects.filter(pk=self.credits.pk).update(credits_remaining=credits_remaining)
+        with self.captureOnCommitCallbacks(execute=True):
+            credits.invalidate_credit_balance(self.user.id)
+
+    def test_balance_is_cached_until_it_changes(self):
+        use_fake_redis(self)
+        self.assertEqual(credits.get_credit_balance(self.user.id)['credits_remaining'], 300)
+        with self.assertNumQueries(0):
+            self.assertEqual(credits.get_credit_balance(self.user.id)['credits_remaining'], 300)
+        self.change_balance(250)
+        self.assertEqual(credits.get_credit_balance(self.user.id)['credits_remaining'], 250)
+
+    def test_read_overlapping_a_change_does_not_cache_a_stale_balance(self):
+        use_fake_redis(self)
+        balance_data = credits.credit_balance_data
+
+        def change_meanwhile(row):
+            # The row was loaded before this change committed
+            self.change_balance(100)
+            return balance_data(row)
+
+        with mock.patch.object(credits, 'credit_balance_data', side_effect=change_meanwhile):
+            self.assertEqual(credits.get_credit_balance(self.user.id)['credits_remaining'], 300)
+        self.assertEqual(credits.get_credit_balance(self.user.id)['credits_remaining'], 100)
+
+    def test_redis_down_reads_the_database(self):
+        use_broken_redis(self)
+        self.change_balance(42)
+        self.assertEqual(credits.get_credit_balance(self.user.id)['credits_remaining'], 42)
+        Credits.objects.all().delete()
+        self.assertEqual(credits.get_credit_balance(self.user.id), credits.EMPTY_BALANCE)
+
+
+@skipUnless(connection.vendor == 'postgresql', 'EXPLAIN output is PostgreSQL specific')
+class RevisionIndexTests(TestCase):
+    """Each revision access path must be answered from its partial index."""
+
+    def setUp(self):
+        self.user = User.objects.create_user(username='writer', email='writer@example.com', password='secret')
+        self.story = Story.objects.create(title='Indexed', content='text', author=self.user, is_public=True)
+        for format in ('pdf', 'audio', 'mp4'):
+            Revision.objects.create(story=self.story, format=format, url=f'https://example.com/r.{format}')
+
+    def assertUsesIndex(self, queryset, index_name):
+        with transaction.atomic(), connection.cursor() as cursor:
+            # Tiny test tables would otherwise always be sequentially scanned
+            cursor.execute('SET LOCAL enable_seqscan = off')
+            plan = queryset.explain()
+        self.assertIn(index_name, plan)
+
+    def test_access_paths_use_their_indexes(self):
+        revisions = Revision.objects.filter(story_id=self.story.id)
+        self.assertUsesIndex(
+            revisions.filter(format='pdf', is_active=True, deleted_at=None).order_by('-created_at')[:1],
+            'revision_active_format_idx'
+        )
+        self.assertUsesIndex(revisions.filter(is_current=True, url__isnull=False), 'revision_current_idx')
+        self.assertUsesIndex(
+            revisions.filter(deleted_at__isnull=True, url__isnull=False).order_by('-created_at'),
+            'revision_live_created_idx'
+        )
+        self.assertUsesIndex(
+            Revision.objects.filter(story__author=self.user, deleted_at__isnull=True).order_by('-created_at', '-id'),
+            'revision_live_created_idx'
+        )
+        self.assertUsesIndex(revisions, 'revision_history_idx')
+        self.assertUsesIndex(revisions.filter(format='pdf'), 'revision_history_idx')
+
+
+class StoryCounterTests(TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create_user(username='writer', email='writer@example.com', password='secret')
+        self.story = Story.objects.create(title='Counted', content='text', author=self.user)
+
+    def test_counters_follow_scene_and_media_writes(self):
+        first = Scene.objects.create(story=self.story, title='One', content='a', order=1)
+        second = Scene.objects.create(story=self.story, title='Two', content='b', order=2)
+        Media.objects.create(story=self.story, scene=first, media_type='image', url='https://example.com/1.png')
+        Media.objects.create(story=self.story, scene=first, media_type='image', url='https://example.com/2.png')
+        Media.objects.create(story=self.story, scene=second, media_type='audio', url='https://example.com/2.mp3')
+        self.story.refresh_from_db()
+        self.assertEqual(
+            (self.story.active_scene_count, self.story.image_ready_scene_count, self.story.audio_ready_scene_count),
+            (2, 1, 1)
+        )
+        self.assertFalse(self.story.is_media_ready('image'))
+
+        second.is_active = False
+        second.save()
+        self.story.refresh_from_db()
+        self.assertEqual(self.story.active_scene_count, 1)
+        self.assertEqual(self.story.audio_ready_scene_count, 0)
+        self.assertTrue(self.story.is_media_ready('image'))
+
+    def test_repair_command_fixes_drift(self):
+        scene = Scene.objects.create(story=self.story, title='One', content='a', order=1)
+        Media.objects.create(story=self.story, scene=scene, media_type='image', url='https://example.com/1.png')
+        Story.objects.filter(pk=self.story.pk).update(active_scene_count=7, image_ready_scene_count=0)
+        call_command('recompute_story_counters', stdout=StringIO())
+        self.story.refresh_from_db()
+        self.assertEqual((self.story.active_scene_count, self.story.image_ready_scene_count), (1, 1))
+
+
+@override_settings(AWS_S3_REGION_NAME='us-east-1')
+class AwsClientRegistryTests(TestCase):
+
+    def setUp(self):
+        utils._reset_aws_clients()
+        self.addCleanup(utils._reset_aws_clients)
+
+    def test_clients_are_shared_per_service(self):
+        sqs = utils.aws_client('sqs')
+        self.assertIs(utils.aws_client('sqs'), sqs)
+        self.assertIsNot(utils.aws_client('s3'), sqs)
+        self.assertEqual(sqs.meta.config.max_pool_connections, utils.AWS_CLIENT_CONFIG.max_pool_connections)
+
+    def test_forked_children_build_their_own_clients(self):
+        sqs = utils.aws_client('sqs')
+        utils._reset_aws_clients()
+        self.assertIsNot(utils.aws_client('sqs'), sqs)
+
+    def test_messages_are_batched_with_per_entry_failures(self):
+        messages = [{'scene_id': index} for index in range(12)]
+        with Stubber(utils.aws_client('sqs')) as stubber:
+            stubber.add_response('send_message_batch', {
+                'Successful': [
+                    {'Id': str(index), 'MessageId': f'm{index}', 'MD5OfMessageBody': 'x'}
+                    for index in range(10) if index != 3
+                ],
+                'Failed': [{'Id': '3', 'SenderFault': False, 'Code': 'InternalError', 'Message': 'try again'}],
+            })
+            stubber.add_client_error('send_message_batch', service_error_code='AccessDenied')
+            sent, failed = utils.send_messages_to_sqs(messages, queue_url='https://sqs.example.com/queue')
+        self.assertEqual([index for index, _ in sent], [0, 1, 2, 4, 5, 6, 7, 8, 9])
+        self.assertEqual(sent[0], (0, 'm0'))
+        self.assertEqual([index for index, _ in failed], [3, 10, 11])
+
+
+@override_settings(AWS_S3_REGION_NAME='us-east-1', WHISPR_TALES_QUEUE_URL='https://sqs.example.com/queue')
+class OutboxTests(TestCase):
+
+    def setUp(self):
+        utils._reset_aws_clients()
+        self.addCleanup(utils._reset_aws_clients)
+        self.user = User.objects.create_user(username='writer', email='writer@example.com', password='secret')
+
+    def create_job(self):
+        return Job.objects.create(job_type='generate_pdf_preview', user=self.user, request_data={'action': 'preview'})
+
+    def test_rolled_back_jobs_leave_no_message(self):
+        try:
+            with transaction.atomic():
+                enqueue_job(self.create_job(), {'action': 'preview'})
+                raise RuntimeError
+        except RuntimeError:
+            pass
+        self.assertFalse(OutboxMessage.objects.exists())
+
+    def test_relay_sends_pending_messages_and_stamps_jobs(self):
+        jobs = [self.create_job() for _ in range(2)]
+        for job in jobs:
+            enqueue_job(job, {'action': 'preview'})
+        with Stubber(utils.aws_client('sqs')) as stubber:
+            stubber.add_response('send_message_batch', {
+                'Successful': [{'Id': '0', 'MessageId': 'sent-0', 'MD5OfMessageBody': 'x'}],
+                'Failed': [{'Id': '1', 'SenderFault': False, 'Code': 'InternalError', 'Message': 'try again'}],
+            })
+            self.assertEqual(relay_batch(), (1, 1))
+        jobs[0].refresh_from_db()
+        self.assertEqual(jobs[0].message_id, 'sent-0')
+        self.assertEqual(OutboxMessage.objects.get(job=jobs[0]).body['job_id'], str(jobs[0].id))
+        pending = OutboxMessage.objects.get(sent_at__isnull=True)
+        self.assertEqual((pending.job_id, pending.attempts, pending.last_error), (jobs[1].id, 1, 'try again'))
+
+    @override_settings(JOB_QUEUE_BACKEND='memory')
+    def test_failed_sends_back_off_and_dead_letter(self):
+        job = self.create_job()
+        message = enqueue_job(job, {'action': 'preview'})
+        queue = get_queue(job.queue_lane)
+        with mock.patch.object(type(queue), 'send_batch', return_value=([], [(0, 'queue down')])):
+            self.assertEqual(relay_batch(), (0, 1))
+            message.refresh_from_db()
+            self.assertGreater(message.next_attempt_at, timezone.now())
+            # Not due yet, so the next pass leaves it alone
+            self.assertEqual(relay_batch(), (0, 0))
+
+            for attempt in range(2, OUTBOX_MAX_ATTEMPTS + 1):
+                OutboxMessage.objects.filter(pk=message.pk).update(next_attempt_at=timezone.now())
+                self.assertEqual(relay_batch(), (0, 1))
+        message.refresh_from_db()
+        job.refresh_from_db()
+        self.assertEqual(message.attempts, OUTBOX_MAX_ATTEMPTS)
+        self.assertIsNotNone(message.dead_lettered_at)
+        self.assertEqual(job.status, 'failed')
+        OutboxMessage.objects.filter(pk=message.pk).update(next_attempt_at=timezone.now())
+        self.assertEqual(relay_batch(), (0, 0))
+
+
+class MemoryQueueTests(TestCase):
+
+    def test_incomplete_backends_cannot_be_instantiated(self):
+        class SendOnlyQueue(QueueBackend):
+            def send_batch(self, bodies):
+                return [], []
+
+        with self.assertRaises(TypeError):
+            SendOnlyQueue()
+
+    def test_consumer_groups_receive_each_message_until_acked(self):
+        queue = MemoryQueue()
+        sent, failed = queue.send_batch([{'job_id': '1'}, {'job_id': '2'}, {'job_id': '3'}])
+        self.assertEqual((len(sent), failed), (3, []))
+
+        first = queue.receive('workers', 'worker-1', max_messages=2)
+        second = queue.receive('workers', 'worker-2', max_messages=2)
+        self.assertEqual([message.body['job_id'] for message in first + second], ['1', '2', '3'])
+        # Another group gets its own copy of the stream
+        self.assertEqual(len(queue.receive('audit', 'auditor', max_messages=10)), 3)
+
+        queue.ack('workers', first)
+        self.assertEqual(list(queue.groups['workers']['pending']), [second[0].receipt])
+
+    @override_settings(JOB_QUEUE_BACKEND='memory')
+    def test_outbox_relays_to_configured_backend(self):
+        user = User.objects.create_user(username='writer', email='writer@example.com', password='secret')
+        job = Job.objects.create(job_type='generate_pdf_preview', user=user, request_data={})
+        enqueue_job(job, {'action': 'preview'})
+        queue = get_queue('preview')
+        queue.receive('workers', 'drain', max_messages=1000)
+        self.assertEqual(relay_batch(), (1, 0))
+        job.refresh_from_db()
+        [message] = queue.receive('workers', 'worker-1')
+        self.assertEqual(message.id, job.message_id)
+        self.assertEqual(message.body['job_id'], str(job.id))
+
+
+class RedisStreamQueueTests(TestCase):
+
+    def setUp(self):
+        self.redis = FakeStreamRedis()
+        patcher = mock.patch.object(queues, 'redis_client', return_value=self.redis)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.queue = RedisStreamQueue(stream='jobs', maxlen=100, visibility_timeout=300)
+
+    def test_consumer_groups_receive_each_message_until_acked(self):
+        sent, failed = self.queue.send_batch([{'job_id': '1'}, {'job_id': '2'}, {'job_id': '3'}])
+        self.assertEqual((sent, failed), ([(0, '1-0'), (1, '2-0'), (2, '3-0')], []))
+        self.assertEqual(self.queue.send({'job_id': '4'}), '4-0')
+
+        first = self.queue.receive('workers', 'worker-1', max_messages=2)
+        # The group exists by now, so this receive goes through the BUSYGROUP path
+        second = self.queue.receive('workers', 'worker-2', max_messages=5)
+        self.assertEqual([message.body['job_id'] for message in first + second], ['1', '2', '3', '4'])
+        self.assertEqual(first[0].id, '1-0')
+        self.assertEqual(self.queue.receive('workers', 'worker-3'), [])
+        # Another group gets its own copy of the stream
+        self.assertEqual(len(self.queue.receive('audit', 'auditor', max_messages=10)), 4)
+
+        self.queue.ack('workers', first)
+        self.assertEqual(list(self.redis.groups[('jobs', 'workers')]['pending']), [b'3-0', b'4-0'])
+
+    def test_sends_are_trimmed_to_maxlen_and_fail_per_entry(self):
+        RedisStreamQueue(stream='jobs', maxlen=2).send_batch([{'job_id': str(i)} for i in range(5)])
+        self.assertEqual([entry_id for entry_id, _ in self.redis.streams['jobs']], [b'4-0', b'5-0'])
+
+        sent, failed = RedisStreamQueue(stream='broken', maxlen=2).send_batch([{'job_id': '1'}])
+        self.assertEqual(sent, [])
+        self.assertIn('WRONGTYPE', failed[0][1])
+
+    def test_stale_pending_entries_are_redelivered(self):
+        self.queue.send_batch([{'job_id': '1'}])
+        [message] = self.queue.receive('workers', 'worker-1')
+
+        self.redis.now += 299 * 1000
+        self.assertEqual(self.queue.receive('workers', 'worker-2'), [])
+        self.redis.now += 1000
+        [redelivered] = self.queue.receive('workers', 'worker-2')
+        self.assertEqual((redelivered.id, redelivered.body), (message.id, message.body))
+
+        self.queue.ack('workers', [redelivered])
+        self.redis.now += 300 * 1000
+        self.assertEqual(self.queue.receive('workers', 'worker-3'), [])
+
+    def test_trimmed_pending_entries_are_dropped(self):
+        queue = RedisStreamQueue(stream='jobs', maxlen=1, visibility_timeout=1)
+        queue.send_batch([{'job_id': '1'}])
+        queue.receive('workers', 'worker-1')
+        queue.send_batch([{'job_id': '2'}])
+        self.redis.now += 1000
+        self.assertEqual([message.body['job_id'] for message in queue.receive('workers', 'worker-2')], ['2'])
+        self.assertEqual(list(self.redis.groups[('jobs', 'workers')]['pending']), [b'2-0'])
+
+    def test_other_group_errors_are_raised(self):
+        with mock.patch.object(self.redis, 'xgroup_create', side_effect=redis.ResponseError('NOPERM')):
+            with self.assertRaises(redis.ResponseError):
+                self.queue.receive('workers', 'worker-1')
+
+
+class IdempotencyKeyTests(TestCase):
+
+    def post(self, data, **headers):
+        return RequestFactory().post(
+            '/api/stories/1/scenes/2/generate-audio/', data, content_type='application/json', headers=headers
+        )
+
+    def test_fingerprint_ignores_key_order(self):
+        first = request_fingerprint(self.post('{"voice_id": "v1", "speed": 1}'))
+        self.assertEqual(first, request_fingerprint(self.post('{"speed": 1, "voice_id": "v1"}')))
+        self.assertNotEqual(first, request_fingerprint(self.post('{"speed": 1, "voice_id": "v2"}')))
+
+    def test_idempotency_key_header_takes_precedence(self):
+        request = self.post('{}', **{'Idempotency-Key': 'click-1'})
+        fingerprint = request_fingerprint(request)
+        self.assertIn(':key:', submission_key(7, request, fingerprint))
+        self.assertEqual(submission_key(7, self.post('{}'), fingerprint), f'idempotency:7:fp:{fingerprint}')
+
+    @override_settings(JOB_QUEUE_BACKEND='memory')
+    def test_repeated_submission_replays_the_job_through_the_middleware(self):
+        client = use_fake_redis(self)
+        patcher = mock.patch('core.middleware.redis_client', client)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        user = User.objects.create_user(username='writer', email='writer@example.com', password='secret')
+        credits = Credits.objects.create(user=user, credits_remaining=300)
+        story = Story.objects.create(title='Once', content='text', author=user)
+        scene = Scene.objects.create(story=story, title='One', content='a', order=1)
+        api = APIClient()
+        api.credentials(HTTP_AUTHORIZATION=f'Bearer {AccessToken.for_user(user)}')
+        url = reverse('scene-generate-image', args=[story.id, scene.id])
+
+        first = api.post(url, {}, format='json')
+        self.assertEqual(first.status_code, 200)
+        transactions = CreditTransaction.objects.count()
+        replay = api.post(url, {}, format='json')
+        self.assertEqual(replay['Idempotent-Replayed'], 'true')
+        self.assertEqual(replay.json()['id'], first.data['id'])
+        self.assertEqual(Job.objects.count(), 1)
+        self.assertEqual(OutboxMessage.objects.count(), 1)
+        self.assertEqual(CreditTransaction.objects.count(), transactions)
+        credits.refresh_from_db()
+        self.assertEqual(credits.credits_remaining, 300 - math.ceil(CREDIT_COSTS['image']))
+        # Without an Idempotency-Key only a double submit is coalesced
+        self.assertEqual(client.ttls[submission_key(user.id, first.wsgi_request, request_fingerprint(first.wsgi_request))], idempotency.DUPLICATE_SUBMISSION_TTL)
+
+        other = Scene.objects.create(story=story, title='Two', content='b', order=2)
+        keyed = api.post(
+            reverse('scene-generate-image', args=[story.id, other.id]), {}, format='json', HTTP_IDEMPOTENCY_KEY='click-1'
+        )
+        self.assertEqual(keyed.status_code, 200)
+        key = submission_key(user.id, keyed.wsgi_request, request_fingerprint(keyed.wsgi_request))
+        self.assertEqual(client.ttls[key], idempotency.IDEMPOTENCY_TTL)
+
+
+@override_settings(JOB_QUEUE_BACKEND='memory')
+class BulkGenerationTests(TestCase):
+
+    def test_bulk_image_creates_parent_and_child_jobs(self):
+        user = User.objects.create_user(username='writer', email='writer@example.com', password='secret')
+        story = Story.objects.create(title='Bulk', content='text', author=user)
+        scenes = [Scene.objects.create(story=story, title=f'Scene {i}', content='a', order=i) for i in range(12)]
+        Scene.objects.create(story=story, title='Removed', content='a', order=99, is_active=False)
+        credit_transaction = CreditTransaction.objects.create(user=user, credits_used=120, transaction_type='debit')
+
+        url = reverse('story-generate-bulk-image', args=[story.id])
+        request = APIRequestFactory().post(url, {}, format='json')
+        request.resolver_match = resolve(url)
+        # Set by CreditDeductionMiddleware in the real request cycle
+        request.credit_transaction = credit_transaction
+        force_authenticate(request, user=user)
+        get_queue('batch').receive('workers', 'drain', max_messages=1000)
+        # story, scene ids, parent insert, children bulk insert, children request data
+        # update, outbox insert, media update, counter lock and refresh (plus a savepoint pair)
+        with self.assertNumQueries(11):
+            response = StoryDetailAPIView.as_view()(request, pk=story.id)
+
+        self.assertEqual(response.status_code, 200)
+        parent = Job.objects.get(pk=response.data['job_id'])
+        children = list(parent.children.order_by('scene__order'))
+        self.assertEqual([child.scene_id for child in children], [scene.id for scene in scenes])
+        self.assertEqual({child.credit_transaction_id for child in children}, {credit_transaction.id})
+        self.assertEqual({child.queue_lane for child in children}, {Job.LANE_BATCH})
+        # The spend is carried by the children only, so it is counted once
+        self.assertEqual(parent.credit_cost, 0)
+        self.assertEqual(sum(child.credit_cost for child in children), credit_transaction.credits_used)
+        # Nothing is sent until the outbox is relayed
+        self.assertEqual(OutboxMessage.objects.filter(job__parent=parent, sent_at=None).count(), 12)
+        self.assertEqual(get_queue('batch').receive('workers', 'worker-1', max_messages=20), [])
+        self.assertEqual(relay_batch(), (12, 0))
+        for child in children:
+            child.refresh_from_db()
+        messages = get_queue('batch').receive('workers', 'worker-1', max_messages=20)
+        self.assertEqual(sorted(message.id for message in messages), sorted(child.message_id for child in children))
+        self.assertEqual(messages[0].body['job_id'], str(children[0].id))
+
+    def test_bulk_generation_needs_active_scenes(self):
+        user = User.objects.create_user(username='writer', email='writer@example.com', password='secret')
+        story = Story.objects.create(title='Empty', content='text', author=user)
+        url = reverse('story-generate-bulk-image', args=[story.id])
+        request = APIRequestFactory().post(url, {}, format='json')
+        request.resolver_match = resolve(url)
+        force_authenticate(request, user=user)
+        response = StoryDetailAPIView.as_view()(request, pk=story.id)
+        self.assertEqual(response.status_code, 400)
+        self.assertFalse(Job.objects.exists())
+
+    def create_bulk(self, user, scene_count):
+        story = Story.objects.create(title='Bulk', content='text', author=user)
+        parent = Job.objects.create(job_type='generate_bulk_media', user=user, story=story, request_data={})
+        children = Job.objects.bulk_create([
+            Job(
+                job_type='generate_media', user=user, story=story, parent=parent, request_data={},
+                scene=Scene.objects.create(story=story, title=f'Scene {order}', content='a', order=order)
+            )
+            for order in range(scene_count)
+        ])
+        enqueue_jobs(children)
+        return parent, children
+
+    def test_cancelling_a_parent_cancels_its_children(self):
+        user = User.objects.create_user(username='writer', email='writer@example.com', password='secret')
+        parent, children = self.create_bulk(user, 2)
+        Job.objects.filter(pk=children[0].pk).update(status='completed')
+        client = APIClient()
+        client.force_authenticate(user)
+        response = client.post(reverse('job-cancel', args=[parent.id]))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(
+            list(Job.objects.filter(parent=parent).order_by('id').values_list('status', flat=True)),
+            ['completed', 'cancelled']
+        )
+        # Nothing is sent for the cancelled child
+        self.assertEqual(relay_batch(), (1, 0))
+
+    def test_cancelled_and_dead_lettered_children_finish_the_parent(self):
+        user = User.objects.create_user(username='writer', email='writer@example.com', password='secret')
+        parent, children = self.create_bulk(user, 2)
+        client = APIClient()
+        client.force_authenticate(user)
+        client.post(reverse('job-cancel', args=[children[0].id]))
+        parent.refresh_from_db()
+        self.assertEqual(parent.status, 'pending')
+
+        queue = get_queue(Job.LANE_INTERACTIVE)
+        with mock.patch.object(type(queue), 'send_batch', return_value=([], [(0, 'queue down')])):
+            for attempt in range(OUTBOX_MAX_ATTEMPTS):
+                OutboxMessage.objects.update(next_attempt_at=timezone.now())
+                self.assertEqual(relay_batch(), (0, 1))
+        parent.refresh_from_db()
+        self.assertEqual(
+            (parent.status, parent.response_data), ('failed', {'completed': 0, 'failed': 1, 'cancelled': 1})
+        )
+
+    @override_settings(JOB_QUEUE_BACKEND='memory', WORKER_API_TOKEN='worker-secret')
+    def test_bulk_audio_only_synthesizes_changed_scenes(self):
+        user = User.objects.create_user(username='narrator', email='narrator@example.com', password='secret')
+        story = Story.objects.create(title='Narrated', content='text', author=user)
+        unchanged, edited, new = [
+            Scene.objects.create(story=story, title=f'Scene {i}', content=f'text {i}', order=i) for i in range(3)
+        ]
+        kept = Media.objects.create(
+            story=story, scene=unchanged, media_type='audio', url='https://example.com/0.mp3',
+            fingerprint=scene_audio_fingerprint(unchanged.content, 'voice-1', user.language)
+        )
+        replaced = Media.objects.create(
+            story=story, scene=edited, media_type='audio', url='https://example.com/1.mp3',
+            fingerprint=scene_audio_fingerprint('old text', 'voice-1', user.language)
+        )
+
+        plan = plan_story_audio(story.id, 'voice-1', user.language)
+        self.assertEqual([scene['media_id'] for scene in plan], [kept.id, None, None])
+        self.assertEqual(sum(scene['credit_cost'] for scene in plan), 2 * math.ceil(CREDIT_COSTS['audio'] * 6))
+
+        url = reverse('story-generate-bulk-audio', args=[story.id])
+        request = APIRequestFactory().post(url, {'voice_id': 'voice-1'}, format='json')
+        request.resolver_match = resolve(url)
+        force_authenticate(request, user=user)
+        response = StoryDetailAPIView.as_view()(request, pk=story.id)
+
+        self.assertEqual(response.data['synthesized_scene_ids'], [edited.id, new.id])
+        job = Job.objects.get(pk=response.data['job_id'])
+        self.assertEqual(job.request_data['scenes'][0]['url'], 'https://example.com/0.mp3')
+        kept.refresh_from_db()
+        replaced.refresh_from_db()
+        self.assertEqual((kept.is_active, replaced.is_active), (True, False))
+
+        # The worker reports one segment per synthesized scene
+        worker = APIClient()
+        worker.credentials(HTTP_AUTHORIZATION='Worker worker-secret')
+        response = worker.post(reverse('job-completion'), {'events': [{
+            'job_id': job.id, 'status': 'completed', 'media': [
+                {'scene_id': edited.id, 'url': 'https://example.com/1b.mp3'},
+                {'scene_id': new.id, 'url': 'https://example.com/2.mp3'},
+                # Reused as is, so not recorded again
+                {'scene_id': unchanged.id, 'url': 'https://example.com/0b.mp3'},
+            ]
+        }]}, format='json')
+        self.assertEqual(response.status_code, 200)
+        synthesized = Media.objects.filter(story=story, is_active=True, media_type='audio').exclude(pk=kept.pk)
+        self.assertEqual(
+            sorted(synthesized.values_list('scene_id', 'fingerprint')),
+            sorted([
+                (edited.id, scene_audio_fingerprint(edited.content, 'voice-1', user.language)),
+                (new.id, scene_audio_fingerprint(new.content, 'voice-1', user.language)),
+            ])
+        )
+        story.refresh_from_db()
+        self.assertEqual(story.audio_ready_scene_count, 3)
+
+        # With every scene's audio current nothing is queued
+        request = APIRequestFactory().post(url, {'voice_id': 'voice-1'}, format='json')
+        request.resolver_match = resolve(url)
+        force_authenticate(request, user=user)
+        response = StoryDetailAPIView.as_view()(request, pk=story.id)
+        self.assertNotIn('job_id', response.data)
+        self.assertEqual(Job.objects.count(), 1)
+
+
+    @override_settings(JOB_QUEUE_BACKEND='memory')
+    def test_form_encoded_bulk_audio_is_charged_for_the_plan_it_queues(self):
+        fake = use_fake_redis(self)
+        patcher = mock.patch('core.middleware.redis_client', fake)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        user = User.objects.create_user(username='narrator', email='narrator@example.com', password='secret')
+        credits = Credits.objects.create(user=user, credits_remaining=300)
+        story = Story.objects.create(title='Narrated', content='text', author=user)
+        unchanged, edited = [
+            Scene.objects.create(story=story, title=f'Scene {i}', content=f'text {i}', order=i) for i in range(2)
+        ]
+        Media.objects.create(
+            story=story, scene=unchanged, media_type='audio', url='https://example.com/0.mp3',
+            fingerprint=scene_audio_fingerprint(unchanged.content, 'voice-1', user.language)
+        )
+        api = APIClient()
+        api.credentials(HTTP_AUTHORIZATION=f'Bearer {AccessToken.for_user(user)}')
+
+        response = api.post(reverse('story-generate-bulk-audio', args=[story.id]), {'voice_id': 'voice-1'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['synthesized_scene_ids'], [edited.id])
+        job = Job.objects.get(pk=response.data['job_id'])
+        self.assertEqual(job.request_data['voice_id'], 'voice-1')
+        credits.refresh_from_db()
+        self.assertEqual(credits.credits_remaining, 300 - math.ceil(CREDIT_COSTS['audio'] * len(edited.content)))
+        self.assertEqual(job.credit_cost, 300 - credits.credits_remaining)
+
+
+class QueueLaneTests(TestCase):
+
+    def test_jobs_are_routed_by_type_and_size(self):
+        self.assertEqual(Job.lane_for('generate_media'), Job.LANE_INTERACTIVE)
+        self.assertEqual(Job.lane_for('generate_media', is_child=True), Job.LANE_BATCH)
+        self.assertEqual(Job.lane_for('generate_entire_audio'), Job.LANE_BATCH)
+        self.assertEqual(Job.lane_for('generate_pdf_preview', scene_count=5), Job.LANE_PREVIEW)
+        with override_settings(JOB_LANE_MAX_PREVIEW_SCENES=10):
+            self.assertEqual(Job.lane_for('generate_pdf_preview', scene_count=11), Job.LANE_BATCH)
+
+        user = User.objects.create_user(username='writer', email='writer@example.com', password='secret')
+        job = Job.objects.create(job_type='generate_entire_audio', user=user, request_data={})
+        self.assertEqual(job.queue_lane, Job.LANE_BATCH)
+
+        job.mark_as_processing()
+        out = StringIO()
+        call_command('job_lane_stats', stdout=out)
+        self.assertIn('Batch: 1 jobs', out.getvalue())
+
+    @override_settings(JOB_QUEUE_BACKEND='memory')
+    def test_lanes_are_consumed_by_weight(self):
+        lanes = {'interactive': {'weight': 3}, 'batch': {'weight': 1}}
+        for lane in lanes:
+            queue = get_queue(lane)
+            queue.receive('weighted', 'drain', max_messages=1000)
+            queue.send_batch([{'lane': lane}] * 20)
+
+        consumer = LaneConsumer('weighted', 'worker-1', lanes=lanes)
+        served = [consumer.receive(max_messages=1)[0] for _ in range(8)]
+        self.assertEqual(served.count('interactive'), 6)
+        self.assertEqual(served.count('batch'), 2)
+
+        # An empty lane gives its turns to the others
+        get_queue('interactive').receive('weighted', 'drain', max_messages=1000)
+        self.assertEqual(consumer.receive(max_messages=1)[0], 'batch')
+
+
+@override_settings(JOB_QUEUE_BACKEND='memory')
+class RetrySchedulerTests(TestCase):
+
+    def test_due_retries_are_dispatched_once(self):
+        user = User.objects.create_user(username='writer', email='writer@example.com', password='secret')
+        due = Job.objects.create(job_type='generate_media', user=user, request_data={'action': 'generate_media'}, status='failed')
+        later = Job.objects.create(job_type='generate_media', user=user, request_data={}, status='failed')
+        self.assertTrue(due.schedule_retry())
+        self.assertTrue(later.schedule_retry())
+        Job.objects.filter(pk=due.pk).update(next_retry_at=timezone.now() - timedelta(seconds=1))
+
+        get_queue('interactive').receive('workers', 'drain', max_messages=1000)
+        call_command('dispatch_retries', '--once', stdout=StringIO())
+        self.assertEqual(enqueue_due_retries(), 0)
+
+        due.refresh_from_db()
+        self.assertIsNone(due.next_retry_at)
+        self.assertIsNotNone(due.message_id)
+        [message] = get_queue('interactive').receive('workers', 'worker-1')
+        self.assertEqual(message.body['job_id'], str(due.id))
+        later.refresh_from_db()
+        self.assertIsNotNone(later.next_retry_at)
+
+    def test_immediate_retry_is_not_rescheduled(self):
+        user = User.objects.create_user(username='writer', email='writer@example.com', password='secret')
+        job = Job.objects.create(job_type='generate_media', user=user, request_data={}, status='failed')
+        self.assertTrue(job.schedule_retry(immediate=True))
+        self.assertEqual((job.status, job.retry_count, job.next_retry_at), ('pending', 1, None))
+
+
+class JobEventStreamTests(TestCase):
+
+    async def test_stream_requires_a_valid_token(self):
+        response = await self.async_client.get(reverse('job-events'), {'token': 'not-a-token'})
+        self.assertEqual(response.status_code, 401)
+
+    async def test_story_stream_requires_ownership(self):
+        owner = await User.objects.acreate(username='owner', email='owner@example.com')
+        other = await User.objects.acreate(username='other', email='other@example.com')
+        story = await Story.objects.acreate(title='Mine', content='text', author=owner)
+        response = await self.async_client.get(
+            reverse('job-events'), {'token': str(AccessToken.for_user(other)), 'story': story.id}
+        )
+        self.assertEqual(response.status_code, 404)
+
+    def test_stream_is_refused_under_wsgi(self):
+        user = User.objects.create_user(username='writer', email='writer@example.com', password='secret')
+        response = self.client.get(reverse('job-events'), {'token': str(AccessToken.for_user(user))})
+        self.assertEqual(response.status_code, 501)
+
+    async def test_stream_relays_published_job_events(self):
+        use_fake_redis(self)
+        user = await User.objects.acreate(username='writer', email='writer@example.com')
+        response = await self.async_client.get(reverse('job-events'), {'token': str(AccessToken.for_user(user))})
+        self.assertEqual((response.status_code, response['Content-Type']), (200, 'text/event-stream'))
+        stream = aiter(response.streaming_content)
+        try:
+            self.assertEqual(await anext(stream), b'retry: 5000\n\n')
+            job = await Job.objects.acreate(job_type='generate_media', user=user, request_data={})
+            await sync_to_async(self.publish)(job)
+            frame = (await anext(stream)).decode()
+            self.assertTrue(frame.startswith('event: job\ndata: '))
+            expected = json.loads(json.dumps(events.job_event(job), cls=DjangoJSONEncoder))
+            self.assertEqual(json.loads(frame.split('data: ', 1)[1]), expected)
+        finally:
+            await stream.aclose()
+
+    def publish(self, job):
+        with self.captureOnCommitCallbacks(execute=True):
+            events.publish_job_event(job)
+
+
+@override_settings(WORKER_API_TOKEN='worker-secret')
+class JobCompletionTests(TestCase):
+
+    def setUp(self):
+        self.client = APIClient()
+        self.client.credentials(HTTP_AUTHORIZATION='Worker worker-secret')
+        self.user = User.objects.create_user(username='writer', email='writer@example.com', password='secret')
+        self.story = Story.objects.create(title='Done', content='text', author=self.user)
+
+    def create_bulk(self, scene_count):
+        parent = Job.objects.create(job_type='generate_bulk_media', user=self.user, story=self.story, request_data={})
+        children = []
+        for order in range(scene_count):
+            scene = Scene.objects.create(story=self.story, title=f'Scene {order}', content='a', order=order)
+            children.append(Job.objects.create(
+                job_type='generate_media', user=self.user, story=self.story, scene=scene, parent=parent,
+                request_data={'media_type': 'image'}
+            ))
+        return parent, children
+
+    def complete(self, events):
+        return self.client.post(reverse('job-completion'), {'events': events}, format='json')
+
+    def image_event(self, job, index):
+        return {'job_id': job.id, 'status': 'completed', 'media': {'url': f'https://example.com/{index}.png'}}
+
+    def test_requires_worker_token(self):
+        self.client.credentials(HTTP_AUTHORIZATION='Worker wrong')
+        self.assertEqual(self.complete([{'job_id': 1, 'status': 'completed'}]).status_code, 403)
+
+    def test_media_lists_must_name_their_scenes(self):
+        job = Job.objects.create(
+            job_type='generate_entire_audio', user=self.user, story=self.story, request_data={'media_type': 'audio'}
+        )
+        response = self.complete([
+            {'job_id': job.id, 'status': 'completed', 'media': [{'url': 'https://example.com/a.mp3'}]}
+        ])
+        self.assertEqual(response.status_code, 400)
+
+    def test_batch_applies_in_constant_queries(self):
+        _, small = self.create_bulk(2)
+        # lock jobs, update jobs, insert media, roll up parent, update parent,
+        # lock and refresh counters (plus a savepoint pair)
+        with self.assertNumQueries(9) as small_queries:
+            self.complete([self.image_event(job, i) for i, job in enumerate(small)])
+        _, large = self.create_bulk(20)
+        with self.assertNumQueries(len(small_queries.captured_queries)):
+            self.complete([self.image_event(job, i) for i, job in enumerate(large)])
+
+    def test_children_media_parent_and_revisions(self):
+        parent, children = self.create_bulk(3)
+        preview = Job.objects.create(job_type='generate_pdf_preview', user=self.user, story=self.story, request_data={})
+        old = Revision.objects.create(story=self.story, format='pdf', url='https://example.com/old.pdf')
+        # Out of retries, so the failure is final
+        Job.objects.filter(pk=children[2].pk).update(retry_count=F('max_retries'))
+        response = self.complete([
+            self.image_event(children[0], 0),
+            self.image_event(children[1], 1),
+            {'job_id': children[2].id, 'status': 'failed', 'error_message': 'GPU out of memory'},
+            {'job_id': preview.id, 'status': 'completed', 'revision': {'url': 'https://example.com/new.pdf'}},
+            {'job_id': 999999, 'status': 'completed'},
+        ])
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['unknown'], [999999])
+        self.assertEqual(len(response.data['applied']), 4)
+
+        parent.refresh_from_db()
+        self.assertEqual((parent.status, parent.response_data), ('completed', {'completed': 2, 'failed': 1, 'cancelled': 0}))
+        self.assertEqual(Job.objects.get(pk=children[2].pk).error_message, 'GPU out of memory')
+        self.story.refresh_from_db()
+        self.assertEqual(self.story.image_ready_scene_count, 2)
+        current = Revision.objects.get(story=self.story, is_current=True)
+        self.assertEqual((current.format, current.url), ('pdf', 'https://example.com/new.pdf'))
+        old.refresh_from_db()
+        self.assertFalse(old.is_current)
+
+        # Redelivered events are skipped
+        response = self.complete([self.image_event(children[0], 0)])
+        self.assertEqual(response.data['skipped'], [children[0].id])
+        self.assertEqual(Media.objects.filter(scene=children[0].scene).count(), 1)
+
+    def test_failed_jobs_with_retries_left_are_scheduled_again(self):
+        parent, children = self.create_bulk(2)
+        response = self.complete([
+            self.image_event(children[0], 0),
+            {'job_id': children[1].id, 'status': 'failed', 'error_message': 'GPU out of memory'},
+        ])
+        self.assertEqual(response.data['applied'], [children[0].id, children[1].id])
+        retried = Job.objects.get(pk=children[1].pk)
+        self.assertEqual(
+            (retried.status, retried.retry_count, retried.error_message), ('pending', 1, 'GPU out of memory')
+        )
+        self.assertIsNotNone(retried.next_retry_at)
+        self.assertIsNone(retried.completed_at)
+        # The bulk run waits for the retry
+        parent.refresh_from_db()
+        self.assertEqual(parent.status, 'pending')
+        Job.objects.filter(pk=retried.pk).update(next_retry_at=timezone.now())
+        self.assertEqual(enqueue_due_retries(), 1)
+
+        Job.objects.filter(pk=retried.pk).update(retry_count=F('max_retries'))
+        self.complete([{'job_id': retried.id, 'status': 'failed', 'error_message': 'GPU out of memory'}])
+        retried.refresh_from_db()
+        self.assertEqual(retried.status, 'failed')
+        parent.refresh_from_db()
+        self.assertEqual((parent.status, parent.response_data), ('completed', {'completed': 1, 'failed': 1, 'cancelled': 0}))
+
+    def test_only_the_last_revision_of_a_batch_is_current(self):
+        first, second = [
+            Job.objects.create(job_type='generate_pdf_preview', user=self.user, story=self.story, request_data={})
+            for _ in range(2)
+        ]
+        self.complete([
+            {'job_id': first.id, 'status': 'completed', 'revision': {'url': 'https://example.com/1.pdf'}},
+            {'job_id': second.id, 'status': 'completed', 'revision': {'url': 'https://example.com/2.pdf'}},
+        ])
+        self.assertEqual(Revision.objects.filter(story=self.story, format='pdf').count(), 2)
+        current = Revision.objects.get(story=self.story, format='pdf', is_current=True)
+        self.assertEqual(current.url, 'https://example.com/2.pdf')
+
+
+@override_settings(AWS_S3_REGION_NAME='us-east-1', PDF_AWS_STORAGE_BUCKET_NAME='previews')
+class PreviewStatusTests(TestCase):
+
+    def setUp(self):
+        utils._reset_aws_clients()
+        self.addCleanup(utils._reset_aws_clients)
+        self.user = User.objects.create_user(username='writer', email='writer@example.com', password='secret')
+        self.story = Story.objects.create(title='Preview', content='text', author=self.user)
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        self.url = reverse('preview-status', args=[self.story.id, 'pdf'])
+
+    def test_status_comes_from_the_revision(self):
+        self.assertEqual(self.client.get(self.url).data, {'status': 'pending'})
+        revision = Revision.objects.create(story=self.story, format='pdf', url='https://example.com/p.pdf')
+        self.assertEqual(self.client.get(self.url).data['status'], 'pending')
+        revision.status = 'complete'
+        revision.completed_at = timezone.now()
+        revision.save()
+        response = self.client.get(self.url)
+        self.assertEqual((response.data['status'], response.data['url']), ('complete', 'https://example.com/p.pdf'))
+
+        other = User.objects.create_user(username='other', email='other@example.com', password='secret')
+        self.client.force_authenticate(other)
+        self.assertEqual(self.client.get(self.url).status_code, 404)
+
+    def test_reconciler_checks_pending_revisions_in_s3(self):
+        rendered = Revision.objects.create(story=self.story, format='pdf', url='https://example.com/1.pdf')
+        missing = Revision.objects.create(story=self.story, format='audio', url='https://example.com/2.mp3')
+        Revision.objects.update(created_at=timezone.now() - timedelta(hours=2))
+        with Stubber(utils.aws_client('s3')) as stubber:
+            stubber.add_response(
+                'head_object', {}, {'Bucket': 'previews', 'Key': f'story_{self.story.id}/preview_{rendered.id}.pdf'}
+            )
+            stubber.add_client_error('head_object', service_error_code='404', http_status_code=404)
+            call_command('reconcile_previews', stdout=StringIO())
+        rendered.refresh_from_db()
+        missing.refresh_from_db()
+        self.assertEqual((rendered.status, missing.status), ('complete', 'failed'))
+        self.assertIsNotNone(rendered.completed_at)
+
+    @override_settings(WORKER_API_TOKEN='worker-secret')
+    def test_completion_marks_the_rendered_revision(self):
+        job = Job.objects.create(job_type='generate_pdf_preview', user=self.user, story=self.story, request_data={})
+        revision = Revision.objects.create(story=self.story, format='pdf')
+        client = APIClient()
+        client.credentials(HTTP_AUTHORIZATION='Worker worker-secret')
+        client.post(reverse('job-completion'), {'events': [{
+            'job_id': job.id, 'status': 'completed',
+            'revision': {'id': revision.id, 'url': 'https://example.com/done.pdf'}
+        }]}, format='json')
+        revision.refresh_from_db()
+        self.assertEqual((revision.status, revision.url), ('complete', 'https://example.com/done.pdf'))
+        self.assertEqual(self.client.get(self.url).data['status'], 'complete')
+
+    @override_settings(WORKER_API_TOKEN='worker-secret')
+    def test_unchanged_story_reuses_the_rendered_preview(self):
+        scene = Scene.objects.create(story=self.story, title='One', content='a', order=1)
+        Media.objects.create(story=self.story, scene=scene, media_type='image', url='https://example.com/1.png')
+        preview_url = reverse('story-preview-pdf', args=[self.story.id])
+
+        job = Job.objects.get(pk=self.client.post(preview_url).data['id'])
+        worker = APIClient()
+        worker.credentials(HTTP_AUTHORIZATION='Worker worker-secret')
+        worker.post(reverse('job-completion'), {'events': [{
+            'job_id': job.id, 'status': 'completed', 'revision': {'url': 'https://example.com/p.pdf'}
+        }]}, format='json')
+        revision = Revision.objects.get(story=self.story, format='pdf')
+        self.assertEqual(revision.metadata['fingerprint'], job.request_data['fingerprint'])
+
+        response = self.client.post(preview_url)
+        self.assertEqual((response.data['reused'], response.data['revision']['id']), (True, revision.id))
+        self.assertEqual(Job.objects.count(), 1)
+
+        scene.content = 'b'
+        scene.save()
+        self.assertIn('job_type', self.client.post(preview_url).data)
+        self.assertEqual(Job.objects.count(), 2)
+
+    @override_settings(WORKER_API_TOKEN='worker-secret')
+    def test_story_title_change_renders_the_preview_again(self):
+        scene = Scene.objects.create(story=self.story, title='One', content='a', order=1)
+        Media.objects.create(story=self.story, scene=scene, media_type='image', url='https://example.com/1.png')
+        preview_url = reverse('story-preview-pdf', args=[self.story.id])
+        job = Job.objects.get(pk=self.client.post(preview_url).data['id'])
+        worker = APIClient()
+        worker.credentials(HTTP_AUTHORIZATION='Worker worker-secret')
+        worker.post(reverse('job-completion'), {'events': [{
+            'job_id': job.id, 'status': 'completed', 'revision': {'url': 'https://example.com/p.pdf'}
+        }]}, format='json')
+        self.assertTrue(self.client.post(preview_url).data['reused'])
+
+        # Story level inputs are rendered too, so a rename needs a new preview
+        self.story.title = 'Renamed'
+        self.story.save()
+        response = self.client.post(preview_url)
+        self.assertNotIn('reused', response.data)
+        self.assertNotEqual(response.data['request_data']['fingerprint'], job.request_data['fingerprint'])
+
+    def test_long_poll_answers_finished_previews_immediately(self):
+        Revision.objects.create(
+            story=self.story, format='pdf', url='https://example.com/p.pdf', status='complete',
+            completed_at=timezone.now()
+        )
+        client = APIClient()
+        self.assertEqual(client.get(self.url, {'wait': 30}).status_code, 401)
+
+        client.credentials(HTTP_AUTHORIZATION=f'Bearer {AccessToken.for_user(self.user)}')
+        response = client.get(self.url, {'wait': 30})
+        self.assertEqual((response.status_code, response.json()['status']), (200, 'complete'))
+
+        other = User.objects.create_user(username='other', email='other@example.com', password='secret')
+        client.credentials(HTTP_AUTHORIZATION=f'Bearer {AccessToken.for_user(other)}')
+        self.assertEqual(client.get(self.url, {'wait': 30}).status_code, 404)
+
+    @override_settings(WORKER_API_TOKEN='worker-secret')
+    async def test_long_poll_wakes_when_the_preview_completes(self):
+        fake = use_fake_redis(self)
+        job = await Job.objects.acreate(
+            job_type='generate_pdf_preview', user=self.user, story=self.story, request_data={}
+        )
+        revision = await Revision.objects.acreate(story=self.story, format='pdf')
+        poll = asyncio.ensure_future(self.async_client.get(
+            self.url, {'wait': 30}, headers={'authorization': f'Bearer {AccessToken.for_user(self.user)}'}
+        ))
+        channel = previews.preview_status_channel(self.story.id, 'pdf')
+        while not fake.subscribers[channel]:
+            await asyncio.sleep(0.01)
+        self.assertFalse(poll.done())
+
+        await sync_to_async(self.complete)(job, revision)
+        response = await asyncio.wait_for(poll, 5)
+        self.assertEqual((response.status_code, response.json()['status']), (200, 'complete'))
+        self.assertEqual(response.json()['url'], 'https://example.com/done.pdf')
+
+    async def test_long_poll_times_out_with_the_pending_status(self):
+        use_fake_redis(self)
+        await Revision.objects.acreate(story=self.story, format='pdf')
+        with mock.patch.object(previews, 'MAX_PREVIEW_WAIT', 0.05):
+            response = await self.async_client.get(
+                self.url, {'wait': 30}, headers={'authorization': f'Bearer {AccessToken.for_user(self.user)}'}
+            )
+        self.assertEqual((response.status_code, response.json()), (200, {'status': 'pending'}))
+
+    async def test_parked_long_poll_holds_no_thread(self):
+        fake = use_fake_redis(self)
+        await Revision.objects.acreate(story=self.story, format='pdf')
+        # Sync code running on behalf of the poll: a sync only middleware
+        # would stay in here for as long as the request is parked
+        running = []
+        run_sync = SyncToAsync.__call__
+
+        async def tracked(hop, *args, **kwargs):
+            running.append(hop.func)
+            try:
+                return await run_sync(hop, *args, **kwargs)
+            finally:
+                running.remove(hop.func)
+
+        with mock.patch.object(SyncToAsync, '__call__', tracked), mock.patch.object(previews, 'MAX_PREVIEW_WAIT', 0.5):
+            poll = asyncio.ensure_future(self.async_client.get(
+                self.url, {'wait': 30}, headers={'authorization': f'Bearer {AccessToken.for_user(self.user)}'}
+            ))
+            channel = previews.preview_status_channel(self.story.id, 'pdf')
+            while not fake.subscribers[channel]:
+                await asyncio.sleep(0.01)
+            await asyncio.sleep(0.1)
+            self.assertFalse(poll.done())
+            self.assertEqual(running, [])
+            response = await asyncio.wait_for(poll, 5)
+        self.assertEqual(response.json(), {'status': 'pending'})
+
+    def complete(self, job, revision):
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.credentials(HTTP_AUTHORIZATION='Worker worker-secret')
+            self.client.post(reverse('job-completion'), {'events': [{
+                'job_id': job.id, 'status': 'completed',
+                'revision': {'id': revision.id, 'url': 'https://example.com/done.pdf'}
+            }]}, format='json')
@@ -10,6 +10,7 @@ from rest_framework_simplejwt.views import (
     TokenRefreshView,
 )
 from .views import *
+from .events import job_events
 
 urlpatterns = [
     # Story endpoints
@@ -59,7 +60,13 @@ urlpatterns = [
     path('stories/<int:story_id>/preview-video/', StoryPreviewView.as_view(), name='story-preview-video'),
     path('stories/<int:story_id>/preview-voice/', StoryPreviewView.as_view(), name='story-preview-voice'),
     
-    path('stories/<int:story_id>/preview-status/<str:pk>/', PreviewStatusView.as_view(), name='preview-status'),
+    path('stories/<int:story_id>/preview-status/<str:pk>/', preview_status, name='preview-status'),
+
+    # Job progress events (Server-Sent Events, served under ASGI)
+    path('events/jobs/', job_events, name='job-events'),
+
+    # Internal endpoints for workers
+    path('internal/jobs/complete/', JobCompletionAPIView.as_view(), name='job-completion'),
 
     # Revision endpoints
     path('stories/<int:story_id>/revisions/', RevisionListAPIView.as_view(), name='revision-list'),
@@ -81,12 +88,12 @@ urlpatterns = [
 
     # Job endpoints
     path('jobs/', JobViewSet.as_view({'get': 'list', 'post': 'create'}), name='job-list-create'),
-    path('jobs/<uuid:pk>/', JobViewSet.as_view({
+    path('jobs/<int:pk>/', JobViewSet.as_view({
         'get': 'retrieve',
         'put': 'update',
         'patch': 'partial_update',
         'delete': 'destroy'
     }), name='job-detail'),
-    path('jobs/<uuid:pk>/retry/', JobViewSet.as_view({'post': 'retry'}), name='job-retry'),
-    path('jobs/<uuid:pk>/cancel/', JobViewSet.as_view({'post': 'cancel'}), name='job-cancel'),
+    path('jobs/<int:pk>/retry/', JobViewSet.as_view({'post': 'retry'}), name='job-retry'),
+    path('jobs/<int:pk>/cancel/', JobViewSet.as_view({'post': 'cancel'}), name='job-cancel'),
 ]
\ No newline at end of file
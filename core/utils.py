@@ -1,24 +1,166 @@
 import boto3
+from botocore.config import Config
 import json
 import traceback
 from django.conf import settings
+from django.core.handlers.asgi import ASGIRequest
 import redis
+import redis.asyncio
 import os
+import threading
+import time
+from django.db import connection
 
 CREDIT_COSTS = {
         'image': 10,  # 10 credits per image
         'audio': 0.25,  # 0.25 credits per audio
     }
 
+# Connection pools sized for gunicorn threads sharing one client per service
+AWS_CLIENT_CONFIG = Config(
+    max_pool_connections=50,
+    connect_timeout=5,
+    read_timeout=30,
+    tcp_keepalive=True,
+    retries={'max_attempts': 3, 'mode': 'standard'}
+)
+
+_aws_clients = {}
+_aws_clients_lock = threading.Lock()
+
+def aws_client(service_name):
+    """
+    Return the process-wide boto3 client for an AWS service.
+
+    Clients are created lazily on first use and then shared by every request
+    in the process, so credential resolution, endpoint setup and TLS
+    handshakes happen once per worker instead of once per request. boto3
+    clients are thread-safe; creation is serialized so concurrent first
+    requests build a single client.
+
+    Args:
+        service_name (str): The AWS service, e.g. 'sqs' or 's3'
+
+    Returns:
+        botocore.client.BaseClient: The shared client
+    """
+    client = _aws_clients.get(service_name)
+    if client is None:
+        with _aws_clients_lock:
+            client = _aws_clients.get(service_name)
+            if client is None:
+                # A private session: the default boto3 session isn't thread-safe
+                session = boto3.session.Session(
+                    aws_access_key_id=settings.AWS_ACCESS_KEY_ID,
+                    aws_secret_access_key=settings.AWS_SECRET_ACCESS_KEY,
+                    region_name=settings.AWS_S3_REGION_NAME
+                )
+                client = session.client(service_name, config=AWS_CLIENT_CONFIG)
+                _aws_clients[service_name] = client
+    return client
+
+def _reset_aws_clients():
+    """Drop clients inherited from a parent process; sockets can't be shared across a fork."""
+    global _aws_clients, _aws_clients_lock
+    _aws_clients = {}
+    _aws_clients_lock = threading.Lock()
+
+os.register_at_fork(after_in_child=_reset_aws_clients)
+
+_redis_pool = None
+
 def redis_client():
-    return redis.Redis(
+    """
+    Return a Redis client backed by a process-wide connection pool, so
+    callers reuse open connections instead of dialing Redis on every call.
+    """
+    global _redis_pool
+    if _redis_pool is None:
+        _redis_pool = redis.ConnectionPool(
+            host=os.getenv('REDISHOST'),
+            port=os.getenv('REDISPORT'),
+            password=os.getenv('REDISPASSWORD')
+        )
+    return redis.Redis(connection_pool=_redis_pool)
+def async_redis_client():
+    """
+    Return a new asyncio Redis client for async views. Each event loop needs
+    its own connections, so callers close the client when they are done.
+    """
+    return redis.asyncio.Redis(
         host=os.getenv('REDISHOST'),
         port=os.getenv('REDISPORT'),
         password=os.getenv('REDISPASSWORD')
     )
+
+def served_under_asgi(request):
+    """
+    Whether a request came in through the ASGI handler. Under WSGI an async
+    view still holds a worker thread for as long as it runs, so views that
+    park requests must not do so there.
+    """
+    return isinstance(request, ASGIRequest)
+
+def cached_count(cache_key, queryset, ttl=60, stale_ttl=3600):
+    """
+    Return a cached, possibly slightly stale, row count for a queryset.
+
+    Fresh counts are served from Redis. Once a count is older than ``ttl``
+    seconds it is still served, and a single background thread recomputes
+    it; only a cold cache runs COUNT(*) inside the request.
+
+    Args:
+        cache_key (str): Redis key identifying the counted queryset
+        queryset (QuerySet): The queryset to count
+        ttl (int): Seconds a count is considered fresh
+        stale_ttl (int): Seconds a stale count may still be served
+
+    Returns:
+        int: The cached or freshly computed count
+    """
+    key = f"count:{cache_key}"
+    try:
+        cached = redis_client().get(key)
+    except Exception as e:
+        print(f"Error reading cached count: {str(e)}")
+        return queryset.count()
+
+    if cached is None:
+        return _refresh_count(key, queryset, stale_ttl)
+
+    cached = json.loads(cached)
+    if time.time() - cached['refreshed_at'] > ttl:
+        try:
+            # Let only one process refresh a stale count at a time
+            if redis_client().set(f"{key}:refresh", 1, nx=True, ex=30):
+                threading.Thread(
+                    target=_refresh_count_in_background,
+                    args=(key, queryset, stale_ttl),
+                    daemon=True
+                ).start()
+        except Exception as e:
+            print(f"Error scheduling count refresh: {str(e)}")
+    return cached['count']
+
+def _refresh_count(key, queryset, stale_ttl):
+    count = queryset.count()
+    try:
+        redis_client().setex(key, stale_ttl, json.dumps({'count': count, 'refreshed_at': time.time()}))
+    except Exception as e:
+        print(f"Error caching count: {str(e)}")
+    return count
+
+def _refresh_count_in_background(key, queryset, stale_ttl):
+    try:
+        _refresh_count(key, queryset, stale_ttl)
+    finally:
+        # Threads get their own database connection; don't leak it
+        connection.close()
+
 def send_job_to_sqs(job, request_data, media_id=None):
     """
-    Send a job to AWS SQS queue and update the job with the message ID.
+    Send a job to the job queue (SQS unless JOB_QUEUE_BACKEND says otherwise)
+    and update the job with the message ID.
     
     Args:
         job (Job): The job instance to send
@@ -35,22 +177,14 @@ def send_job_to_sqs(job, request_data, media_id=None):
         job_id = job.id
         request_data['job_id'] = str(job_id)
         request_data['media_id'] = media_id
-        sqs_client = boto3.client(
-            'sqs',
-            aws_access_key_id=settings.AWS_ACCESS_KEY_ID,
-            aws_secret_access_key=settings.AWS_SECRET_ACCESS_KEY,
-            region_name=settings.AWS_S3_REGION_NAME
-        )
+        from .queues import get_queue
 
-        # Send message to SQS
+        # Send message to the queue
         print('request_data', request_data)
-        response = sqs_client.send_message(
-            QueueUrl=settings.WHISPR_TALES_QUEUE_URL,
-            MessageBody=json.dumps(request_data)
-        )
-        print(f'job sent to the sqs {request_data} for job Id: {job_id}')
+        message_id = get_queue(job.queue_lane or None).send(request_data)
+        print(f'job sent to the queue {request_data} for job Id: {job_id}')
         # Update job with message ID
-        job.message_id = response['MessageId']
+        job.message_id = message_id
         job.save()
         return job
 
@@ -64,6 +198,41 @@ def send_job_to_sqs(job, request_data, media_id=None):
         job.mark_as_failed(f"Failed to send to SQS: {str(e)}\nTraceback:\n{error_traceback}")
         raise
 
+SQS_MAX_BATCH_SIZE = 10
+
+def send_messages_to_sqs(messages, queue_url=None):
+    """
+    Send messages to SQS with send_message_batch, ten entries per request.
+
+    A failed request or entry only fails the messages it carried; the rest
+    are still sent.
+
+    Args:
+        messages (list): The JSON serializable message bodies to send
+        queue_url (str): The queue to send to, WHISPR_TALES_QUEUE_URL by default
+
+    Returns:
+        tuple: (sent, failed) lists; sent holds (index, message_id) and
+        failed holds (index, error) pairs, indexing into ``messages``
+    """
+    sqs_client = aws_client('sqs')
+    queue_url = queue_url or settings.WHISPR_TALES_QUEUE_URL
+    sent, failed = [], []
+    for start in range(0, len(messages), SQS_MAX_BATCH_SIZE):
+        indexes = range(start, min(start + SQS_MAX_BATCH_SIZE, len(messages)))
+        entries = [{'Id': str(index), 'MessageBody': json.dumps(messages[index])} for index in indexes]
+        try:
+            response = sqs_client.send_message_batch(QueueUrl=queue_url, Entries=entries)
+        except Exception as e:
+            print(f"Error sending SQS batch: {str(e)}")
+            failed.extend((index, str(e)) for index in indexes)
+            continue
+        sent.extend((int(entry['Id']), entry['MessageId']) for entry in response.get('Successful', []))
+        for entry in response.get('Failed', []):
+            print(f"Error sending SQS message {entry['Id']}: {entry.get('Code')} {entry.get('Message')}")
+            failed.append((int(entry['Id']), entry.get('Message') or entry.get('Code')))
+    return sorted(sent), sorted(failed)
+
 def create_redis_lock(scene_id, media_type):
     """
     Create a Redis lock for media generation.
@@ -11,6 +11,9 @@ from rest_framework import permissions, status
 from rest_framework.response import Response
 from django.shortcuts import get_object_or_404
 from rest_framework_simplejwt.tokens import RefreshToken
+from rest_framework_simplejwt.authentication import JWTAuthentication
+from rest_framework.exceptions import AuthenticationFailed
+from asgiref.sync import sync_to_async
 from django.contrib.auth import authenticate
 from django.utils.decorators import method_decorator
 from django.views.decorators.csrf import csrf_exempt
@@ -22,6 +25,7 @@ import json
 import razorpay
 import uuid
 import math
+import hashlib
 # from allauth.socialaccount.providers.google.views import GoogleOAuth2Adapter
 # from allauth.socialaccount.providers.oauth2.client import OAuth2Client
 # from dj_rest_auth.registration.views import SocialLoginView
@@ -34,19 +38,32 @@ from django.conf import settings
 import os
 from rest_framework import viewsets
 from rest_framework.decorators import action
-import boto3
 from io import BytesIO
 import requests
 from datetime import datetime, timedelta
 from django.db import transaction
-from django.db.models import Q
-from django.http import JsonResponse
+from django.db.models import Prefetch, Q
+from django.http import Http404, JsonResponse
 from django.core.mail import send_mail
 from django.utils.crypto import get_random_string
 from django.utils import timezone
 import resend
 import traceback
 from .utils import *
+from .pagination import KeysetPagination
+from .outbox import enqueue_job, enqueue_jobs
+from .completions import apply_completion_events, cancel_job
+from .previews import (
+    find_rendered_preview, get_preview_status, invalidate_preview_status, revision_format,
+    story_content_fingerprint, wait_for_preview_status,
+)
+from .permissions import IsWorker
+from .audio import plan_story_audio, scene_audio_fingerprint, stale_scenes, story_audio_segments
+from .credits import get_credit_balance, invalidate_credit_balance, annotate_credit_balance
+from .cache import (
+    get_or_compute, public_list_cache_key, public_story_cache_key, invalidate_public_story,
+    story_version, story_etag, etag_matches, not_modified
+)
 
 User = get_user_model()
 
@@ -205,12 +222,37 @@ class PricingConfigUpdateView(APIView):
         
         return Response({'message': 'Pricing configuration updated successfully'})
 
+def get_list_param(request, name):
+    """Parse a comma separated query parameter, returning None when it is absent."""
+    value = request.query_params.get(name)
+    if value is None:
+        return None
+    return [item.strip() for item in value.split(',') if item.strip()]
+
+def story_read_queryset(request, stories):
+    """
+    Apply the ?fields= and ?include= query parameters to a story queryset.
+
+    Returns the queryset, loading only the columns and relations that will be
+    rendered, along with the matching StorySerializer options.
+    """
+    fields = get_list_param(request, 'fields')
+    include = get_list_param(request, 'include')
+    relations = StorySerializer.relations_for(fields, include)
+    return stories.with_related(include=relations, fields=fields), {'fields': fields, 'include': include}
+
 class StoryListCreateAPIView(APIView):
     """
     API endpoint for listing and creating stories.
     
     GET /stories/ - List all stories for the current user
     POST /stories/ - Create a new story
+    Query Parameters:
+        - cursor: Opaque cursor returned as next_cursor by the previous page
+        - page_size: Items per page (default: PAGE_SIZE, max: 100)
+        - view: 'summary' for the compact story card representation
+        - fields: Comma separated story fields to return
+        - include: Comma separated relations to embed (author, scenes, media)
     """
     permission_classes = [permissions.IsAuthenticated]
 
@@ -223,8 +265,15 @@ class StoryListCreateAPIView(APIView):
             stories = Story.objects.filter(is_active=True, is_public=is_public)
         else:
             stories = Story.objects.filter(author=request.user, is_active=True)
-        serializer = StorySerializer(stories, many=True)
-        return Response(serializer.data)
+        paginator = KeysetPagination(ordering=('-created_at', '-id'))
+        if request.query_params.get('view') == 'summary':
+            page = paginator.paginate_queryset(stories.summary(), request)
+            serializer = StorySummarySerializer(page, many=True)
+        else:
+            stories, options = story_read_queryset(request, stories)
+            page = paginator.paginate_queryset(stories, request)
+            serializer = StorySerializer(page, many=True, **options)
+        return Response(paginator.get_paginated_data(serializer.data))
 
     def post(self, request):
         """Create a new story."""
@@ -252,10 +301,22 @@ class StoryDetailAPIView(APIView):
 
     def get(self, request, pk):
         """Retrieve a story."""
-        story = self.get_object(pk)
-        if story.is_public or story.author == request.user:
-            serializer = StorySerializer(story)
-            return Response(serializer.data)
+        # Answer polling clients from a single version query when nothing changed
+        version = story_version(pk)
+        etag = None
+        if version and (version['is_public'] or version['author_id'] == request.user.id):
+            etag = story_etag(version, 'detail', request)
+            if etag_matches(request, etag):
+                return not_modified(etag)
+
+        stories, options = story_read_queryset(request, Story.objects.all())
+        story = get_object_or_404(stories, pk=pk)
+        if story.is_public or story.author_id == request.user.id:
+            serializer = StorySerializer(story, **options)
+            response = Response(serializer.data)
+            if etag:
+                response['ETag'] = etag
+            return response
         else:
             return Response(
                 {"error": "Story is not public"},
@@ -290,59 +351,119 @@ class StoryDetailAPIView(APIView):
         return Response(status=status.HTTP_204_NO_CONTENT)
 
     def post(self, request, pk):
-        """Generate image/audio for all scenes in the story."""
+        """
+        Generate image/audio for all scenes in the story.
+
+        Images get a parent job with one child job per active scene, created
+        with a single bulk_create and linked to the aggregated credit
+        transaction recorded by CreditDeductionMiddleware. Audio is a single
+        generate_entire_audio job that only synthesizes scenes whose text,
+        voice or language changed and stitches in the audio of the rest.
+        Queue messages are written to the outbox in the jobs' transaction.
+        """
         print("Generating images for all scenes in the story.", request.data)
         story = self.get_object(pk)
         voice_id = request.data.get('voice_id')
         url_name = request.resolver_match.url_name
         media_type = url_name.split('-')[-1]
-        scenes = story.scenes.all()
-        scene_ids = [scene.id for scene in scenes]
-        try:
-            # Initialize SQS client
-            sqs_client = boto3.client(
-                'sqs',
-                aws_access_key_id=settings.AWS_ACCESS_KEY_ID,
-                aws_secret_access_key=settings.AWS_SECRET_ACCESS_KEY,
-                region_name=settings.AWS_S3_REGION_NAME
+        credit_transaction = getattr(request, 'credit_transaction', None)
+        scene_ids = list(story.scenes.filter(is_active=True).order_by('order', 'id').values_list('id', flat=True))
+        if not scene_ids:
+            return Response(
+                {'error': 'Story has no active scenes'},
+                status=status.HTTP_400_BAD_REQUEST
             )
-                    
-            if media_type == 'image':
-                # incase of image, we can send independent messages for each scene
-                for scene in scenes:
-                    # Prepare the message
-                    message = {
-                        'story_id': story.id,
-                        'voice_id': voice_id,
-                        'scene_id': scene.id,
-                        'media_type': media_type,
-                        'action': 'generate_media'
+        try:
+            with transaction.atomic():
+                if media_type == 'image':
+                    parent = Job.objects.create(
+                        job_type='generate_bulk_media',
+                        user=request.user,
+                        story=story,
+                        request_data={
+                            'story_id': story.id,
+                            'voice_id': voice_id,
+                            'scene_ids': scene_ids,
+                            'media_type': media_type,
+                            'action': 'generate_bulk_media'
+                        },
+                        # Each child carries its scene's cost against the shared transaction
+                        credit_transaction=credit_transaction
+                    )
+                    # incase of image, we can send independent messages for each scene
+                    children = Job.objects.bulk_create([
+                        Job(
+                            parent=parent,
+                            job_type='generate_media',
+                            user=request.user,
+                            story=story,
+                            scene_id=scene_id,
+                            request_data={
+                                'story_id': story.id,
+                                'voice_id': voice_id,
+                                'scene_id': scene_id,
+                                'media_type': media_type,
+                                'action': 'generate_media'
+                            },
+                            queue_lane=Job.LANE_BATCH,
+                            credit_transaction=credit_transaction,
+                            credit_cost=math.ceil(CREDIT_COSTS[media_type])
+                        )
+                        for scene_id in scene_ids
+                    ])
+                    # Queued through the outbox; relay_outbox sends them in batches once this commits
+                    enqueue_jobs(children)
+                    dispatched_scene_ids = scene_ids
+                    body = {
+                        'message': 'Media generation request sent successfully',
+                        'job_id': parent.id,
+                        'jobs': [{'scene_id': child.scene_id, 'job_id': child.id} for child in children]
                     }
-                    print(f"Message for media generation: {message}")
-                    # Send message to SQS queue
-                    response = sqs_client.send_message(
-                        QueueUrl=settings.WHISPR_TALES_QUEUE_URL,
-                        MessageBody=json.dumps(message)
+                elif media_type == 'audio':
+                    # incase of audio, we have to single message for all scenes
+                    audio_plan = getattr(request, 'audio_plan', None)
+                    if audio_plan is not None:
+                        # Planned and charged for by CreditDeductionMiddleware
+                        voice_id, language, plan = audio_plan['voice_id'], audio_plan['language'], audio_plan['scenes']
+                    else:
+                        language = request.user.language
+                        plan = plan_story_audio(story.id, voice_id, language)
+                    stale = stale_scenes(plan)
+                    if not stale:
+                        return Response({
+                            'message': 'Audio is already up to date',
+                            'scenes': plan
+                        })
+                    job = Job.objects.create(
+                        job_type='generate_entire_audio',
+                        user=request.user,
+                        story=story,
+                        request_data={
+                            'user_id': request.user.id,
+                            'story_id': story.id,
+                            'voice_id': voice_id,
+                            'language': language,
+                            'media_type': media_type,
+                            'action': 'generate_entire_audio',
+                            # Every scene in order; those with a media_id are reused as is
+                            'scenes': plan,
+                            'synthesize_scene_ids': [scene['scene_id'] for scene in stale]
+                        },
+                        credit_transaction=credit_transaction,
+                        credit_cost=credit_transaction.credits_used if credit_transaction else 0
                     )
-            elif media_type == 'audio':
-                # incase of audio, we have to single message for all scenes
-                message = {
-                    'user_id': request.user.id,
-                    'story_id': story.id,
-                    'voice_id': voice_id,
-                    'media_type': media_type,
-                    'action': 'generate_entire_audio'
-                }
-                response = sqs_client.send_message(
-                    QueueUrl=settings.WHISPR_TALES_QUEUE_URL,
-                    MessageBody=json.dumps(message)
-                )
-            # Update old media to inactive
-            Media.objects.filter(story_id=story.id, scene_id__in=scene_ids, is_active=True, media_type=media_type).update(is_active=False)
-            return Response({
-                'message': 'Media generation request sent successfully',
-                'message_id': response['MessageId']
-            })
+                    enqueue_job(job, job.request_data)
+                    dispatched_scene_ids = [scene['scene_id'] for scene in stale]
+                    body = {
+                        'message': 'Media generation request sent successfully',
+                        'job_id': job.id,
+                        'synthesized_scene_ids': dispatched_scene_ids
+                    }
+                # Update old media to inactive
+                Media.objects.filter(story_id=story.id, scene_id__in=dispatched_scene_ids, is_active=True, media_type=media_type).update(is_active=False)
+                Story.objects.filter(pk=story.id).refresh_counters()
+                invalidate_public_story(story.id, include_list=story.is_public)
+            return Response(body)
         except Exception as e:
             return Response(
                 {'error': str(e)},
@@ -457,14 +578,33 @@ class SceneListCreateAPIView(APIView):
     
     GET /stories/{story_id}/scenes/ - List all scenes for a story
     POST /stories/{story_id}/scenes/ - Create a new scene
+    Query Parameters:
+        - fields: Comma separated scene fields to return
+        - include: 'media' to embed active media (embedded by default)
     """
     permission_classes = [permissions.IsAuthenticated]
 
     def get(self, request, story_pk):
         """List all scenes for a story."""
+        version = story_version(story_pk)
+        etag = None
+        if version and version['author_id'] == request.user.id:
+            etag = story_etag(version, 'scenes', request)
+            if etag_matches(request, etag):
+                return not_modified(etag)
+
+        fields = get_list_param(request, 'fields')
+        include = get_list_param(request, 'include')
         scenes = Scene.objects.filter(story_id=story_pk, story__author=request.user, is_active=True)
-        serializer = SceneSerializer(scenes, many=True)
-        return Response(serializer.data)
+        if include is None or 'media' in include:
+            scenes = scenes.prefetch_related(
+                Prefetch('media', queryset=Media.objects.filter(is_active=True), to_attr='active_media')
+            )
+        serializer = SceneSerializer(scenes, many=True, fields=fields, include=include)
+        response = Response(serializer.data)
+        if etag:
+            response['ETag'] = etag
+        return response
 
     def post(self, request, story_pk):
         """Create a new scene."""
@@ -534,9 +674,9 @@ class SceneDetailAPIView(APIView):
         if url_name == 'scene-generate-image' or url_name == 'scene-generate-audio':
             try:
                 # Get user's active credits
-                user_credits = request.user.credits.filter(is_active=True).first()
+                user_credits = get_credit_balance(request.user.id)
                 scene = Scene.objects.filter(id=pk).first()
-                if not user_credits:
+                if user_credits['updated_at'] is None:
                     return Response(
                         {'error': 'No active credits found for user'},
                         status=status.HTTP_400_BAD_REQUEST
@@ -587,7 +727,8 @@ class SceneDetailAPIView(APIView):
                     job_data['request_data'].update({
                         'previous_request_ids': previous_request_ids if previous_request_ids else None,
                         'next_request_ids': next_request_ids if next_request_ids else None,
-                        'voice_id': voice_id
+                        'voice_id': voice_id,
+                        'fingerprint': scene_audio_fingerprint(scene.content, voice_id, request.user.language)
                     })
 
                 # Create and send job within a transaction
@@ -624,25 +765,12 @@ class SceneDetailAPIView(APIView):
                         
                         # Mark them as inactive
                         active_media.update(is_active=False)
+                        Story.objects.filter(pk=story_pk).refresh_counters()
+                        invalidate_public_story(story_pk)
                         
-                        try:
-                            # Send job to SQS
-                            job = send_job_to_sqs(job, job.request_data, media_id)
-                            return Response(JobSerializer(job).data)
-                        except Exception as e:
-                            error_traceback = traceback.format_exc()
-                            print(f'Error in media generation:')
-                            print(f'Error: {str(e)}')
-                            print('Traceback:')
-                            print(error_traceback)
-                            # The job is already marked as failed in send_job_to_sqs
-                            return Response(
-                                {
-                                    'error': f'Failed to send job to queue: {str(e)}',
-                                    'traceback': error_traceback if settings.DEBUG else None
-                                },
-                                status=status.HTTP_500_INTERNAL_SERVER_ERROR
-                            )
+                        # Queued through the outbox; relay_outbox sends it once this commits
+                        enqueue_job(job, job.request_data, media_id)
+                        return Response(JobSerializer(job).data)
                     else:
                         return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
             except Exception as e:
@@ -741,8 +869,11 @@ class UserListCreateAPIView(APIView):
     """
     API endpoint for listing and creating users.
     
-    GET /users/ - List all users
+    GET /users/ - List users, paginated by cursor
     POST /users/ - Create a new user
+    Query Parameters:
+        - cursor: Opaque cursor returned as next_cursor by the previous page
+        - page_size: Items per page (default: PAGE_SIZE, max: 100)
     """
     def get_permissions(self):
         """Set permissions based on the request method."""
@@ -751,10 +882,11 @@ class UserListCreateAPIView(APIView):
         return [permissions.IsAuthenticated()]
 
     def get(self, request):
-        """List all users."""
-        users = User.objects.all()
+        """List users with their credit balance, one page per query."""
+        paginator = KeysetPagination(ordering=('id',))
+        users = paginator.paginate_queryset(annotate_credit_balance(User.objects.all()), request)
         serializer = UserSerializer(users, many=True)
-        return Response(serializer.data)
+        return Response(paginator.get_paginated_data(serializer.data))
 
     def post(self, request):
         """Create a new user."""
@@ -914,12 +1046,7 @@ class StoryViewSet(viewsets.ModelViewSet):
         
         try:
             # Initialize S3 client
-            s3_client = boto3.client(
-                's3',
-                aws_access_key_id=settings.AWS_ACCESS_KEY_ID,
-                aws_secret_access_key=settings.AWS_SECRET_ACCESS_KEY,
-                region_name=settings.AWS_S3_REGION_NAME
-            )
+            s3_client = aws_client('s3')
             
             # Initialize OpenAI client
             client = OpenAI(api_key=settings.CHATGPT_OPENAI_API_KEY)
@@ -981,12 +1108,7 @@ class SceneViewSet(viewsets.ModelViewSet):
         
         try:
             # Initialize S3 client
-            s3_client = boto3.client(
-                's3',
-                aws_access_key_id=settings.AWS_ACCESS_KEY_ID,
-                aws_secret_access_key=settings.AWS_SECRET_ACCESS_KEY,
-                region_name=settings.AWS_S3_REGION_NAME
-            )
+            s3_client = aws_client('s3')
 
             # Initialize OpenAI client
             client = OpenAI(
@@ -1049,7 +1171,7 @@ class StoryPreviewView(APIView):
             format = url_name.split('-')[2]
             format = 'image' if format == 'pdf' else 'audio' if format == 'audio' else 'video' if format == 'video' else 'media'
             
-            if format != 'video' and story.scenes.filter(is_active=True).count() != story.media.filter(media_type=format, is_active=True).count():
+            if format != 'video' and not story.is_media_ready(format):
                 return Response(
                     {'error': f'generate {format} for all scenes first'},
                     status=status.HTTP_400_BAD_REQUEST
@@ -1061,6 +1183,16 @@ class StoryPreviewView(APIView):
                 'story-preview-audio': 'generate_audio_preview',
                 'story-preview-video': 'generate_video_preview'
             }.get(url_name, 'generate_media')
+            revision_name = revision_format('pdf' if format == 'image' else format)
+
+            # Nothing changed since the last render: hand back that revision
+            fingerprint = story_content_fingerprint(story)
+            rendered = find_rendered_preview(story_id, revision_name, fingerprint)
+            if rendered is not None:
+                return Response({
+                    'reused': True,
+                    'revision': RevisionSerializer(rendered).data
+                })
 
             job_data = {
                 'job_type': job_type,
@@ -1069,27 +1201,37 @@ class StoryPreviewView(APIView):
                 'request_data': {
                     'story_id': story_id,
                     'user_id': request.user.id,
-                    'action': job_type
+                    'action': job_type,
+                    'fingerprint': fingerprint
                 }
             }
+            if format == 'audio':
+                # Stitched from the scenes' current audio rather than synthesized again
+                job_data['request_data']['segments'] = story_audio_segments(story_id)
 
             # Create and send job
             serializer = JobCreateSerializer(data=job_data)
             if serializer.is_valid():
                 try:
                     with transaction.atomic():
-                        job = serializer.save(user=request.user)
+                        # Long stories are rendered in the batch lane
+                        job = serializer.save(
+                            user=request.user,
+                            queue_lane=Job.lane_for(job_type, scene_count=story.active_scene_count)
+                        )
                         
                         # Mark current revision as inactive
                         Revision.objects.filter(
                             story_id=story_id,
-                            format=format if format != 'image' else 'pdf',
+                            format=revision_name,
                             is_active=True,
                             deleted_at=None
                         ).update(is_active=False)
+                        invalidate_public_story(story_id, include_list=False)
+                        invalidate_preview_status(story_id)
                         
-                        # Send job to SQS
-                        job = send_job_to_sqs(job, job.request_data)
+                        # Queued through the outbox; relay_outbox sends it once this commits
+                        enqueue_job(job, job.request_data)
                         return Response(JobSerializer(job).data)
                 except Exception as e:
                     error_traceback = traceback.format_exc()
@@ -1119,63 +1261,60 @@ class StoryPreviewView(APIView):
             )
 
 class PreviewStatusView(APIView):
+    """
+    GET /stories/{story_id}/preview-status/{format}/ - Status of the latest preview in a format
+
+    Answered from the Redis cached revision status; S3 is only checked by
+    the reconcile_previews command.
+    """
     permission_classes = [permissions.IsAuthenticated]
 
     def get(self, request, story_id, pk):
         try:
-            # Get the latest revision for the story
-            revision = Revision.objects.filter(
-                story_id=story_id,
-                story__author=request.user,
-                format=pk,
-                is_active=True,
-                deleted_at=None
-            ).order_by('-created_at').first()
-            format = 'mp3' if pk == 'audio' else 'mp4' if pk == 'video' else pk
-            if not revision:
+            author_id, body = get_preview_status(story_id, pk)
+            if author_id != request.user.id:
                 return Response({
-                    'status': 'pending'
-                })
-            
-            # Check if preview exists in S3
-            s3_client = boto3.client(
-                's3',
-                aws_access_key_id=settings.AWS_ACCESS_KEY_ID,
-                aws_secret_access_key=settings.AWS_SECRET_ACCESS_KEY,
-                region_name=settings.AWS_S3_REGION_NAME
-            )
-            
-            bucket_name = settings.PDF_AWS_STORAGE_BUCKET_NAME
-            prefix = f"story_{story_id}/preview_{revision.id}.{format}"
-
-            # List objects in S3 with the prefix
-            response = s3_client.list_objects_v2(
-                Bucket=bucket_name,
-                Prefix=prefix
-            )
-            
-            if 'Contents' in response:
-                return Response({
-                    'status': 'complete',
-                    'url': revision.url,
-                    'format': revision.format,
-                    'created_at': revision.created_at
-                })
-            
-            return Response({
-                'status': 'pending'
-            })
-            
-        except Story.DoesNotExist:
-            return Response({
-                'error': 'Story not found'
-            }, status=status.HTTP_404_NOT_FOUND)
+                    'error': 'Story not found'
+                }, status=status.HTTP_404_NOT_FOUND)
+            return Response(body)
         except Exception as e:
             print(e)
             return Response({
                 'error': str(e)
             }, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
+async def preview_status(request, story_id, pk):
+    """
+    GET /stories/{story_id}/preview-status/{format}/?wait=<seconds> - Long-poll the preview status
+
+    Without ``wait`` this is PreviewStatusView. With it, a pending preview
+    parks the request on the preview's Redis change channel until the
+    revision completes or fails, or ``wait`` (at most 30) seconds pass.
+    Requests are only parked under ASGI; under WSGI a parked request would
+    hold a worker thread, so ``wait`` is ignored there.
+    """
+    wait = request.GET.get('wait', '')
+    if not wait.isdigit() or not int(wait) or not served_under_asgi(request):
+        return await sync_to_async(PreviewStatusView.as_view())(request, story_id=story_id, pk=pk)
+
+    try:
+        auth = await sync_to_async(JWTAuthentication().authenticate)(request)
+    except AuthenticationFailed as e:
+        return JsonResponse({'error': str(e.detail)}, status=status.HTTP_401_UNAUTHORIZED)
+    if auth is None:
+        return JsonResponse({
+            'error': 'Authentication credentials were not provided.'
+        }, status=status.HTTP_401_UNAUTHORIZED)
+
+    try:
+        author_id, body = await wait_for_preview_status(story_id, pk, auth[0].id, int(wait))
+    except Exception as e:
+        print(e)
+        return JsonResponse({'error': str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+    if author_id != auth[0].id:
+        return JsonResponse({'error': 'Story not found'}, status=status.HTTP_404_NOT_FOUND)
+    return JsonResponse(body)
+
 class RevisionListAPIView(APIView):
     """
     API endpoint for listing and creating revisions.
@@ -1210,14 +1349,24 @@ class RevisionCurrentAPIView(APIView):
 
     def get(self, request, story_id):
         """Get current revisions for a story."""
+        version = story_version(story_id)
+        etag = None
+        if version and version['author_id'] == request.user.id:
+            etag = story_etag(version, 'current-revisions', request)
+            if etag_matches(request, etag):
+                return not_modified(etag)
+
         revisions = Revision.objects.filter(
             story_id=story_id,
             story__author=request.user,
             is_current=True,
             url__isnull=False
-        )
+        ).select_related('story')
         serializer = RevisionSerializer(revisions, many=True)
-        return Response(serializer.data)
+        response = Response(serializer.data)
+        if etag:
+            response['ETag'] = etag
+        return response
 
 class RevisionHistoryAPIView(APIView):
     """
@@ -1245,6 +1394,8 @@ class GeneratedContentListAPIView(APIView):
         - page: Page number (default: 1)
         - page_size: Items per page (default: 10)
         - search: Search term for filtering by name or story title
+        - pagination: 'cursor' to page with opaque cursors instead of page numbers
+        - cursor: Opaque cursor returned as next_cursor by the previous page
     """
     permission_classes = [permissions.IsAuthenticated]
 
@@ -1254,12 +1405,10 @@ class GeneratedContentListAPIView(APIView):
         page = int(request.query_params.get('page', 1))
         page_size = int(request.query_params.get('page_size', 10))
         search = request.query_params.get('search', '')
+        cursor_mode = request.query_params.get('pagination') == 'cursor' or 'cursor' in request.query_params
 
-        # Get all stories by the current user
-        stories = Story.objects.filter(author=request.user)
-        
-        # Get all revisions for these stories
-        revisions = Revision.objects.filter(story__in=stories, deleted_at__isnull=True).select_related('story').order_by('-created_at')
+        # Get all revisions for the current user's stories
+        revisions = Revision.objects.filter(story__author=request.user, deleted_at__isnull=True).select_related('story').order_by('-created_at')
         
         # Apply search filter if provided
         if search:
@@ -1268,13 +1417,19 @@ class GeneratedContentListAPIView(APIView):
                 Q(format__icontains=search)
             )
         
-        # Calculate pagination
-        total_count = revisions.count()
-        start = (page - 1) * page_size
-        end = start + page_size
-        
+        # Cached total, refreshed in the background once stale
+        search_key = hashlib.md5(search.encode()).hexdigest()
+        total_count = cached_count(f"generated_content:{request.user.id}:{search_key}", revisions)
+
         # Get paginated revisions
-        paginated_revisions = revisions[start:end]
+        if cursor_mode:
+            paginator = KeysetPagination(ordering=('-created_at', '-id'), page_size=page_size)
+            paginated_revisions = paginator.paginate_queryset(revisions, request)
+            page_size = paginator.page_size
+        else:
+            start = (page - 1) * page_size
+            end = start + page_size
+            paginated_revisions = revisions[start:end]
         
         # Format the response
         content_list = []
@@ -1290,6 +1445,11 @@ class GeneratedContentListAPIView(APIView):
                 'storyTitle': revision.story.title
             })
         
+        if cursor_mode:
+            response = paginator.get_paginated_data(content_list)
+            response['total'] = total_count
+            return Response(response)
+
         return Response({
             'results': content_list,
             'total': total_count,
@@ -1712,6 +1872,7 @@ class PaymentView(APIView):
                             if referee_credits:
                                 referee_credits.credits_remaining += REFERRAL_FREE_CREDITS
                                 referee_credits.save()
+                                invalidate_credit_balance(referee.id)
                                 
                                 # Create credit transaction record for the referee
                                 credit_transaction = CreditTransaction.objects.create(
@@ -1725,6 +1886,7 @@ class PaymentView(APIView):
                     credits = order.user.credits.filter(is_active=True).first()
                     credits.credits_remaining += credit_to_be_added
                     credits.save()
+                    invalidate_credit_balance(credits.user_id)
                     order.user.save()
 
                     # Create credit transaction for the purchased credits
@@ -2206,7 +2368,8 @@ class JobViewSet(viewsets.ModelViewSet):
                     status=status.HTTP_400_BAD_REQUEST
                 )
 
-            if job.schedule_retry():
+            # Sent right away, so dispatch_retries must not pick it up again
+            if job.schedule_retry(immediate=True):
                 try:
                     # Re-send to SQS using utility function
                     job = send_job_to_sqs(job, job.request_data)
@@ -2255,7 +2418,7 @@ class JobViewSet(viewsets.ModelViewSet):
                 status=status.HTTP_400_BAD_REQUEST
             )
 
-        job.cancel()
+        cancel_job(job)
         return Response({'message': 'Job cancelled successfully'})
 
 class PublicStoryListAPIView(APIView):
@@ -2263,49 +2426,73 @@ class PublicStoryListAPIView(APIView):
     API endpoint for listing public stories without authentication.
     
     GET /stories/public/ - List all public stories
+    Query Parameters:
+        - page: Page number (default: 1)
+        - page_size: Items per page (default: 10)
+        - search: Search term matched against title, content and author, ranked by relevance
+        - pagination: 'cursor' to page with opaque cursors instead of page numbers (not with search)
+        - cursor: Opaque cursor returned as next_cursor by the previous page
+        - view: 'summary' for the compact story card representation
+        - fields: Comma separated story fields to return
+        - include: Comma separated relations to embed (author, scenes, media)
     """
     permission_classes = [permissions.AllowAny]
 
     def get(self, request):
         """List all public stories."""
+        body = get_or_compute(public_list_cache_key(request), lambda: self.list_stories(request))
+        return Response(body)
+
+    def list_stories(self, request):
+        """Build the response body for a public story listing."""
         # Get query parameters
         page = int(request.query_params.get('page', 1))
         page_size = int(request.query_params.get('page_size', 10))
         search = request.query_params.get('search', '')
+        cursor_mode = request.query_params.get('pagination') == 'cursor' or 'cursor' in request.query_params
 
         # Filter public stories
         stories = Story.objects.filter(is_active=True, is_public=True)
         
-        # Apply search filter if provided
+        # Apply search filter if provided, ranked by relevance; otherwise
+        # order by creation date (newest first)
         if search:
-            stories = stories.filter(
-                Q(title__icontains=search) |
-                Q(content__icontains=search) |
-                Q(author__username__icontains=search)
-            )
-        
-        # Order by creation date (newest first)
-        stories = stories.order_by('-created_at')
+            stories = stories.search(search)
+            # Relevance order can't be seeked on, so search results use pages
+            cursor_mode = False
+        else:
+            stories = stories.order_by('-created_at', '-id')
         
-        # Calculate pagination
-        total_count = stories.count()
+        # Cached total, refreshed in the background once stale
+        search_key = hashlib.md5(search.encode()).hexdigest()
+        total_count = cached_count(f"public_stories:{search_key}", stories)
+
+        if request.query_params.get('view') == 'summary':
+            stories, serializer_class, options = stories.summary(), StorySummarySerializer, {}
+        else:
+            stories, options = story_read_queryset(request, stories)
+            serializer_class = StorySerializer
+
+        if cursor_mode:
+            paginator = KeysetPagination(ordering=('-created_at', '-id'), page_size=page_size)
+            serializer = serializer_class(paginator.paginate_queryset(stories, request), many=True, **options)
+            body = paginator.get_paginated_data(serializer.data)
+            body['total_count'] = total_count
+            return body
+
+        # Serialize the paginated stories
         start = (page - 1) * page_size
         end = start + page_size
-        
-        # Get paginated stories
-        paginated_stories = stories[start:end]
-        
-        # Serialize the stories
-        serializer = StorySerializer(paginated_stories, many=True)
+        serializer = serializer_class(stories[start:end], many=True, **options)
         
         # Return paginated response
-        return Response({
+        return {
             'results': serializer.data,
             'total_count': total_count,
             'total_pages': (total_count + page_size - 1) // page_size,
             'current_page': page,
             'page_size': page_size
-        })
+        }
 
 
 class PublicStoryDetailAPIView(APIView):
@@ -2316,15 +2503,14 @@ class PublicStoryDetailAPIView(APIView):
     """
     permission_classes = [permissions.AllowAny]
 
-    def get_object(self, pk):
-        """Get public story object or return 404."""
-        return get_object_or_404(Story, pk=pk, is_active=True, is_public=True)
-
     def get(self, request, pk):
         """Retrieve a public story."""
-        story = self.get_object(pk)
-        serializer = StorySerializer(story)
-        return Response(serializer.data)
+        def retrieve():
+            stories, options = story_read_queryset(request, Story.objects.filter(is_active=True, is_public=True))
+            story = get_object_or_404(stories, pk=pk)
+            return StorySerializer(story, **options).data
+
+        return Response(get_or_compute(public_story_cache_key(pk, 'detail', request), retrieve))
 
 class PublicStoryRevisionsAPIView(APIView):
     """
@@ -2336,7 +2522,7 @@ class PublicStoryRevisionsAPIView(APIView):
 
     def get(self, request, story_id):
         """Get revisions for a public story."""
-        try:
+        def list_revisions():
             # Verify the story exists and is public
             story = get_object_or_404(Story, id=story_id, is_active=True, is_public=True)
             
@@ -2345,11 +2531,15 @@ class PublicStoryRevisionsAPIView(APIView):
                 story_id=story_id,
                 deleted_at__isnull=True,
                 url__isnull=False
-            ).order_by('-created_at')
-            
-            serializer = RevisionSerializer(revisions, many=True)
-            return Response(serializer.data)
+            ).select_related('story').order_by('-created_at')
             
+            return RevisionSerializer(revisions, many=True).data
+
+        try:
+            body = get_or_compute(public_story_cache_key(story_id, 'revisions', request), list_revisions)
+            return Response(body)
+        except Http404:
+            raise
         except Story.DoesNotExist:
             return Response(
                 {'error': 'Story not found or not public'},
@@ -2361,3 +2551,30 @@ class PublicStoryRevisionsAPIView(APIView):
                 status=status.HTTP_500_INTERNAL_SERVER_ERROR
             )
 
+
+
+class JobCompletionAPIView(APIView):
+    """
+    Internal endpoint workers report finished jobs to, in batches.
+
+    POST /internal/jobs/complete/ - {"events": [{"job_id": 1, "status": "completed", ...}, ...]}
+
+    Authenticated with the shared worker token rather than a user JWT.
+    """
+    authentication_classes = []
+    permission_classes = [IsWorker]
+    max_batch_size = 500
+
+    def post(self, request):
+        events = request.data.get('events') if isinstance(request.data, dict) else None
+        if not isinstance(events, list) or not events:
+            return Response({'error': 'events must be a non-empty list'}, status=status.HTTP_400_BAD_REQUEST)
+        if len(events) > self.max_batch_size:
+            return Response(
+                {'error': f'At most {self.max_batch_size} events can be sent per batch'},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        serializer = JobCompletionEventSerializer(data=events, many=True)
+        if not serializer.is_valid():
+            return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+        return Response(apply_completion_events(serializer.validated_data))
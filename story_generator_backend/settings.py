@@ -14,6 +14,7 @@ from pathlib import Path
 import os
 from dotenv import load_dotenv
 from datetime import timedelta
+from corsheaders.defaults import default_headers
 
 load_dotenv()
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
@@ -41,6 +42,7 @@ INSTALLED_APPS = [
     'django.contrib.sessions',
     'django.contrib.messages',
     'django.contrib.staticfiles',
+    'django.contrib.postgres',
     
     # Third party apps
     'rest_framework',
@@ -60,6 +62,7 @@ MIDDLEWARE = [
     'django.contrib.auth.middleware.AuthenticationMiddleware',  # Authentication middleware must come first
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
+    'core.middleware.IdempotentSubmissionMiddleware',  # Replays repeated submissions before credits are deducted
     'core.middleware.CreditDeductionMiddleware',  # Credit deduction middleware after authentication
 ]
 
@@ -82,6 +85,9 @@ TEMPLATES = [
 ]
 
 WSGI_APPLICATION = 'story_generator_backend.wsgi.application'
+# Production runs the ASGI app (see Procfile) so job event streams and
+# preview long-polls can be parked without tying up a worker thread
+ASGI_APPLICATION = 'story_generator_backend.asgi.application'
 
 
 # Database
@@ -183,6 +189,8 @@ SIMPLE_JWT = {
 
 # CORS settings
 CORS_ALLOW_ALL_ORIGINS = True  # For development only
+CORS_ALLOW_HEADERS = (*default_headers, 'idempotency-key')
+CORS_EXPOSE_HEADERS = ['idempotent-replayed', 'etag']
 CORS_ALLOWED_ORIGINS = [
     "http://localhost:5173",  # Vite default port
     "http://127.0.0.1:5173"
@@ -223,6 +231,36 @@ CHATGPT_OPENAI_API_KEY = os.getenv('CHATGPT_OPENAI_API_KEY')
 # SQS Queue URLs
 WHISPR_TALES_QUEUE_URL = os.getenv('WHISPR_TALES_QUEUE_URL')
 
+# Job queue backend: 'sqs', 'redis' (Redis Streams) or 'memory' (in-process, for local runs and tests)
+JOB_QUEUE_BACKEND = os.getenv('JOB_QUEUE_BACKEND', 'sqs')
+JOB_QUEUE_STREAM = os.getenv('JOB_QUEUE_STREAM', 'whisprtales:jobs')
+JOB_QUEUE_MAXLEN = int(os.getenv('JOB_QUEUE_MAXLEN', 100000))
+
+# Priority lanes. Each lane may have its own SQS queue or stream (falling back
+# to the defaults above); workers consume them in proportion to their weight.
+JOB_QUEUE_LANES = {
+    'interactive': {
+        'weight': 6,
+        'queue_url': os.getenv('INTERACTIVE_QUEUE_URL'),
+        'stream': f'{JOB_QUEUE_STREAM}:interactive',
+    },
+    'preview': {
+        'weight': 3,
+        'queue_url': os.getenv('PREVIEW_QUEUE_URL'),
+        'stream': f'{JOB_QUEUE_STREAM}:preview',
+    },
+    'batch': {
+        'weight': 1,
+        'queue_url': os.getenv('BATCH_QUEUE_URL'),
+        'stream': f'{JOB_QUEUE_STREAM}:batch',
+    },
+}
+# Previews of stories with more active scenes than this run in the batch lane
+JOB_LANE_MAX_PREVIEW_SCENES = int(os.getenv('JOB_LANE_MAX_PREVIEW_SCENES', 20))
+
+# Shared secret workers send to the internal job completion endpoint
+WORKER_API_TOKEN = os.getenv('WORKER_API_TOKEN')
+
 CSRF_TRUSTED_ORIGINS = ['http://localhost:5173']
 
 TEST_RAZORPAY_KEY_ID = os.getenv('TEST_RAZORPAY_KEY_ID')